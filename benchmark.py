@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths on synthetic NVDB geofences (type 911).
+
+    python benchmark.py --fences 1000 --vertices 50 --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.2
+
+Results are written as JSON. With --baseline, every benchmark is compared
+with the stored result of the same name, and the exit code is 1 if any is
+more than 'threshold' slower per item.
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import geofence
+import datex2
+import diff
+import storage
+import util
+from interchange import NordicWayIC
+from notify import SlackNotifier
+from pipeline import SyncPipeline
+from transport import LoopbackBroker, LoopbackTransport
+
+log = logging.getLogger("geofencebroker")
+
+NVDB_HREF = "https://www.vegvesen.no/nvdb/api/v2/vegobjekter/911/{}/{}"
+
+# Geofences are placed within this UTM 33N box around Oslo
+AREA = (250000, 6640000, 280000, 6660000)
+
+
+def _name(rng, length):
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append("".join(rng.choice("abcdefghijklmnopqrstuvwxyzæøå") for _ in range(rng.randint(3, 10))))
+    return " ".join(words)[:length].strip().capitalize()
+
+
+def _polygon(rng, vertices, x=None, y=None):
+    """WKT of a closed, star shaped ring of 'vertices' points"""
+    if x is None:
+        x = rng.uniform(AREA[0], AREA[2])
+        y = rng.uniform(AREA[1], AREA[3])
+    radius = rng.uniform(50, 500)
+    points = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * rng.uniform(0.7, 1.0)
+        points.append((x + r * math.cos(angle), y + r * math.sin(angle)))
+    points.append(points[0])
+    return "POLYGON (({}))".format(", ".join("{:.8f} {:.8f}".format(px, py) for px, py in points))
+
+
+def vegobjekt(rng, nvdb_id, vertices=50, name_length=20, sist_modifisert="2017-09-01 10:00:00", version=1):
+    """A geofence 'vegobjekt' as listed by NVDB, with a random polygon"""
+    return {
+        "id": nvdb_id,
+        "href": NVDB_HREF.format(nvdb_id, version),
+        "metadata": {
+            "type": {"id": 911, "navn": "Geofence"},
+            "versjon": version,
+            "startdato": "2017-01-01",
+            "sist_modifisert": sist_modifisert
+        },
+        "egenskaper": [
+            {"id": 11212, "navn": "Navn", "datatype": 1, "datatype_tekst": "Tekst",
+             "verdi": _name(rng, name_length)},
+            {"id": 11213, "navn": "Beskrivelse", "datatype": 1, "datatype_tekst": "Tekst",
+             "verdi": _name(rng, name_length)},
+            {"id": 11214, "navn": "Versjon", "datatype": 1, "datatype_tekst": "Tekst",
+             "verdi": str(version)},
+            {"id": 11215, "navn": "Geometri, flate", "datatype": 19, "datatype_tekst": "GeomFlate",
+             "verdi": _polygon(rng, vertices)}
+        ],
+        "lokasjon": {"kommuner": [301], "fylker": [3], "regioner": [1], "vegavdelinger": [2]}
+    }
+
+
+def generate(count, vertices=50, name_length=20, seed=0):
+    """'count' geofences with IDs from 1, as listed by NVDB"""
+    rng = random.Random(seed)
+    return [vegobjekt(rng, i, vertices, name_length) for i in range(1, count + 1)]
+
+
+def change(fences, ratio=0.1, vertices=50, name_length=20, seed=1):
+    """
+    The next listing of 'fences': 'ratio' of them modified, and a
+    quarter as many deleted and added.
+    """
+    rng = random.Random(seed)
+    count = int(len(fences) * ratio)
+    listing = list(fences)
+    picked = rng.sample(range(len(listing)), min(len(listing), count + count // 4))
+    for i in picked[:count]:
+        old = listing[i]
+        version = geofence.get_version(old) + 1
+        listing[i] = vegobjekt(rng, old["id"], vertices, name_length, "2017-09-02 10:00:00", version)
+    deleted = set(picked[count:])
+    listing = [f for i, f in enumerate(listing) if i not in deleted]
+    next_id = max(f["id"] for f in fences) + 1 if fences else 1
+    for nvdb_id in range(next_id, next_id + count // 4):
+        listing.append(vegobjekt(rng, nvdb_id, vertices, name_length, "2017-09-02 10:00:00"))
+    return listing
+
+
+class SyntheticNvdb(object):
+    """Lists 'fences' like geofence.NvdbClient"""
+
+    def __init__(self, fences):
+        self.fences = fences
+
+    def objects(self, changed_since=None):
+        return iter(self.fences)
+
+    def ids(self):
+        return [f["id"] for f in self.fences]
+
+
+def measure(fn, items, repeat=3, setup=None):
+    """
+    Runs fn() 'repeat' times, after setup() if given, and returns the
+    best and mean wall time, and the best time per item in microseconds.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - started)
+    best = min(times)
+    return {
+        "items": items,
+        "best_s": round(best, 6),
+        "mean_s": round(sum(times) / len(times), 6),
+        "per_item_us": round(best / max(items, 1) * 1e6, 3)
+    }
+
+
+def reset_database(fences=()):
+    storage.ensure_schema()
+    storage.get_db().query("DELETE FROM vegobjekter")
+    storage.set_state("sist_modifisert", None)
+    storage.write(added=fences)
+
+
+def run(fences=1000, vertices=50, name_length=20, change_ratio=0.1, repeat=3, seed=0, only=None):
+    """Runs the benchmarks and returns their results by name"""
+    base = generate(fences, vertices, name_length, seed)
+    listing = change(base, change_ratio, vertices, name_length, seed + 1)
+    wkts = [[e["verdi"] for e in f["egenskaper"] if e["datatype"] == 19][0] for f in base]
+    polygons = [util.parse_polygon(wkt) for wkt in wkts]
+    coordinates = [tuple(p) for polygon in polygons for p in polygon][:20000]
+    docs = [datex2.create_doc(f) for f in base]
+    modified = [f for f in listing if f["metadata"]["sist_modifisert"] > "2017-09-01 10:00:00"]
+
+    def create_docs():
+        geofence.clear_geometry_cache()
+        for f in base:
+            datex2.create_doc(f)
+
+    def compute_diff():
+        geofence.clear_geometry_cache()
+        diff.compute(listing, storage.versions())
+
+    def add_each():
+        for f in base:
+            storage.add(f)
+
+    def update_each():
+        for f in modified:
+            storage.update(f)
+
+    def end_to_end():
+        broker = LoopbackBroker(capacity=len(listing) * 2)
+        ic = NordicWayIC("amqp://localhost", "geofences", "positions", None, None,
+                         window=100, transport=LoopbackTransport(broker))
+        ic.start()
+        pipeline = SyncPipeline(SyntheticNvdb(listing), ic, SlackNotifier(None), interval=0,
+                                send_timeout=60)
+        pipeline.start()
+        try:
+            pipeline.run_cycle()
+        finally:
+            pipeline.stop(timeout=10)
+            ic.stop()
+
+    benchmarks = [
+        ("util.parse_polygon", lambda: [util.parse_polygon(w) for w in wkts], len(wkts), None),
+        ("util.get_polygon_centroid", lambda: [util.get_polygon_centroid(p) for p in polygons],
+         len(polygons), None),
+        ("util.utm_to_gps", lambda: [util.utm_to_gps(c) for c in coordinates], len(coordinates), None),
+        ("util.utm_to_gps_array", lambda: [util.utm_to_gps_array(p) for p in polygons], len(polygons), None),
+        ("datex2.create_doc", create_docs, len(base), None),
+        ("Datex2.__str__", lambda: [str(d) for d in docs], len(docs), None),
+        ("storage.versions", storage.versions, len(base), lambda: reset_database(base)),
+        ("diff.compute", compute_diff, len(listing), lambda: reset_database(base)),
+        ("storage.add", add_each, len(base), reset_database),
+        ("storage.update", update_each, len(modified), lambda: reset_database(base)),
+        ("storage.write", lambda: storage.write(added=base), len(base), reset_database),
+        ("end_to_end", end_to_end, len(listing), lambda: reset_database(base))
+    ]
+
+    results = {}
+    for name, fn, items, setup in benchmarks:
+        if only and not any(o in name for o in only):
+            continue
+        results[name] = measure(fn, items, repeat, setup)
+        print("{:<28} {:>12.3f} us per item".format(name, results[name]["per_item_us"]), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compares the 'per_item_us' of each of 'results' with 'baseline'.
+    Returns {name: {baseline, current, ratio, regressed}} for the
+    benchmarks in both.
+    """
+    comparison = {}
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]["per_item_us"]
+        after = result["per_item_us"]
+        ratio = after / before if before else float("inf") if after else 1.0
+        comparison[name] = {
+            "baseline": before,
+            "current": after,
+            "ratio": round(ratio, 3),
+            "regressed": ratio > 1 + threshold
+        }
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic NVDB geofences")
+    parser.add_argument("--fences", type=int, default=1000, help="Number of geofences")
+    parser.add_argument("--vertices", type=int, default=50, help="Vertices per polygon")
+    parser.add_argument("--name-length", type=int, default=20, help="Length of names and descriptions")
+    parser.add_argument("--change-ratio", type=float, default=0.1,
+                        help="Share of geofences modified between listings")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark, the best counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", help="Only run benchmarks with these in their name")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Slowdown per item counted as a regression, 0.2 is 20%%")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the log of the code under test")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    log.setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+
+    config = {
+        "fences": args.fences,
+        "vertices": args.vertices,
+        "name_length": args.name_length,
+        "change_ratio": args.change_ratio,
+        "repeat": args.repeat,
+        "seed": args.seed
+    }
+    workdir = tempfile.mkdtemp(prefix="geofence-benchmark-")
+    try:
+        storage.connect("sqlite:///{}".format(os.path.join(workdir, "benchmark.db")))
+        results = run(only=args.only, **config)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {"config": config, "results": results}
+    regressed = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("Baseline was run with another config: {}".format(baseline.get("config")), file=sys.stderr)
+        report["comparison"] = compare(results, baseline["results"], args.threshold)
+        regressed = [name for name, c in sorted(report["comparison"].items()) if c["regressed"]]
+        for name in regressed:
+            print("{} regressed: {current} us per item, was {baseline}".format(
+                name, **report["comparison"][name]), file=sys.stderr)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(1 if regressed else 0)
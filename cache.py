@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, namedtuple
+import logging
+import os
+import pickle
+import threading
+
+# A geofence as it appears in a Datex2 document:
+#  name         - name of the geofence
+#  polygon      - list of (lat, lon) tuples
+#  centroid     - (lat, lon) tuple
+#  container    - the serialized <predefinedLocationContainer>
+#  content_hash - see geofence.content_hash(), or None
+CachedLocation = namedtuple("CachedLocation", ["name", "polygon", "centroid", "container", "content_hash"])
+
+
+class DocumentCache(object):
+    """
+    Bounded LRU cache of serialized Datex2 locations and their GPS
+    centroid, keyed by (nvdb_id, version). Optionally persisted to
+    'path' with save(), and loaded from it again on startup.
+    """
+
+    def __init__(self, maxsize=10000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.log = logging.getLogger("geofencebroker")
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def get(self, nvdb_id, version, content_hash=None):
+        """
+        The CachedLocation for 'nvdb_id' and 'version', or None. An entry
+        stored with another 'content_hash' than given counts as a miss.
+        """
+        key = (int(nvdb_id), version or None)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and content_hash and entry.content_hash != content_hash:
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Reinsert as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, nvdb_id, version, entry):
+        key = (int(nvdb_id), version or None)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, datex_obj, content_hash=None):
+        """Caches each location in the 'datex2' object that has a polygon"""
+        for i, (name, nvdb_id, version, polygon) in enumerate(datex_obj.locations):
+            if polygon:
+                self.put(nvdb_id, version, CachedLocation(
+                    name, polygon, datex_obj.centroids[i], datex_obj.containers[i], content_hash))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups else 0.0
+        }
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                entries = pickle.load(f)
+        except Exception as e:
+            self.log.warn("Unable to load document cache from {}: {}".format(self.path, e))
+            return
+        with self._lock:
+            self._entries = OrderedDict((key, CachedLocation(*entry)) for key, entry in entries)
+        self.log.debug("Loaded {} cached documents from {}".format(len(self._entries), self.path))
+
+    def save(self):
+        """Writes the cache to 'path', replacing the previous file atomically"""
+        if not self.path:
+            return
+        with self._lock:
+            entries = [(key, tuple(entry)) for key, entry in self._entries.items()]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<{} size={}, maxsize={}, path={}>".format(
+            self.__class__.__name__, len(self._entries), self.maxsize, self.path)
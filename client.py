@@ -4,21 +4,28 @@
 from __future__ import print_function, unicode_literals
 import argparse
 import logging
-import coloredlogs
-import yaml
 import os
+import signal
 import sys
 import geofence
 import storage
+from cache import DocumentCache
 import datex2
-import time
-from interchange import NordicWayIC, ConnectionError
-from util import slack_notify
+from interchange import NordicWayIC
+from transport import QpidTransport, LoopbackBroker, LoopbackTransport
+from index import GeofenceIndex
+from consumer import Consumer
+from convert import DocumentConverter
+from notify import SlackNotifier
+from pipeline import SyncPipeline
+from metrics import MetricsServer, MetricsFile
+from profiling import CycleProfiler
 
 log = logging.getLogger("geofencebroker")
 
 
 def init_logging(debug_env_var):
+    import coloredlogs
 
     field_style_override = coloredlogs.DEFAULT_FIELD_STYLES
     level_style_override = coloredlogs.DEFAULT_LEVEL_STYLES
@@ -61,6 +68,13 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--password", help="Password", default=None)
     parser.add_argument("-t", "--timeout", type=int,
                         help="Timeout in seconds before checking NVDB for geofence updates", default=None)
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Only fetch geofences changed since the last cycle from NVDB", default=False)
+    parser.add_argument("--profile-cycles", type=int, metavar="N",
+                        help="Profile the first N sync cycles, see also SIGUSR1", default=None)
+    parser.add_argument("--consume", action="store_true",
+                        help="Also match positions of messages on the receiver queue against the geofences",
+                        default=False)
 
     args = parser.parse_args()
     cfg = {}
@@ -68,6 +82,7 @@ if __name__ == '__main__':
     init_logging('DEBUG')
 
     if args.config:
+        import yaml
         log.info("Using config file")
         if not os.path.exists(args.config):
             log.error("Config file was not found..")
@@ -102,6 +117,15 @@ if __name__ == '__main__':
     if args.timeout:
         cfg.update({"timeout": args.timeout})
 
+    if args.incremental:
+        cfg.update({"sync_mode": "incremental"})
+
+    if args.profile_cycles:
+        cfg.update({"profile_cycles": args.profile_cycles})
+
+    if args.consume:
+        cfg.update({"consume": True})
+
     options = {"ssl_skip_hostname_check": True}
     if cfg.get("ssl_keyfile", False):
         options.update({"ssl_keyfile": cfg.get("ssl_keyfile")})
@@ -116,10 +140,22 @@ if __name__ == '__main__':
                 Therefore you need to specify SSL cert and key.""")
             sys.exit(1)
 
-    # Enable reconnection option
-    options.update({
-        "reconnect": True
-    })
+    # NordicWayIC reconnects on its own, with backoff, from its
+    # background thread. qpid's reconnect would hide a broken connection
+    # from its health checks.
+    # 'loopback' sends to an in-process stand-in for the broker, set up
+    # with the 'loopback' options (latency, capacity, failure_rate)
+    if cfg.get("transport", "qpid") == "loopback":
+        broker = LoopbackBroker(**cfg.get("loopback", {}))
+        log.warn("Using loopback transport: {}".format(broker))
+        create_transport = lambda: LoopbackTransport(broker)
+    else:
+        create_transport = QpidTransport
+    try:
+        transport = create_transport()
+    except ImportError as ie:
+        log.error(ie)
+        sys.exit(1)
 
     log.info("Connecting to {broker_url}".format(**cfg))
     log.info(" sender: {sender}, receiver: {receiver}".format(**cfg))
@@ -129,119 +165,144 @@ if __name__ == '__main__':
                      cfg.get("receiver"),
                      cfg.get("username"),
                      cfg.get("password"),
-                     options)
+                     options,
+                     batch_size=cfg.get("batch_size", 1),
+                     batch_max_bytes=cfg.get("batch_max_bytes", None),
+                     window=cfg.get("send_window", 1),
+                     settle_timeout=cfg.get("send_settle_timeout", 30.0),
+                     outbox_size=cfg.get("outbox_size", 10000),
+                     reconnect_backoff=cfg.get("reconnect_backoff", 1.0),
+                     max_reconnect_backoff=cfg.get("max_reconnect_backoff", 60.0),
+                     health_interval=cfg.get("health_check_interval", 10.0),
+                     transport=transport)
     log.debug(ic)
 
-    # try:
-    #     ic.connect()
-    # except ConnectionError as e:
-    #     log.error("Unable to connect to {}".format(cfg.get("broker_url")))
-    #     log.error(e)
-    #     sys.exit(1)
-
-    # if not ic.connection.opened():
-    #     log.error("Unable to connect!")
-    #     sys.exit(1)
+    nvdb = geofence.NvdbClient(connect_timeout=cfg.get("nvdb_connect_timeout", 3.05),
+                               read_timeout=cfg.get("nvdb_read_timeout", 30.0),
+                               retries=cfg.get("nvdb_retries", 3))
+    log.debug(nvdb)
+
+    document_cache = DocumentCache(cfg.get("document_cache_size", 10000),
+                                   cfg.get("document_cache_file", None))
+    log.debug(document_cache)
+
+    # Optional polygon simplification (meters) and coordinate rounding
+    # (decimals) for smaller Datex2 messages
+    reducer = None
+    if cfg.get("simplify_tolerance") or cfg.get("coordinate_decimals") is not None:
+        reducer = datex2.GeometryReducer(cfg.get("simplify_tolerance"), cfg.get("coordinate_decimals"))
+        log.debug(reducer)
+
+    # Large change sets are converted in 'workers' processes (default:
+    # all cores). The pool forks here, before any threads are started.
+    converter = DocumentConverter(workers=cfg.get("workers"),
+                                  chunksize=cfg.get("convert_chunksize", 16),
+                                  min_parallel=cfg.get("convert_min_parallel", 64),
+                                  reducer=reducer)
+    converter.start()
+    log.debug(converter)
+
+    # The connection stays open across cycles. How long each cycle waits
+    # for its geofences to be delivered; the rest keep going out from the
+    # outbox in the background.
+    ic.start()
+    send_timeout = cfg.get("send_timeout", 60)
 
     sleep_time = cfg.get("timeout")
-    log.debug("Sleeping for {} seconds between each check.".format(sleep_time))
-
-    # hack to create centroids if missing - a one-time operation!
-    storage.fix_centroid()
-    slack_url = cfg.get("slack_webhook_url", None)
-    slack_notify(
-        "Geofence is up and running! Will check periodically every {} second".format(sleep_time),
-        slack_url)
-
-
-    # Main loop
-    while True:
-        fences = geofence.fetch_objects()
-
-        if not fences or fences["metadata"].get("returnert", 0) == 0:
-            time.sleep(sleep_time)
-            continue
-
-        # TODO: Check if returned JSON has paging. If so, fetch the rest of
-        #       the geofence objects
-        vegobjekt_ids = []
-        try:
-            ic.connect()
-            log.debug("Connect to interchange.")
-            for fence in fences.get("objekter"):
-                # Sample all vegobjekt IDs to check if there are anyone that
-                # has been deleted from NVDB
-                vegobjekt_ids.append(int(fence.get("id", 0)))
-
-                if not storage.exists(fence):
-                    datex_obj = datex2.create_doc(fence)
-                    #datex_obj.name = unicode("TestÆØÅ-New")
-
-                    msg = u"New geofence: id={}, version={}, name={}".format(
-                        fence.get("id"), datex_obj.version, datex_obj.name)
-                    log.info(msg)
-                    try:
-                        slack_notify(msg, slack_url)
-                    except Exception:
-                        log.warn("Unable to send slack notification")
-
-                    try:
-                        ic.send_obj(datex_obj)
-                    except ConnectionError as ce:
-                        raise ce
-                    else:
-                        storage.add(fence)
-                else:
-                    if storage.is_modified(fence):
-                        datex_obj = datex2.create_doc(fence)
-                        # datex_obj.name = unicode("TestÆØÅ")
-                        msg = u"Modified geofence: message: id={}, version={}, name={}".format(
-                            fence.get("id"), datex_obj.version, datex_obj.name)
-                        log.info(msg)
-                        slack_notify(msg, slack_url)
-                        try:
-                            ic.send_obj(datex_obj)
-                        except ConnectionError as ce:
-                            raise ce
-                        else:
-                            storage.update(fence)
-
-                    # else:
-                        # log.debug("geofence is already in db and has not been updated.")
-
-
-            # Find deleted vegobjekter in NVDB by getting a list of ID's from our
-            # cache database and list all ID's missing in our JSON from NVDB.
-            vegobjekter = storage.vegobjekter().all()
-            for v in vegobjekter:
-                # log.debug("inspecting v: {}".format(v.get("id")))
-                if v.get("id") not in vegobjekt_ids:
-                    msg = "Vegobjekt with ID '{}' removed from NVDB: {}".format(v.get("id"), v)
-                    log.warn(msg)
-                    slack_notify(msg, slack_url)
-                    datex_obj = datex2.create_delete_doc_from_db(v)
-                    ic.send_obj(datex_obj)
-                    log.debug(datex_obj)
-                    storage.delete(v.get("id"))
-                    log.warn("Delete geofence id: {}".format(v.get("id")))
-
-        except ConnectionError:
-            # Interchange lost its connection
-            log.debug("Interchange connection error. Trying to re-connect. URI: {}".format(cfg.get("broker_url")))
-            #while True:
-            #    try:
-            #        ic.connect()
-            #        log.debug("Successfully re-connected to {}".format(cfg.get("broker_url")))
-            #    except ConnectionError:
-            #        log.debug("")
-            #        time.sleep(5)
-            #        continue
-            #    break
-        else:
-            log.debug("Disconnect interchange.")
-            ic.close()
-
-        time.sleep(sleep_time)
-    ic.close()
+    log.debug("Starting a cycle every {} seconds.".format(sleep_time))
+
+    # One-time fixes of the database run once, as numbered migrations
+    storage.configure(cfg.get("database_url", storage.DEFAULT_URL))
+    storage.migrate()
+    notifier = SlackNotifier(cfg.get("slack_webhook_url", None),
+                             queue_size=cfg.get("slack_queue_size", 100),
+                             min_interval=cfg.get("slack_min_interval", 1.0))
+    notifier.start()
+    log.debug(notifier)
+    notifier.notify(
+        "Geofence is up and running! Will check periodically every {} second".format(sleep_time))
+
+    # Consumer mode: match the positions of the messages on the receiver
+    # queue against the stored geofences, on a connection of its own.
+    # Hits are sent to 'hits_queue' if 'consume_publish_hits' is set.
+    index = None
+    consumer = None
+    if cfg.get("consume"):
+        if cfg.get("consume_publish_hits") and not cfg.get("hits_queue"):
+            log.error("consume_publish_hits needs a hits_queue to send the hits to")
+            sys.exit(1)
+        index = GeofenceIndex()
+        index.load(storage.polygons())
+        log.debug(index)
+        consumer_ic = NordicWayIC(cfg.get("broker_url"),
+                                  cfg.get("hits_queue"),
+                                  cfg.get("receiver"),
+                                  cfg.get("username"),
+                                  cfg.get("password"),
+                                  options,
+                                  window=cfg.get("send_window", 1),
+                                  transport=create_transport(),
+                                  prefetch=cfg.get("consume_prefetch", 1000))
+        consumer = Consumer(consumer_ic, index,
+                            batch_size=cfg.get("consume_batch_size", 500),
+                            publish_hits=cfg.get("consume_publish_hits", False),
+                            report_interval=cfg.get("consume_report_interval", 60))
+        consumer.start()
+        log.debug(consumer)
+
+
+    # Counters and latency histograms in the Prometheus text format, on
+    # http://metrics_host:metrics_port/metrics and/or written to
+    # 'metrics_file' every 'metrics_interval' seconds
+    exporters = []
+    if cfg.get("metrics_port"):
+        exporters.append(MetricsServer(cfg.get("metrics_port"), cfg.get("metrics_host", "127.0.0.1")))
+    if cfg.get("metrics_file"):
+        exporters.append(MetricsFile(cfg.get("metrics_file"), cfg.get("metrics_interval", 60)))
+    for exporter in exporters:
+        exporter.start()
+        log.debug(exporter)
+
+    # Profiles of the first 'profile_cycles' cycles, and of the next
+    # 'profile_signal_cycles' cycles after each SIGUSR1, are written to
+    # 'profile_dir'. See profiling.CycleProfiler for 'profile_mode'.
+    profiler = CycleProfiler(cfg.get("profile_dir", "profiles"),
+                             cfg.get("profile_mode", "cprofile"),
+                             cfg.get("profile_interval", 0.005))
+    if cfg.get("profile_cycles"):
+        profiler.request(cfg.get("profile_cycles"))
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: profiler.request(cfg.get("profile_signal_cycles", 1)))
+    log.debug(profiler)
+
+    # Each cycle runs through the fetch, diff, convert, publish and
+    # persist stages at once, see pipeline.SyncPipeline. Cycles start
+    # every 'timeout' seconds, counted from the start of the previous one.
+    pipeline = SyncPipeline(nvdb, ic, notifier,
+                            interval=sleep_time,
+                            incremental=cfg.get("sync_mode", "full") == "incremental",
+                            delete_check_interval=cfg.get("delete_check_interval", 3600),
+                            cache=document_cache,
+                            converter=converter,
+                            index=index,
+                            reducer=reducer,
+                            send_timeout=send_timeout,
+                            chunk_size=cfg.get("pipeline_chunk_size", 200),
+                            queue_size=cfg.get("pipeline_queue_size", 8),
+                            profiler=profiler)
+    log.debug("Sync mode: {}".format(cfg.get("sync_mode", "full")))
+    log.debug(pipeline)
+    pipeline.start()
+    try:
+        pipeline.run()
+    finally:
+        pipeline.stop(timeout=10)
+    ic.stop()
+    if consumer is not None:
+        consumer.stop(timeout=10)
+    notifier.stop(timeout=10)
+    converter.close()
+    for exporter in exporters:
+        exporter.stop()
 
     log.info("Shutdown.. See ya!")
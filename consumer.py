@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+import numpy as np
+import datex2
+from transport import Message, MessagingError
+from util import parse_iso_epoch
+
+log = logging.getLogger("geofencebroker")
+
+
+def parse_positions(messages):
+    """
+    The 'lat' and 'lon' properties of 'messages' as float arrays, with
+    NaN where a message has no valid position, and the array of their
+    'when' timestamps in epoch seconds (NaN if missing).
+    """
+    properties = [m.properties or {} for m in messages]
+    positions = [(p.get("lat"), p.get("lon")) for p in properties]
+    try:
+        lat, lon = np.array(positions, dtype=np.float64).reshape(-1, 2).T
+    except (TypeError, ValueError):
+        lat, lon = np.array([_positions(p) for p in positions], dtype=np.float64).reshape(-1, 2).T
+    sent_at = np.array([parse_iso_epoch(p.get("when")) for p in properties], dtype=np.float64)
+    return lat, lon, sent_at
+
+
+def _positions(position):
+    try:
+        return float(position[0]), float(position[1])
+    except (TypeError, ValueError):
+        return np.nan, np.nan
+
+
+class Consumer(object):
+    """
+    Drains the receiver queue of 'ic' (a NordicWayIC with its own
+    connection) in a background thread, and matches the position of each
+    message against 'index' (an index.GeofenceIndex).
+
+    Messages are fetched 'batch_size' at a time and acknowledged per
+    batch. Hits are logged, and sent as JSON messages through the sender
+    of 'ic' if 'publish_hits' is set. Throughput and lag (the time since
+    the 'when' property of a message) are logged every
+    'report_interval' seconds, see stats().
+    """
+
+    def __init__(self, ic, index, batch_size=500, timeout=1.0, publish_hits=False,
+                 report_interval=60.0, reconnect_backoff=1.0, max_reconnect_backoff=60.0):
+        self.ic = ic
+        self.index = index
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.publish_hits = publish_hits
+        self.report_interval = report_interval
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self._stop = threading.Event()
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._since = time.time()
+        self._received = 0
+        self._hits = 0
+        self._invalid = 0
+        self._lag_sum = 0.0
+        self._lag_max = 0.0
+        self._lag_count = 0
+        self._match_time = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="consumer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.ic.close()
+
+    def _run(self):
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                if not self.ic.connected():
+                    self.ic.close()
+                    self.ic.connect()
+                    log.info("Consumer connected to {}".format(self.ic.url))
+                self.consume()
+                attempt = 0
+            except Exception as e:
+                # Anything else would end this thread without a word, so
+                # it is logged and the unacknowledged batch fetched again
+                delay = random.uniform(0, min(self.max_reconnect_backoff,
+                                              self.reconnect_backoff * 2 ** attempt))
+                attempt += 1
+                if isinstance(e, MessagingError):
+                    log.warn("Consumer error: {}. Reconnecting in {:.1f} seconds".format(e, delay))
+                else:
+                    log.exception("Unexpected consumer error. Reconnecting in {:.1f} seconds".format(delay))
+                self.ic.close()
+                self._stop.wait(delay)
+            if time.time() - self._since >= self.report_interval:
+                log.info("Consumer: {}".format(self.stats()))
+                self._reset_stats()
+
+    def consume(self):
+        """Handles one batch of messages. Returns the number of messages."""
+        messages = self.ic.recv_batch(self.batch_size, self.timeout)
+        if not messages:
+            return 0
+
+        started = time.time()
+        lat, lon, sent_at = parse_positions(messages)
+        point, ids = self.index.query(lat, lon)
+        self._match_time += time.time() - started
+
+        if len(point):
+            self._hit(messages, lat, lon, point, ids)
+        self.ic.acknowledge()
+
+        self._received += len(messages)
+        self._hits += len(point)
+        self._invalid += int(np.isnan(lat).sum())
+        lags = started - sent_at[~np.isnan(sent_at)]
+        if len(lags):
+            self._lag_sum += float(lags.sum())
+            self._lag_max = max(self._lag_max, float(lags.max()))
+            self._lag_count += len(lags)
+        return len(messages)
+
+    def _hit(self, messages, lat, lon, point, ids):
+        # 'point' is sorted, so the hits of each message are consecutive
+        bounds = np.flatnonzero(np.diff(point)) + 1
+        hits = []
+        for indices in np.split(np.arange(len(point)), bounds):
+            i = point[indices[0]]
+            fences = ids[indices].tolist()
+            log.debug("Position (%s, %s) is inside geofences %s", lat[i], lon[i], fences)
+            if self.publish_hits:
+                # Our own properties only: the broker rejects a user_id
+                # other than ours, and the sender's routing is not ours
+                # to pass on
+                properties = {
+                    "what": "GeofenceHit",
+                    "geofences": ",".join(str(f) for f in fences),
+                    "lat": float(lat[i]),
+                    "lon": float(lon[i]),
+                    "when": datetime.datetime.now(datex2.get_timezone()).isoformat()
+                }
+                hits.append(Message(content=json.dumps({"lat": lat[i], "lon": lon[i], "geofences": fences}),
+                                    properties=properties,
+                                    user_id=self.ic.username))
+        if hits:
+            self.ic.send_messages(hits)
+
+    def stats(self):
+        elapsed = max(time.time() - self._since, 1e-9)
+        return {
+            "received": self._received,
+            "per_second": round(self._received / elapsed, 1),
+            "hits": self._hits,
+            "invalid": self._invalid,
+            "match_us_per_message": round(self._match_time / self._received * 1e6, 1) if self._received else 0.0,
+            "lag_mean": round(self._lag_sum / self._lag_count, 3) if self._lag_count else 0.0,
+            "lag_max": round(self._lag_max, 3)
+        }
+
+    def __repr__(self):
+        return "<{} batch_size={}, prefetch={}, publish_hits={}>".format(
+            self.__class__.__name__, self.batch_size, self.ic.prefetch, self.publish_hits)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import time
+import datex2
+import geofence
+import metrics
+
+log = logging.getLogger("geofencebroker")
+
+# The GeometryReducer of a worker process, see _init_worker()
+_reducer = None
+
+
+def _init_worker(tolerance, decimals):
+    global _reducer
+    if tolerance or decimals is not None:
+        _reducer = datex2.GeometryReducer(tolerance, decimals)
+
+
+def _convert(vegobjekt):
+    """
+    Runs in a worker: converts 'vegobjekt' with datex2.create_doc() and
+    returns its location as a picklable tuple, see DocumentConverter.
+    """
+    if _reducer is not None:
+        _reducer.reset()
+    try:
+        started = time.time()
+        doc = datex2.create_doc(vegobjekt, reducer=_reducer)
+        elapsed = time.time() - started
+        name, nvdb_id, version, polygon = doc.locations[0]
+        return (name, nvdb_id, version, polygon, doc.centroids[0], doc.containers[0],
+                geofence.get_content_hash(vegobjekt), _reducer.stats() if _reducer is not None else None,
+                elapsed)
+    finally:
+        # Workers live as long as the pool, and only the parent clears its
+        # memo each cycle, so the geometry is not kept past this call
+        geofence.clear_geometry_cache()
+
+
+class DocumentConverter(object):
+    """
+    Converts 'vegobjekt' dicts from NVDB to Datex2 documents. Change sets
+    of at least 'min_parallel' geofences are converted by a pool of
+    'workers' processes (all cores if None), handed out 'chunksize' at a
+    time. Smaller ones, or all with 'workers' set to 1, are converted in
+    this process.
+
+    The pool forks on start(), which should happen before any other
+    threads are started.
+    """
+
+    def __init__(self, workers=None, chunksize=16, min_parallel=64, reducer=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.min_parallel = min_parallel
+        self.reducer = reducer
+        self._pool = None
+
+    def start(self):
+        if self._pool is not None or self.workers <= 1:
+            return
+        tolerance = self.reducer.tolerance if self.reducer is not None else None
+        decimals = self.reducer.decimals if self.reducer is not None else None
+        self._pool = multiprocessing.Pool(self.workers, _init_worker, (tolerance, decimals))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def convert(self, vegobjekter, cache=None):
+        """
+        Yields the Datex2 document of each of 'vegobjekter', in order. If
+        'cache' (a cache.DocumentCache) is given, documents converted
+        before are taken from it, e.g. when a geofence is sent again, and
+        the new ones are put in it.
+        """
+        vegobjekter = list(vegobjekter)
+        cached = [datex2.cached_doc(v, cache) if cache is not None else None for v in vegobjekter]
+        converted = self._convert_missing([v for v, doc in zip(vegobjekter, cached) if doc is None], cache)
+        for doc in cached:
+            yield doc if doc is not None else next(converted)
+
+    def _convert_missing(self, vegobjekter, cache):
+        if len(vegobjekter) < self.min_parallel or self.workers <= 1:
+            for vegobjekt in vegobjekter:
+                doc = datex2.create_doc(vegobjekt, reducer=self.reducer)
+                if cache is not None:
+                    cache.add(doc, geofence.get_content_hash(vegobjekt))
+                yield doc
+            return
+
+        self.start()
+        log.debug("Converting {} geofences in {} processes".format(len(vegobjekter), self.workers))
+        for result in self._pool.imap(_convert, vegobjekter, self.chunksize):
+            name, nvdb_id, version, polygon, centroid, container, content_hash, reduction, elapsed = result
+            # The metrics of the workers are not exposed, so time them here
+            metrics.CONVERT_SECONDS.observe(elapsed)
+            doc = datex2.Datex2()
+            doc.add_location(name, nvdb_id, version, polygon, centroid, container)
+            if cache is not None:
+                cache.add(doc, content_hash)
+            if self.reducer is not None and reduction is not None:
+                self.reducer.merge(reduction)
+            yield doc
+
+    def __repr__(self):
+        return "<{} workers={}, chunksize={}, min_parallel={}>".format(
+            self.__class__.__name__, self.workers, self.chunksize, self.min_parallel)
@@ -1,40 +1,272 @@
 # -*- coding: utf-8 -*-
 
-from lxml import etree
-import io
 import datetime
-import pytz
 import logging
+import time
+import numpy as np
 import geofence
+import geometry
+import metrics
 import util
 
 log = logging.getLogger("geofencebroker")
 
+# pytz and lxml are imported on first use, which keeps startup fast
+_timezone = None
+_etree = None
+
+
+def get_timezone():
+    """The Europe/Oslo timezone of publication times"""
+    global _timezone
+    if _timezone is None:
+        import pytz
+        _timezone = pytz.timezone("Europe/Oslo")
+    return _timezone
+
+
+def get_etree():
+    """lxml.etree, to build the tree of Datex2.doc"""
+    global _etree
+    if _etree is None:
+        from lxml import etree
+        _etree = etree
+    return _etree
+
+
+# Precompiled document skeleton for Datex2.__str__(). Together with the
+# container templates below this gives exactly what lxml pretty prints for
+# the tree in Datex2.doc, without building the tree.
+_HEAD = (
+    u'<d2LogicalModel xmlns="http://datex2.eu/schema/2/2_0" modelBaseVersion="2">\n'
+    u'  <exchange>\n'
+    u'    <supplierIdentification>\n'
+    u'      <country>no</country>\n'
+    u'      <nationalIdentifier>Norwegian Public Roads Administration</nationalIdentifier>\n'
+    u'    </supplierIdentification>\n'
+    u'  </exchange>\n'
+    u'  <payloadPublication xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" lang="en" '
+    u'xsi:type="PredefinedLocationsPublication">\n'
+    u'    <publicationTime>{}</publicationTime>\n'
+    u'    <publicationCreator>\n'
+    u'      <country>no</country>\n'
+    u'      <nationalIdentifier>Norwegian Public Roads Administration</nationalIdentifier>\n'
+    u'    </publicationCreator>\n'
+    u'    <headerInformation>\n'
+    u'      <confidentiality>noRestriction</confidentiality>\n'
+    u'      <informationStatus>real</informationStatus>\n'
+    u'    </headerInformation>\n'
+)
+_TAIL = (
+    b'  </payloadPublication>\n'
+    b'</d2LogicalModel>\n'
+)
+_CONTAINER_HEAD = (
+    u'    <predefinedLocationContainer id="{}" version="{}" xsi:type="PredefinedLocation">\n'
+    u'      <predefinedLocationName>\n'
+    u'        <values>\n'
+    u'          <value>{}</value>\n'
+    u'        </values>\n'
+    u'      </predefinedLocationName>\n'
+    u'      <location xsi:type="Area">\n'
+    u'        <areaExtension>\n'
+    u'          <openlrExtendedArea>\n'
+    u'            <openlrAreaLocationReference xsi:type="OpenlrPolygonLocationReference">\n'
+)
+_CORNERS_OPEN = b'              <openlrPolygonCorners>\n'
+_CORNERS_EMPTY = b'              <openlrPolygonCorners/>\n'
+_CORNERS_CLOSE = b'              </openlrPolygonCorners>\n'
+_COORDINATE = (
+    b'                <openlrCoordinate>\n'
+    b'                  <latitude>%s</latitude>\n'
+    b'                  <longitude>%s</longitude>\n'
+    b'                </openlrCoordinate>\n'
+)
+_CONTAINER_TAIL = (
+    b'            </openlrAreaLocationReference>\n'
+    b'          </openlrExtendedArea>\n'
+    b'        </areaExtension>\n'
+    b'      </location>\n'
+    b'    </predefinedLocationContainer>\n'
+)
+
+
+# Size of a document without any containers, give or take the length
+# of the publication time
+_HEADER_SIZE = len(_HEAD.format(u"2017-01-01T00:00:00.000000+01:00")) + len(_TAIL)
+
+
+def _escape(value, attribute=False):
+    """Escapes 'value' for XML the way lxml does, as ASCII bytes"""
+    value = u"{}".format(value).replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+    if attribute:
+        value = value.replace(u'"', u"&quot;").replace(u"\n", u"&#10;").replace(u"\t", u"&#9;")
+    return value.replace(u"\r", u"&#13;").encode("ascii", "xmlcharrefreplace")
+
+
+def render_container(name, nvdb_id, version, polygon):
+    """
+    Serializes one <predefinedLocationContainer> block, where 'polygon' is
+    a list of (lat, lon) tuples, by streaming the coordinates into the
+    precompiled templates.
+    """
+    head = _CONTAINER_HEAD.format(_escape(nvdb_id, True).decode("ascii"),
+                                  _escape(version, True).decode("ascii"),
+                                  _escape(name).decode("ascii"))
+    chunks = [head.encode("ascii")]
+    if polygon:
+        chunks.append(_CORNERS_OPEN)
+        chunks.extend(_COORDINATE % (str(lat), str(lon)) for lat, lon in polygon)
+        chunks.append(_CORNERS_CLOSE)
+    else:
+        chunks.append(_CORNERS_EMPTY)
+    chunks.append(_CONTAINER_TAIL)
+    return b"".join(chunks)
+
+
+def _vertex_size(lat, lon):
+    """Bytes of one <openlrCoordinate> in a container"""
+    return len(_COORDINATE % (str(float(lat)), str(float(lon))))
+
+
+class GeometryReducer(object):
+    """
+    Optional stage between geofence.get_polygon() and the Datex2
+    container, see Datex2.body(). Simplifies each polygon with
+    geometry.simplify() at 'tolerance' meters, and rounds the GPS
+    coordinates to 'decimals' places (6 is about 0.1 meter).
+
+    Counts vertices and container bytes before and after, see stats().
+    """
+
+    def __init__(self, tolerance=None, decimals=None):
+        self.tolerance = tolerance
+        self.decimals = decimals
+        self.reset()
+
+    def reset(self):
+        self.polygons = 0
+        self.vertices_before = 0
+        self.vertices_after = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
 
-def create_doc(vegobjekt):
+    def simplify(self, polygon):
+        """The UTM 'polygon' simplified, as an N×2 array"""
+        return geometry.simplify(polygon, self.tolerance)
+
+    def quantize(self, lat, lon):
+        """
+        The 'lat' and 'lon' arrays rounded, without the consecutive
+        duplicates that rounding may leave. A ring that rounding would
+        collapse below a closed triangle is returned unrounded.
+        """
+        if self.decimals is None or not len(lat):
+            return lat, lon
+        rounded_lat = np.round(lat, self.decimals)
+        rounded_lon = np.round(lon, self.decimals)
+        keep = np.ones(len(lat), dtype=bool)
+        keep[1:] = (rounded_lat[1:] != rounded_lat[:-1]) | (rounded_lon[1:] != rounded_lon[:-1])
+        rounded_lat, rounded_lon = rounded_lat[keep], rounded_lon[keep]
+        if len(rounded_lat) < 4 or len(set(zip(rounded_lat.tolist(), rounded_lon.tolist()))) < 3:
+            return lat, lon
+        return rounded_lat, rounded_lon
+
+    def record(self, nvdb_id, polygon, container, reduced):
+        """Counts a location with the original UTM 'polygon', which became
+        'container' with the GPS ring 'reduced'. The size the container
+        would have had unreduced is estimated from the size of its first
+        vertex, rather than projecting and serializing the polygon again.
+        """
+        lat, lon = util.utm_to_gps(polygon[0])
+        before = len(container) + len(polygon) * _vertex_size(lat, lon)
+        if reduced:
+            before -= len(reduced) * _vertex_size(*reduced[0])
+        self.polygons += 1
+        self.vertices_before += len(polygon)
+        self.vertices_after += len(reduced)
+        self.bytes_before += before
+        self.bytes_after += len(container)
+        log.debug(u"Reduced geofence {}: {} -> {} vertices, about {} -> {} bytes".format(
+            nvdb_id, len(polygon), len(reduced), before, len(container)))
+
+    def merge(self, stats):
+        """Adds the stats() of another reducer, e.g. in a worker process"""
+        self.polygons += stats["polygons"]
+        self.vertices_before += stats["vertices_before"]
+        self.vertices_after += stats["vertices_after"]
+        self.bytes_before += stats["bytes_before"]
+        self.bytes_after += stats["bytes_after"]
+
+    def stats(self):
+        return {
+            "polygons": self.polygons,
+            "vertices_before": self.vertices_before,
+            "vertices_after": self.vertices_after,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after
+        }
+
+    def __repr__(self):
+        return "<{} tolerance={}, decimals={}>".format(
+            self.__class__.__name__, self.tolerance, self.decimals)
+
+
+def cached_doc(vegobjekt, cache):
+    """The Datex2 doc for a 'vegobjekt' from NVDB out of 'cache' (a
+    cache.DocumentCache), or None if this version and content of it was
+    not converted before.
+    """
+    nvdb_id = vegobjekt["id"]
+    version = geofence.get_version(vegobjekt)
+    cached = cache.get(nvdb_id, version, geofence.get_content_hash(vegobjekt))
+    if cached is None:
+        return None
+    doc = Datex2()
+    doc.add_location(cached.name, nvdb_id, version, cached.polygon, cached.centroid, cached.container)
+    return doc
+
+
+def create_doc(vegobjekt, cache=None, reducer=None):
+    """Constructs the Datex2 doc for a 'vegobjekt' from NVDB, with its
+    polygon reduced by 'reducer' (a GeometryReducer) if given. If 'cache'
+    (a cache.DocumentCache) is given, a doc converted before is taken from
+    it, and a new one is put in it.
+    """
+    if cache is not None:
+        doc = cached_doc(vegobjekt, cache)
+        if doc is not None:
+            return doc
+
+    started = time.time()
     doc = Datex2()
 
     name = geofence.get_name(vegobjekt)
     nvdb_id = vegobjekt["id"]
     version = geofence.get_version(vegobjekt)
     polygon = geofence.get_polygon(vegobjekt)
-
-    polygon = [[float(j) for j in i] for i in polygon]
     centroid = util.get_polygon_centroid(polygon)
 
-    doc.body(name, nvdb_id, version, polygon, centroid)
+    doc.body(name, nvdb_id, version, polygon, centroid, reducer)
+    if cache is not None:
+        cache.add(doc, geofence.get_content_hash(vegobjekt))
+    metrics.CONVERT_SECONDS.observe(time.time() - started)
 
     log.debug(u"Creating new Datex2 document: name={}, nvdb_id={}, version={}".format(
         name, nvdb_id, version))
     return doc
 
 
-def create_doc_from_db(geofence, delete=False):
+def create_doc_from_db(geofence, delete=False, cache=None, reducer=None):
     """Constructs a valid Datex2 XML doc from the geofence
     object in our database.
 
     If delete is True, then the Datex2 object will not contain any
     polygon points to indicate that the Datex2 object is deleted.
+
+    If 'cache' (a cache.DocumentCache) holds this version of the
+    geofence, its converted polygon, centroid and container are reused.
+    Otherwise the polygon is reduced by 'reducer' if given.
     """
     doc = Datex2()
 
@@ -42,32 +274,86 @@ def create_doc_from_db(geofence, delete=False):
     nvdb_id = geofence.get("id")
     version = geofence.get("version")
 
-    polygon = util.parse_polygon(geofence.get("polygon"))
-    polygon = [[float(j) for j in i] for i in polygon]
-
-    centroid = util.get_polygon_centroid(polygon)
-
-    if delete:
-        polygon = []
+    cached = None
+    if cache is not None:
+        cached = cache.get(nvdb_id, version, geofence.get("content_hash"))
+
+    if cached is None:
+        polygon = util.parse_polygon(geofence.get("polygon"))
+        centroid = util.get_polygon_centroid(polygon)
+        doc.body(name, nvdb_id, version, [] if delete else polygon, centroid, reducer)
+        if cache is not None and not delete:
+            cache.add(doc, geofence.get("content_hash"))
+    elif delete:
+        doc.add_location(name, nvdb_id, version, [], cached.centroid)
+    else:
+        doc.add_location(name, nvdb_id, version, cached.polygon, cached.centroid, cached.container)
 
-    doc.body(name, nvdb_id, version, polygon, centroid)
     log.debug(u"Creating new Datex2 document from DB: name={}, nvdb_id={}, version={}".format(
         name, nvdb_id, version))
     return doc
 
 
-def create_delete_doc_from_db(geofence):
-    return create_doc_from_db(geofence, delete=True)
+def create_delete_doc_from_db(geofence, cache=None, reducer=None):
+    return create_doc_from_db(geofence, delete=True, cache=cache, reducer=reducer)
+
+
+def merge(docs):
+    """One Datex2 document with the locations of all 'docs'"""
+    doc = Datex2()
+    for d in docs:
+        doc.locations.extend(d.locations)
+        doc.containers.extend(d.containers)
+        doc.centroids.extend(d.centroids)
+    return doc
+
+
+def batches(docs, max_locations=1, max_bytes=None):
+    """
+    Groups 'docs' in order into lists of at most 'max_locations'
+    documents, whose merged document stays within 'max_bytes' (if given).
+    A document that is larger than 'max_bytes' on its own gets its own
+    group.
+    """
+    group = []
+    size = _HEADER_SIZE
+    for doc in docs:
+        doc_size = sum(len(c) for c in doc.containers)
+        if group and (len(group) >= max_locations or
+                      (max_bytes and size + doc_size > max_bytes)):
+            yield group
+            group = []
+            size = _HEADER_SIZE
+        group.append(doc)
+        size += doc_size
+    if group:
+        yield group
 
 
 class Datex2:
     def __init__(self):
-        self._file = io.StringIO()
-
+        self.publication_time = datetime.datetime.now(get_timezone()).isoformat()
+
+        # (name, nvdb_id, version, GPS polygon), the serialized container
+        # and the GPS centroid of each location added with body()
+        self.locations = []
+        self.containers = []
+        self.centroids = []
+        self._doc = None
+
+    @property
+    def doc(self):
+        """The document as an lxml ElementTree, built on first use"""
+        if self._doc is None:
+            self._build()
+        return self._doc
+
+    def _build(self):
+        etree = get_etree()
         self.top_root = etree.Element("d2LogicalModel",
                                       attrib={"modelBaseVersion": "2"},
                                       nsmap={None: "http://datex2.eu/schema/2/2_0"})
-        self.doc = etree.ElementTree(self.top_root)
+        self._doc = etree.ElementTree(self.top_root)
 
         exchange = etree.SubElement(self.top_root, "exchange")
         supplierId = etree.SubElement(exchange, "supplierIdentification")
@@ -79,14 +365,16 @@ class Datex2:
         self.root.set(self._qname, "PredefinedLocationsPublication")
 
         self._header()
+        for location in self.locations:
+            self._locationContainer(*location)
 
     def _header(self):
         """
         Construct the standard Datex2 header
         """
+        etree = get_etree()
         pubTime = etree.SubElement(self.root, "publicationTime")
-        tz = pytz.timezone("Europe/Oslo")
-        pubTime.text = datetime.datetime.now(tz).isoformat()
+        pubTime.text = self.publication_time
 
         pubCreator = etree.SubElement(self.root, "publicationCreator")
         etree.SubElement(pubCreator, "country").text = "no"
@@ -96,24 +384,48 @@ class Datex2:
         etree.SubElement(headerInformation, "confidentiality").text = "noRestriction"
         etree.SubElement(headerInformation, "informationStatus").text = "real"
 
-    def body(self, name, nvdb_id, version, polygon, centroid):
-        # Temporary storing of polygon
-        gps_coords_poly = [util.utm_to_gps(i) for i in polygon]
-
-        # Add meta information
-        self._locationContainer(name, nvdb_id, version, gps_coords_poly)
+    def body(self, name, nvdb_id, version, polygon, centroid, reducer=None):
+        original = polygon
+        if reducer is not None and len(polygon):
+            polygon = reducer.simplify(polygon)
 
-        self.polygon = gps_coords_poly
+        # Temporary storing of polygon
+        lat, lon = util.utm_to_gps_array(polygon)
+        if reducer is not None:
+            lat, lon = reducer.quantize(lat, lon)
+        gps_coords_poly = list(zip(lat.tolist(), lon.tolist()))
 
-        log.debug("polygon: {}".format(polygon))
-        log.debug("gps coords: {}".format(gps_coords_poly))
+        # Formatted only when debug logging is on, which is costly for
+        # polygons with thousands of vertices
+        log.debug("polygon: %s", polygon)
+        log.debug("gps coords: %s", gps_coords_poly)
 
         # Calculate centroid of the polygon
         # self.centroid = geofence.get_polygon_centroid(polygon)
-        self.centroid = centroid
-        log.debug("Datex2 centroid: {}".format(self.centroid))
-        self.centroid = util.utm_to_gps(self.centroid)
+        log.debug("Datex2 centroid: {}".format(centroid))
+
+        container = render_container(name, nvdb_id, version, gps_coords_poly)
+        if reducer is not None and len(original):
+            reducer.record(nvdb_id, original, container, gps_coords_poly)
+        self.add_location(name, nvdb_id, version, gps_coords_poly, util.utm_to_gps(centroid), container)
+
+    def add_location(self, name, nvdb_id, version, polygon, centroid, container=None):
+        """
+        Adds a location with a polygon and centroid that are already in GPS
+        coordinates, and optionally its serialized container.
+        """
+        if container is None:
+            container = render_container(name, nvdb_id, version, polygon)
+
+        # Add meta information
+        self.locations.append((name, nvdb_id, version, polygon))
+        self.containers.append(container)
+        self.centroids.append(centroid)
+        if self._doc is not None:
+            self._locationContainer(name, nvdb_id, version, polygon)
 
+        self.polygon = polygon
+        self.centroid = centroid
         self.name = name
         self.nvdb_id = nvdb_id
         self.version = version
@@ -122,6 +434,7 @@ class Datex2:
         """
         Adds the <predefinedLocationContainer> XML tag block
         """
+        etree = get_etree()
         predefinedLocationCont = etree.SubElement(self.root, "predefinedLocationContainer",
                                                   attrib={
                                                       "id": unicode(nvdb_id),
@@ -139,6 +452,7 @@ class Datex2:
         Constructs the polygon XML definitions based on the geofence Polygon
         coordinates from NVDB.
         """
+        etree = get_etree()
         loc = etree.SubElement(parent, "location")
         loc.set(self._qname, "Area")
 
@@ -158,5 +472,32 @@ class Datex2:
             lon = etree.SubElement(coord, "longitude")
             lon.text = str(p[1])
 
+    @property
+    def bbox(self):
+        """(min_lat, min_lon, max_lat, max_lon) of all polygons and centroids"""
+        points = list(self.centroids)
+        for location in self.locations:
+            points.extend(location[3])
+        lats = [p[0] for p in points]
+        lons = [p[1] for p in points]
+        return (min(lats), min(lons), max(lats), max(lons))
+
+    @property
+    def position(self):
+        """
+        The (lat, lon) that represents the document on the AMQP message:
+        the centroid of a single location, or the center of the bounding
+        box for a batch.
+        """
+        if len(self.locations) == 1:
+            return self.centroid
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return ((min_lat + max_lat) / 2.0, (min_lon + max_lon) / 2.0)
+
+    def to_bytes(self):
+        """The serialized document, byte for byte what lxml pretty prints for 'doc'"""
+        head = _HEAD.format(_escape(self.publication_time).decode("ascii")).encode("ascii")
+        return b"".join([head] + self.containers + [_TAIL])
+
     def __str__(self):
-        return etree.tostring(self.doc, pretty_print=True)
+        return self.to_bytes()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import logging
+import geofence
+
+log = logging.getLogger("geofencebroker")
+
+# The outcome of comparing a listing from NVDB with our database:
+#  added    - 'vegobjekt' dicts not in the database
+#  modified - 'vegobjekt' dicts with a newer 'sist_modifisert' and
+#             another content hash than stored
+#  touched  - 'vegobjekt' dicts with a newer 'sist_modifisert', but the
+#             same name, version and polygon. These only need storing.
+#  deleted  - IDs in the database that are no longer in NVDB
+#  seen     - set of all IDs in the listing
+#  newest   - the highest 'sist_modifisert' in the listing (or None)
+ChangeSet = namedtuple("ChangeSet", ["added", "modified", "touched", "deleted", "seen", "newest"])
+
+
+def compute(fences, known):
+    """Sorts the 'vegobjekt' dicts from 'fences' into added, modified and
+    touched geofences by comparing against 'known', the
+    {id: (sist_modifisert, content_hash)} dict from storage.versions().
+
+    'fences' is consumed once, and only changed geofences are kept.
+    Timestamps are compared as strings, which is safe since NVDB formats
+    them as 'YYYY-MM-DD HH:MM:SS'. The content hash is only computed for
+    geofences with a newer timestamp.
+
+    The 'deleted' list is left empty, see with_deleted().
+    """
+    added = []
+    modified = []
+    touched = []
+    seen = set()
+    newest = None
+
+    for fence in fences:
+        nvdb_id = int(fence.get("id", 0))
+        seen.add(nvdb_id)
+
+        next_date = fence["metadata"]["sist_modifisert"]
+        if newest is None or next_date > newest:
+            newest = next_date
+
+        if nvdb_id not in known:
+            added.append(fence)
+            continue
+
+        prev_date, prev_hash = known[nvdb_id]
+        if next_date > prev_date:
+            if prev_hash is None or geofence.get_content_hash(fence) != prev_hash:
+                modified.append(fence)
+            else:
+                touched.append(fence)
+        elif next_date < prev_date:
+            log.warn("next_date < prev_data: (%s < %s)" % (next_date, prev_date))
+            log.warn("Most likely a bug!!")
+
+    return ChangeSet(added, modified, touched, [], seen, newest)
+
+
+def with_deleted(changes, known, listed_ids):
+    """Returns 'changes' with 'deleted' set to every known geofence ID
+    missing from 'listed_ids', the complete set of IDs in NVDB.
+    """
+    deleted = sorted(set(known).difference(listed_ids))
+    return changes._replace(deleted=deleted)
@@ -1,48 +1,287 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import hashlib
+import random
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, Timeout
 from util import parse_timestamp, datetime_to_unix_epoch
 import logging
-import six
+import threading
+import numpy as np
 import util
+import geometry
+import metrics
 
+NVDB_URL = "https://www.vegvesen.no/nvdb/api/v2/vegobjekter/911"
+NVDB_PARAMS = {"inkluder": "lokasjon,egenskaper,metadata"}
+NVDB_ID_PARAMS = {"inkluder": "minimum"}
 
-def fetch_objects():
-    log = logging.getLogger("geofencebroker")
-    try:
-        url = "https://www.vegvesen.no/nvdb/api/v2/vegobjekter/911?inkluder=lokasjon,egenskaper,metadata"
-        req = requests.get(url, timeout=2.0)
-
-        if not req.ok:
-            log.warn("Unable to retrieve NVDB goefence objects")
-            return None
-        return req.json()
-    except (ConnectionError, Timeout) as ce:
-        log.error(ce)
+# Responses worth retrying: rate limiting and server side trouble
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class FetchError(Exception):
+    """Raised when a page of geofence objects could not be retrieved from NVDB.
+
+    The listing is incomplete when this is raised, so callers must not treat
+    the objects seen so far as the full set of geofences.
+    """
+
+
+class NotModified(Exception):
+    """Raised when NVDB answers a conditional request with 304 Not Modified"""
+
+
+class _PageRequest(threading.Thread):
+    """Fetches one NVDB result page in the background."""
+
+    def __init__(self, fetch, url, params=None, headers=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fetch = fetch
+        self.url = url
+        self.params = params
+        self.headers = headers
+        self._response = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._response = self.fetch(self.url, self.params, self.headers)
+        except (FetchError, NotModified) as e:
+            self._error = e
+        except Exception as e:
+            # Anything else would die with this thread, and leave the
+            # consumer of the page without a response
+            self._error = FetchError("Unable to retrieve NVDB geofence objects from {}: {!r}".format(
+                self.url, e))
+
+    def result(self):
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+
+def _next_url(page):
+    """URL of the page after 'page', or None if 'page' was the last one"""
+    metadata = page.get("metadata", {})
+    if metadata.get("returnert", 0) == 0:
         return None
+    return metadata.get("neste", {}).get("href")
 
 
-def get_polygon(vegobjekt):
+class NvdbClient(object):
     """
-    Input is a "vegobjekt" dictionary from NVDB. Then we'll
-    extract the POLYGON datatype and convert it a 2-dimensional
-    list of UTM coordinates.
+    Reusable client for the NVDB API. Keeps a pool of keep-alive
+    connections and retries failed requests with jittered exponential
+    backoff.
+    """
+
+    def __init__(self, url=NVDB_URL, connect_timeout=3.05, read_timeout=30.0,
+                 retries=3, backoff=0.5, max_backoff=30.0, pool_size=4):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.log = logging.getLogger("geofencebroker")
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/vnd.vegvesen.nvdb-v2+json",
+            "Accept-Encoding": "gzip, deflate"
+        })
+
+        # ETag / Last-Modified of the first page of each listing, by URL
+        self._validators = {}
+
+    def _get(self, url, params=None, headers=None):
+        """GET 'url' and return the (JSON decoded page, response) tuple.
+
+        Retries connection errors, timeouts and 429/5xx responses up to
+        'retries' times. Raises NotModified on 304 and FetchError when
+        the retries are spent.
+        """
+        attempt = 0
+        while True:
+            try:
+                with metrics.FETCH_SECONDS.time():
+                    resp = self.session.get(url, params=params, headers=headers,
+                                            timeout=self.timeout)
+                metrics.FETCH_BYTES.inc(len(resp.content))
+                if resp.status_code == 304:
+                    raise NotModified(resp.url)
+                if resp.ok:
+                    return resp.json(), resp
+                error = FetchError("Unable to retrieve NVDB geofence objects: HTTP {} from {}".format(
+                    resp.status_code, resp.url))
+                if resp.status_code not in RETRY_STATUS:
+                    metrics.FETCH_ERRORS.inc()
+                    raise error
+            except (ConnectionError, Timeout) as e:
+                error = FetchError(e)
+            except ValueError as e:
+                metrics.FETCH_ERRORS.inc()
+                raise FetchError("Invalid JSON from NVDB: {}".format(e))
+
+            metrics.FETCH_ERRORS.inc()
+            if attempt >= self.retries:
+                raise error
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            attempt += 1
+            self.log.warn("{}. Retry {}/{} in {:.1f} seconds".format(
+                error, attempt, self.retries, delay))
+            time.sleep(delay)
+
+    def pages(self, params=NVDB_PARAMS, conditional=False):
+        """Yields each result page by following the 'metadata.neste'
+        cursor. The next page is requested while the current one is
+        processed.
+
+        With 'conditional', the first page is requested with the ETag and
+        Last-Modified from the previous complete walk of the same listing,
+        and NotModified is raised if NVDB reports it unchanged.
+
+        Raises FetchError if any page could not be retrieved.
+        """
+        key = requests.Request("GET", self.url, params=params).prepare().url
+        headers = {}
+        etag, last_modified = self._validators.get(key, (None, None))
+        if conditional and etag:
+            headers["If-None-Match"] = etag
+        if conditional and last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        pending = _PageRequest(self._get, self.url, params, headers)
+        validators = None
+        while pending is not None:
+            page, resp = pending.result()
+            if validators is None:
+                validators = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+            next_url = _next_url(page)
+            # The 'neste' href carries all query parameters
+            pending = _PageRequest(self._get, next_url) if next_url else None
+            yield page
+
+        # Only remember the validators once the whole listing went through,
+        # otherwise a failed walk would be skipped as unchanged next time.
+        self._validators[key] = validators
+
+    def objects(self, changed_since=None):
+        """Yields every geofence 'vegobjekt' from NVDB, page by page.
+
+        If 'changed_since' (a 'sist_modifisert' timestamp) is given, only objects
+        modified after that time are listed. The query overlaps by one second
+        since NVDB timestamps have second resolution, so the caller will see
+        some unchanged objects again.
+
+        Such a delta listing is requested conditionally: as long as nothing
+        has changed its URL and content stay the same, so NotModified is
+        raised instead of downloading it again. A full listing is never
+        conditional, since a change may only show up on a later page.
+
+        Raises FetchError if the listing could not be completed.
+        """
+        params = NVDB_PARAMS
+        if changed_since:
+            since = parse_timestamp(changed_since) - datetime.timedelta(seconds=1)
+            params = dict(params, endret_etter=since.isoformat())
+
+        for page in self.pages(params, conditional=bool(changed_since)):
+            objects = page.get("objekter", [])
+            self.log.debug("Fetched page of {} geofence objects from NVDB".format(len(objects)))
+            for vegobjekt in objects:
+                yield vegobjekt
+
+    def ids(self):
+        """Yields the ID of every geofence in NVDB. This is a much lighter
+        listing than objects(), used to detect deleted geofences.
+
+        Raises FetchError if the listing could not be completed.
+        """
+        for page in self.pages(NVDB_ID_PARAMS):
+            for vegobjekt in page.get("objekter", []):
+                yield int(vegobjekt["id"])
+
+    def close(self):
+        self.session.close()
+
+    def __repr__(self):
+        return "<{} url={}, timeout={}, retries={}>".format(
+            self.__class__.__name__, self.url, self.timeout, self.retries)
+
+
+_client = None
+
+
+def _default_client():
+    global _client
+    if _client is None:
+        _client = NvdbClient()
+    return _client
+
+
+def fetch_objects(changed_since=None, client=None):
+    """Yields every geofence 'vegobjekt' from NVDB. See NvdbClient.objects()"""
+    return (client or _default_client()).objects(changed_since)
+
+
+def fetch_ids(client=None):
+    """Yields the ID of every geofence in NVDB. See NvdbClient.ids()"""
+    return (client or _default_client()).ids()
+
+
+# Parsed geometries by (id, sist_modifisert), see get_geometry()
+_geometries = {}
+
+
+def clear_geometry_cache():
+    """Forgets all parsed geometries. Called at the start of each cycle."""
+    _geometries.clear()
+
+
+def get_geometry(vegobjekt):
+    """
+    Input is a "vegobjekt" dictionary from NVDB. Returns its POLYGON
+    parsed with geometry.parse_wkt(), or None if it has none.
+
+    The result is kept per object version, so the conversion, storage
+    and hashing of a changed geofence share one parse.
     """
     log = logging.getLogger("geofencebroker")
+    key = (vegobjekt.get("id"), vegobjekt.get("metadata", {}).get("sist_modifisert"))
+    if key in _geometries:
+        return _geometries[key]
+
     tmp = [x for x in vegobjekt["egenskaper"] if x["datatype"] == 19]
     if not tmp:
         log.error("Unable to get POLYGON from vegobjekt!\n\tvegobjekt['egenskaper'] = {}".format(
             vegobjekt["egenskaper"]))
-        return []
-
-    # tmp = tmp[0]
-    # polygon = tmp["verdi"].replace("POLYGON ((", "").replace("))", "")
-    # polygon = [x.strip().split(" ") for x in polygon.split(",")]
+        return None
 
-    # return polygon
     nvdb_polygon = tmp[0]['verdi']
-    return util.parse_polygon(nvdb_polygon)
+    _geometries[key] = geometry.parse_wkt(nvdb_polygon)
+    return _geometries[key]
+
+
+def get_polygon(vegobjekt):
+    """
+    Input is a "vegobjekt" dictionary from NVDB. Then we'll
+    extract the POLYGON datatype and convert it to an N×2
+    array of UTM coordinates (the shell of the polygon).
+    """
+    parsed = get_geometry(vegobjekt)
+    if parsed is None:
+        return []
+    return geometry.exterior(parsed)
 
 
 def get_name(vegobjekt):
@@ -70,49 +309,28 @@ def get_version(vegobjekt):
     return int(version['verdi'])
 
 
-def get_polygon_centroid(polygon_input):
+def content_hash(name, version, parsed):
     """
-    ref https://stackoverflow.com/questions/2792443/finding-the-centroid-of-a-polygon    
+    Stable SHA-1 hex digest of a geofence's name, version and polygon
+    (a geometry.Geometry). Coordinates are rounded to millimeters, so
+    float noise in the WKT from NVDB doesn't count as a change.
     """
-    log = logging.getLogger("geofencebroker")
+    digest = hashlib.sha1(u"{}\0{}\0".format(name, version).encode("utf-8"))
+    # Adding 0.0 turns -0.0 into 0.0, which has other bytes
+    digest.update((np.round(parsed.coords, 3) + 0.0).astype("<f8").tobytes())
+    digest.update(np.asarray(parsed.rings, dtype="<i8").tobytes())
+    digest.update(np.asarray(parsed.polygons, dtype="<i8").tobytes())
+    return digest.hexdigest()
+
 
+def get_content_hash(vegobjekt):
+    """content_hash() of the 'vegobjekt', or None if it has no polygon"""
+    parsed = get_geometry(vegobjekt)
+    if parsed is None:
+        return None
+    return content_hash(get_name(vegobjekt), get_version(vegobjekt), parsed)
 
-    # Convert the 2D list of string UTM coordinates
-    # to proper float numbers. Need for the calculation
-    # of the polygon centroid.
-    polygon = polygon_input
-    if isinstance(polygon_input[0][0], six.string_types):
-        polygon = [[float(i) for i in p] for p in polygon_input]
-
-    centroid = [0.0, 0.0]
-    signed_area = 0.0
-    a = 0.0
-    p_length = len(polygon) - 1
-
-    for i in range(p_length):
-        x0, y0 = polygon[i][0], polygon[i][1]
-        x1, y1 = polygon[i + 1][0], polygon[i + 1][1]
-
-        a = x0 * y1 - x1 * y0
-        signed_area += a
-        centroid[0] += (x0 + x1) * a
-        centroid[1] += (y0 + y1) * a
-
-    x0, y0 = polygon[p_length][0], polygon[p_length][1]
-    x1, y1 = polygon[0][0], polygon[0][1]
-    a = x0 * y1 - x1 * y0
-    signed_area += a
-    centroid[0] += (x0 + x1) * a
-    centroid[1] += (y0 + y1) * a
-
-    signed_area *= 0.5
-
-    try:
-        centroid[0] /= (6.0 * signed_area)
-        centroid[1] /= (6.0 * signed_area)
-    except ZeroDivisionError:
-        log.exception()
-        raise
-    else:
-        return tuple(centroid)
 
+def get_polygon_centroid(polygon_input):
+    """Same as util.get_polygon_centroid()"""
+    return util.get_polygon_centroid(polygon_input)
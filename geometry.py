@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import re
+import numpy as np
+import six
+
+# area     - signed area, positive for counter-clockwise polygons
+# centroid - (x, y) tuple
+# bbox     - (min_x, min_y, max_x, max_y) tuple
+PolygonStats = namedtuple("PolygonStats", ["area", "centroid", "bbox"])
+
+# A parsed POLYGON or MULTIPOLYGON:
+# coords   - N×2 float64 array with the vertices of all rings
+# rings    - offsets into 'coords' where each ring starts, followed by N
+# polygons - offsets into 'rings' where each polygon starts, followed by
+#            the number of rings. The first ring of a polygon is its shell,
+#            the rest are holes.
+Geometry = namedtuple("Geometry", ["coords", "rings", "polygons"])
+
+_WKT_HEADER = re.compile(r"\s*(MULTIPOLYGON|POLYGON)\s*(ZM|Z|M)?\s*", re.IGNORECASE)
+_WKT_RING = re.compile(r"\(([^()]*)\)")
+
+
+def as_coordinates(polygon):
+    """The polygon as an N×2 float64 array. Also accepts the string
+    coordinates of the old util.parse_polygon().
+    """
+    return np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+
+
+def polygon_stats(polygon):
+    """
+    Signed area, centroid and bounding box of 'polygon' (N×2, closed or
+    not) with the shoelace formula.
+    ref https://stackoverflow.com/questions/2792443/finding-the-centroid-of-a-polygon
+
+    Coordinates are taken relative to the first vertex, which keeps the
+    products small for large UTM values. A polygon without area gets the
+    mean of its vertices as centroid, and an empty one gets NaNs.
+    """
+    area, centroid, bbox = polygon_stats_many([polygon])
+    return PolygonStats(float(area[0]), tuple(centroid[0].tolist()), tuple(bbox[0].tolist()))
+
+
+def polygon_stats_many(polygons):
+    """
+    polygon_stats() for a list of polygons in one pass over all their
+    vertices. Returns the arrays (area, centroid, bbox), with shapes
+    (M,), (M, 2) and (M, 4) for M polygons.
+    """
+    polygons = [as_coordinates(p) for p in polygons]
+    count = len(polygons)
+    lengths = np.array([len(p) for p in polygons], dtype=np.intp)
+
+    area = np.zeros(count)
+    centroid = np.full((count, 2), np.nan)
+    bbox = np.full((count, 4), np.nan)
+
+    nonempty = np.flatnonzero(lengths)
+    if not len(nonempty):
+        return area, centroid, bbox
+
+    coords = np.concatenate([polygons[i] for i in nonempty])
+    lengths = lengths[nonempty]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    # Each vertex is paired with the next one in its own polygon, the
+    # last vertex with the first
+    following = np.arange(1, len(coords) + 1)
+    following[starts + lengths - 1] = starts
+
+    origin = np.repeat(coords[starts], lengths, axis=0)
+    x0, y0 = (coords - origin).T
+    x1, y1 = (coords[following] - origin).T
+
+    a = x0 * y1 - x1 * y0
+    signed_area = np.add.reduceat(a, starts) * 0.5
+    cx = np.add.reduceat((x0 + x1) * a, starts)
+    cy = np.add.reduceat((y0 + y1) * a, starts)
+
+    degenerate = signed_area == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cx = np.where(degenerate, 0.0, cx / (6.0 * signed_area))
+        cy = np.where(degenerate, 0.0, cy / (6.0 * signed_area))
+
+    mean = np.add.reduceat(coords - origin, starts) / lengths[:, np.newaxis]
+    cx = np.where(degenerate, mean[:, 0], cx) + coords[starts, 0]
+    cy = np.where(degenerate, mean[:, 1], cy) + coords[starts, 1]
+
+    area[nonempty] = signed_area
+    centroid[nonempty] = np.column_stack((cx, cy))
+    bbox[nonempty] = np.column_stack((np.minimum.reduceat(coords, starts),
+                                      np.maximum.reduceat(coords, starts)))
+    return area, centroid, bbox
+
+
+def parse_wkt(wkt):
+    """
+    Parses a WKT POLYGON or MULTIPOLYGON, with or without holes, into a
+    Geometry. Z and M values are dropped.
+
+    From: POLYGON ((261406.25545925 6649329.53490491, 261418.543820197 6649292.41831282))
+    To: Geometry(coords=array([[261406.25545925, 6649329.53490491],
+                               [261418.543820197, 6649292.41831282]]),
+                 rings=[0, 2], polygons=[0, 1])
+    """
+    if not isinstance(wkt, six.string_types):
+        raise ValueError("Invalid input argument: expected string, got {}".format(type(wkt)))
+
+    header = _WKT_HEADER.match(wkt)
+    if not header:
+        raise ValueError("Not a WKT POLYGON or MULTIPOLYGON: {}".format(wkt[:40]))
+
+    values = []
+    rings = [0]
+    polygons = [0]
+    dimension = None
+    previous_end = header.end()
+    for ring in _WKT_RING.finditer(wkt, header.end()):
+        if dimension is None:
+            dimension = len(ring.group(1).split(",", 1)[0].split())
+        # Polygons in a MULTIPOLYGON are separated by '), (',
+        # rings within a polygon only by ','
+        if len(rings) > 1 and ")" in wkt[previous_end:ring.start()]:
+            polygons.append(len(rings) - 1)
+        values.extend(ring.group(1).replace(",", " ").split())
+        rings.append(len(values) // dimension)
+        previous_end = ring.end()
+
+    polygons.append(len(rings) - 1)
+    if len(rings) == 1:
+        # POLYGON EMPTY
+        return Geometry(np.empty((0, 2)), np.array([0]), np.array([0]))
+
+    try:
+        coords = np.array(values, dtype=np.float64).reshape(-1, dimension)[:, :2]
+    except ValueError:
+        raise ValueError("Invalid coordinates in WKT: {}".format(wkt[:40]))
+    return Geometry(np.ascontiguousarray(coords), np.array(rings), np.array(polygons))
+
+
+def exterior(geometry, index=0):
+    """The shell of polygon number 'index' in 'geometry' as an N×2 array"""
+    if len(geometry.polygons) < index + 2:
+        return np.empty((0, 2))
+    ring = geometry.polygons[index]
+    return geometry.coords[geometry.rings[ring]:geometry.rings[ring + 1]]
+
+
+def _segment_distances(points, start, end):
+    """Distance from each of 'points' (N×2) to the segment 'start'-'end'"""
+    direction = end - start
+    length2 = direction.dot(direction)
+    if length2 == 0:
+        return np.hypot(*(points - start).T)
+    t = np.clip((points - start).dot(direction) / length2, 0.0, 1.0)
+    return np.hypot(*(points - (start + t[:, np.newaxis] * direction)).T)
+
+
+def _douglas_peucker(coords, tolerance):
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[0] = keep[-1] = True
+    if np.array_equal(coords[0], coords[-1]):
+        # A closed ring has no segment to measure against, so split it
+        # at the vertex farthest from its start
+        split = int(np.argmax(((coords - coords[0]) ** 2).sum(axis=1)))
+        keep[split] = True
+        stack = [(0, split), (split, len(coords) - 1)]
+    else:
+        stack = [(0, len(coords) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        distances = _segment_distances(coords[start + 1:end], coords[start], coords[end])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return coords[keep]
+
+
+def is_simple(ring, chunk_size=256):
+    """
+    True if no two non-adjacent edges of the closed 'ring' cross. Edges
+    that only touch are not detected.
+    """
+    coords = as_coordinates(ring)
+    if len(coords) and not np.array_equal(coords[0], coords[-1]):
+        coords = np.vstack((coords, coords[:1]))
+    a = coords[:-1]
+    b = coords[1:]
+    count = len(a)
+
+    def orientation(p, q, r):
+        return ((q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) -
+                (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0]))
+
+    j = np.arange(count)
+    for offset in range(0, count, chunk_size):
+        i = np.arange(offset, min(offset + chunk_size, count))[:, np.newaxis]
+        ai = a[i[:, 0]][:, np.newaxis]
+        bi = b[i[:, 0]][:, np.newaxis]
+        crossing = ((orientation(ai, bi, a) * orientation(ai, bi, b) < 0) &
+                    (orientation(a, b, ai) * orientation(a, b, bi) < 0))
+        # Each pair once, skipping neighbours (the first and last edge
+        # share a vertex too)
+        crossing &= (j > i + 1) & ~((i == 0) & (j == count - 1))
+        if crossing.any():
+            return False
+    return True
+
+
+def simplify(ring, tolerance, attempts=3):
+    """
+    Douglas-Peucker simplification of 'ring' (N×2), keeping every vertex
+    further than 'tolerance' (in the units of the coordinates, meters for
+    UTM) from the simplified outline.
+
+    If the result has crossing edges, the tolerance is halved up to
+    'attempts' times before giving up and returning 'ring' unchanged. A
+    ring is never reduced below a triangle.
+    """
+    coords = as_coordinates(ring)
+    if not tolerance or tolerance <= 0 or len(coords) <= 4:
+        return coords
+    for attempt in range(attempts):
+        result = _douglas_peucker(coords, tolerance / 2.0 ** attempt)
+        if len(result) >= 4 and is_simple(result):
+            return result
+    return coords
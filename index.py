@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import threading
+import numpy as np
+import six
+import geofence
+import geometry
+import util
+
+log = logging.getLogger("geofencebroker")
+
+
+def _fence(parsed):
+    """
+    The (bbox, edges) of a parsed UTM geometry in GPS coordinates: bbox is
+    (min_lon, min_lat, max_lon, max_lat) and edges an E×4 array of
+    (lon0, lat0, lon1, lat1), covering every ring so holes and
+    multipolygons work with the even-odd rule.
+    """
+    lat, lon = util.utm_to_gps_array(parsed.coords)
+    rings = np.asarray(parsed.rings)
+    starts = rings[:-1]
+    ends = rings[1:]
+    # Each vertex is joined to the next one in its ring, the last to
+    # the first. Closed rings get a zero length edge, which never counts.
+    following = np.arange(1, len(lat) + 1)
+    following[ends - 1] = starts
+    edges = np.column_stack((lon, lat, lon[following], lat[following]))
+    bbox = (lon.min(), lat.min(), lon.max(), lat.max())
+    return bbox, edges
+
+
+def _str_order(bboxes, node_size):
+    """
+    Sort-Tile-Recursive order of 'bboxes' (N×4): sorted into vertical
+    slabs by center x, and by center y within each slab, so that every
+    'node_size' consecutive boxes are close together.
+    """
+    count = len(bboxes)
+    if count <= node_size:
+        return np.arange(count)
+    cx = bboxes[:, 0] + bboxes[:, 2]
+    cy = bboxes[:, 1] + bboxes[:, 3]
+    nodes = int(math.ceil(count / float(node_size)))
+    slab_size = node_size * int(math.ceil(math.sqrt(nodes)))
+    by_x = np.argsort(cx, kind="mergesort")
+    slab = np.empty(count, dtype=np.intp)
+    slab[by_x] = np.arange(count) // slab_size
+    return np.lexsort((cy, slab))
+
+
+def _group_bboxes(bboxes, node_size):
+    """The bounding box of every 'node_size' consecutive boxes"""
+    starts = np.arange(0, len(bboxes), node_size)
+    return np.column_stack((np.minimum.reduceat(bboxes[:, 0], starts),
+                            np.minimum.reduceat(bboxes[:, 1], starts),
+                            np.maximum.reduceat(bboxes[:, 2], starts),
+                            np.maximum.reduceat(bboxes[:, 3], starts)))
+
+
+def _in_bbox(bboxes, lon, lat):
+    return ((bboxes[:, 0] <= lon) & (lon <= bboxes[:, 2]) &
+            (bboxes[:, 1] <= lat) & (lat <= bboxes[:, 3]))
+
+
+def points_in_polygon(lon, lat, edges, chunk_size=1000000):
+    """
+    Even-odd test of the points 'lon', 'lat' against the polygon 'edges'
+    (see _fence()). Returns a boolean array.
+    """
+    inside = np.zeros(len(lon), dtype=bool)
+    if not len(edges):
+        return inside
+    x0, y0, x1, y1 = edges.T
+    step = max(1, chunk_size // len(edges))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(0, len(lon), step):
+            px = lon[i:i + step, np.newaxis]
+            py = lat[i:i + step, np.newaxis]
+            spans = (y0 > py) != (y1 > py)
+            x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            inside[i:i + step] = (spans & (px < x)).sum(axis=1) % 2 == 1
+    return inside
+
+
+class GeofenceIndex(object):
+    """
+    Answers which geofences contain a position, for many positions at
+    once. Geofences are kept in GPS coordinates.
+
+    The bounding boxes are packed into an R-tree with the Sort-Tile-
+    Recursive algorithm, with 'node_size' children per node. Geofences
+    added, updated or deleted afterwards are kept aside and searched
+    linearly until they make up more than 'rebuild_ratio' of the index,
+    when the tree is packed again.
+    """
+
+    def __init__(self, node_size=16, rebuild_ratio=0.1, min_rebuild=64):
+        self.node_size = node_size
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild = min_rebuild
+        # nvdb_id -> (bbox, edges)
+        self._fences = {}
+        # The packed tree: the IDs in leaf order, and the bounding boxes
+        # of each level from the leaves up to the root
+        self._tree_ids = np.empty(0, dtype=np.int64)
+        self._levels = []
+        # IDs in the tree whose entry is out of date, and IDs to search
+        # outside the tree
+        self._stale = set()
+        self._pending = set()
+        self._pending_ids = None
+        self._pending_bboxes = None
+        self._lock = threading.RLock()
+
+    def load(self, rows):
+        """Replaces the index with the (nvdb_id, polygon WKT) 'rows', see
+        storage.polygons()
+        """
+        fences = {}
+        for nvdb_id, wkt in rows:
+            try:
+                parsed = geometry.parse_wkt(wkt)
+            except ValueError as e:
+                log.warn("Unable to index geofence {}: {}".format(nvdb_id, e))
+                continue
+            if len(parsed.coords):
+                fences[int(nvdb_id)] = _fence(parsed)
+        with self._lock:
+            self._fences = fences
+            self.build()
+        log.debug("Indexed {} geofences".format(len(fences)))
+
+    def build(self):
+        """Packs every geofence into the tree"""
+        with self._lock:
+            ids = np.array(sorted(self._fences), dtype=np.int64)
+            bboxes = np.array([self._fences[i][0] for i in ids], dtype=np.float64).reshape(-1, 4)
+            order = _str_order(bboxes, self.node_size)
+            self._tree_ids = ids[order]
+            self._levels = [bboxes[order]]
+            while len(self._levels[-1]) > self.node_size:
+                self._levels.append(_group_bboxes(self._levels[-1], self.node_size))
+            self._stale = set()
+            self._pending = set()
+            self._pending_ids = None
+
+    def add(self, nvdb_id, polygon):
+        """Adds or replaces a geofence from its UTM polygon, given as WKT
+        or a geometry.Geometry
+        """
+        if isinstance(polygon, six.string_types):
+            polygon = geometry.parse_wkt(polygon)
+        if not len(polygon.coords):
+            self.delete(nvdb_id)
+            return
+        nvdb_id = int(nvdb_id)
+        fence = _fence(polygon)
+        with self._lock:
+            self._fences[nvdb_id] = fence
+            self._stale.add(nvdb_id)
+            self._pending.add(nvdb_id)
+            self._changed()
+
+    def delete(self, nvdb_id):
+        nvdb_id = int(nvdb_id)
+        with self._lock:
+            if self._fences.pop(nvdb_id, None) is not None:
+                self._stale.add(nvdb_id)
+                self._pending.discard(nvdb_id)
+                self._changed()
+
+    def apply(self, added=(), modified=(), deleted=()):
+        """Applies the same changes as storage.write()"""
+        for vegobjekt in list(added) + list(modified):
+            parsed = geofence.get_geometry(vegobjekt)
+            if parsed is not None:
+                self.add(vegobjekt["id"], parsed)
+        for nvdb_id in deleted:
+            self.delete(nvdb_id)
+
+    def _changed(self):
+        self._pending_ids = None
+        if len(self._stale) > max(self.min_rebuild, self.rebuild_ratio * len(self._fences)):
+            self.build()
+
+    def _candidates(self, lon, lat):
+        """(point, nvdb_id) arrays of the positions inside a bounding box"""
+        points = []
+        ids = []
+
+        if self._levels:
+            # Walk down the tree for all points at once, keeping the
+            # (point, node) pairs whose box holds the point
+            top = self._levels[-1]
+            point = np.repeat(np.arange(len(lon)), len(top))
+            node = np.tile(np.arange(len(top)), len(lon))
+            keep = _in_bbox(top[node], lon[point], lat[point])
+            point, node = point[keep], node[keep]
+            for level in reversed(self._levels[:-1]):
+                point = np.repeat(point, self.node_size)
+                node = (np.repeat(node * self.node_size, self.node_size) +
+                        np.tile(np.arange(self.node_size), len(node)))
+                keep = node < len(level)
+                point, node = point[keep], node[keep]
+                keep = _in_bbox(level[node], lon[point], lat[point])
+                point, node = point[keep], node[keep]
+            found = self._tree_ids[node]
+            if self._stale:
+                keep = ~np.in1d(found, list(self._stale))
+                point, found = point[keep], found[keep]
+            points.append(point)
+            ids.append(found)
+
+        if self._pending:
+            if self._pending_ids is None:
+                self._pending_ids = np.array(sorted(self._pending), dtype=np.int64)
+                self._pending_bboxes = np.array([self._fences[i][0] for i in self._pending_ids])
+            point = np.repeat(np.arange(len(lon)), len(self._pending_ids))
+            node = np.tile(np.arange(len(self._pending_ids)), len(lon))
+            keep = _in_bbox(self._pending_bboxes[node], lon[point], lat[point])
+            points.append(point[keep])
+            ids.append(self._pending_ids[node[keep]])
+
+        if not points:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.int64)
+        return np.concatenate(points), np.concatenate(ids)
+
+    def query(self, lat, lon, chunk_size=2000000):
+        """
+        Matches the positions 'lat', 'lon' (arrays of equal length)
+        against every geofence. Returns the (point, nvdb_id) arrays of
+        each hit, where 'point' indexes into 'lat' and 'lon', sorted by
+        point and ID.
+
+        All candidates are tested at once, with one row for each edge of
+        each (point, geofence) pair, in chunks of about 'chunk_size' rows.
+        """
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        lon = np.asarray(lon, dtype=np.float64).ravel()
+        with self._lock:
+            point, ids = self._candidates(lon, lat)
+            if not len(ids):
+                return point, ids
+            fences, fence = np.unique(ids, return_inverse=True)
+            edges = [self._fences[i][1] for i in fences]
+
+        counts = np.array([len(e) for e in edges], dtype=np.intp)
+        offsets = np.cumsum(counts) - counts
+        x0, y0, x1, y1 = np.concatenate(edges).T
+
+        inside = np.zeros(len(ids), dtype=bool)
+        pair_counts = counts[fence]
+        pair_ends = np.cumsum(pair_counts)
+        start = 0
+        while start < len(ids):
+            # The pairs [start, end) make up at most 'chunk_size' rows
+            end = max(start + 1, np.searchsorted(pair_ends, pair_ends[start] - pair_counts[start] + chunk_size,
+                                                 side="right"))
+            rows = pair_counts[start:end]
+            row_starts = np.cumsum(rows) - rows
+            pair = np.repeat(np.arange(start, end), rows)
+            edge = (np.arange(rows.sum()) - np.repeat(row_starts, rows) +
+                    np.repeat(offsets[fence[start:end]], rows))
+            px = lon[point[pair]]
+            py = lat[point[pair]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                spans = (y0[edge] > py) != (y1[edge] > py)
+                x = x0[edge] + (py - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+                crossings = np.add.reduceat(spans & (px < x), row_starts)
+            inside[start:end] = crossings % 2 == 1
+            start = end
+
+        hit_points = point[inside]
+        hit_ids = ids[inside]
+        order = np.lexsort((hit_ids, hit_points))
+        return hit_points[order], hit_ids[order]
+
+    def contains(self, lat, lon):
+        """The IDs of the geofences containing the position"""
+        return self.query([lat], [lon])[1].tolist()
+
+    def __len__(self):
+        return len(self._fences)
+
+    def __repr__(self):
+        return "<{} fences={}, levels={}, pending={}, stale={}>".format(
+            self.__class__.__name__, len(self._fences), len(self._levels),
+            len(self._pending), len(self._stale))
@@ -1,26 +1,69 @@
 # -*- coding: utf-8 -*-
 
-import sys
 import logging
 import datetime
-import pytz
+import random
+import threading
+import time
+from collections import namedtuple, OrderedDict
+import datex2
+import metrics
+from transport import Message, MessagingError, Empty, QpidTransport
 
-try:
-    from qpid.messaging import Connection, Message, MessagingError, Empty, ConnectionError
-except ImportError as ie:
-    logging.exception("Unable to find 'qpid' module. Do you have it in sys.path / PYTHONPATH?")
-    sys.exit(1)
+# The outcome of NordicWayIC.send_objs():
+#  delivered - 'datex2' objects the broker has confirmed
+#  failed    - 'datex2' objects that were rejected or never confirmed
+# NordicWayIC.results() returns the same, with the context each object
+# was submitted with instead of the object itself.
+SendResult = namedtuple("SendResult", ["delivered", "failed"])
 
 
 class NordicWayIC:
-    def __init__(self, url, sender, receiver, username, password, options=None):
+    def __init__(self, url, sender, receiver, username, password, options=None,
+                 batch_size=1, batch_max_bytes=None, window=1, settle_timeout=30.0,
+                 outbox_size=10000, reconnect_backoff=1.0, max_reconnect_backoff=60.0,
+                 health_interval=10.0, transport=None, prefetch=0):
         self.options = options if options else {}
+        # The transport.Transport to the broker, qpid unless given
+        self.transport = transport if transport is not None else QpidTransport()
+        # How many geofences send_objs() may pack into one message, and
+        # the largest message it may build from several of them
+        self.batch_size = batch_size
+        self.batch_max_bytes = batch_max_bytes
+        # How many messages send_objs() keeps unsettled in flight, and how
+        # long it waits for the broker to settle them
+        self.window = max(1, window)
+        self.settle_timeout = settle_timeout
+        # How many messages the receiver fetches ahead, see recv_batch()
+        self.prefetch = prefetch
+        # The background thread started with start() checks the connection
+        # every 'health_interval' seconds when idle, and reconnects with
+        # jittered exponential backoff
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.health_interval = health_interval
         self.url = url
         self._queue_sender = sender
         self._queue_receiver = receiver
         self._credentials = {"username": username, "password": password}
         self.log = logging.getLogger("geofencebroker")
 
+        # Objects waiting for the background thread, keyed by NVDB ID so a
+        # newer document replaces one still queued for the same geofence:
+        # nvdb_id -> (datex_obj, context)
+        self.outbox_size = outbox_size
+        self._outbox = OrderedDict()
+        self._in_flight = 0
+        self._delivered = []
+        self._failed = []
+        self._lock = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._attempt = 0
+        # False from a failed connect or send until the next connect,
+        # while submit() drops from the outbox instead of blocking
+        self._reachable = True
+
     def __enter__(self):
         self.connect()
         return self
@@ -29,42 +72,49 @@ class NordicWayIC:
         self.close()
 
     def connect(self):
-        self.connection = Connection(self.url,
-                                     username=self._credentials.get("username"),
-                                     password=self._credentials.get("password"),
-                                     **self.options)
+        self.transport.open(self.url, self._queue_sender, self._queue_receiver,
+                            username=self._credentials.get("username"),
+                            password=self._credentials.get("password"),
+                            capacity=self.window,
+                            prefetch=self.prefetch,
+                            **self.options)
 
-        self.connection.open()
-        self.session = self.connection.session()
+    @property
+    def username(self):
+        return self._credentials.get("username")
 
-        self.sender = self.session.sender(self._queue_sender)
-        self.receiver = self.session.receiver(self._queue_receiver)
+    def connected(self):
+        """True if the connection is open and has not reported an error"""
+        return self.transport.opened()
 
     def send_messsage(self, msg):
         try:
-            self.sender.send(msg)
-            self.sender.check_error()
+            self.transport.send(msg)
+            self.transport.sync(timeout=self.settle_timeout)
         except MessagingError:
             self.log.exception("Error sending message!")
         except Exception:
             self.log.exception("Exception occured while sending..")
 
-        self.session.acknowledge()
+        self.transport.acknowledge()
 
     def send_obj(self, datex_obj):
+        """Sends the 'datex2' object and waits for the broker to settle it"""
+        return self.send_objs([datex_obj])
+
+    def create_message(self, datex_obj):
         """
         Use data from the 'datex2' object to construct a proper
         AMQP object with all the required properties set.
         """
-        tz = pytz.timezone("Europe/Oslo")
-        now_iso_timestamp = datetime.datetime.now(tz).isoformat()
-        centroid = datex_obj.centroid
+        now_iso_timestamp = datetime.datetime.now(datex2.get_timezone()).isoformat()
+        position = datex_obj.position
         prop = {
             "who": "Norwegian Public Roads Administration",
             "how": "Datex2",
             "what": "PredefinedLocation",
-            "lat": centroid[0],
-            "lon": centroid[1],
+            "lat": position[0],
+            "lon": position[1],
             "where1": "no",
             "when": now_iso_timestamp
         }
@@ -73,18 +123,283 @@ class NordicWayIC:
                     properties=prop,
                     content=str(datex_obj))
 
-        self.log.debug(u"Sending message: version={}, name={}".format(
-            datex_obj.version, datex_obj.name))
-        self.send_messsage(m)
+        if len(datex_obj.locations) == 1:
+            self.log.debug(u"Sending message: version={}, name={}".format(
+                datex_obj.version, datex_obj.name))
+        else:
+            self.log.debug(u"Sending message: {} geofences".format(len(datex_obj.locations)))
+        return m
+
+    def send_objs(self, datex_objs):
+        """
+        Sends the 'datex2' objects, packing up to 'batch_size' of them
+        (and at most 'batch_max_bytes') into each message, and returns a
+        SendResult.
+
+        Messages are sent without waiting for the broker, with up to
+        'window' of them unsettled at once (the sender blocks while the
+        window is full). Settlement is checked once per window and waited
+        for at the end. After an error, the objects of every message not
+        yet confirmed are reported as failed.
+        """
+        delivered = []
+        failed = []
+        # Groups sent but not yet settled, oldest first
+        pending = []
+        sent = 0
+        started = time.time()
+
+        groups = datex2.batches(datex_objs, self.batch_size, self.batch_max_bytes)
+        try:
+            for group in groups:
+                m = self.create_message(group[0] if len(group) == 1 else datex2.merge(group))
+                pending.append(group)
+                self.transport.send(m)
+                sent += 1
+                if sent % self.window == 0:
+                    self.transport.check_error()
+                    pending = self._settled(pending, delivered)
+
+            self.transport.sync(timeout=self.settle_timeout)
+            pending = self._settled(pending, delivered)
+        except MessagingError as e:
+            # Which of the pending messages got through is unknown, so
+            # they count as failed along with those never sent
+            self.log.error("Error sending messages: {}".format(e))
+            for group in groups:
+                pending.append(group)
+
+        for group in pending:
+            failed.extend(group)
+        elapsed = time.time() - started
+        metrics.SEND_BATCH_SECONDS.observe(elapsed)
+        metrics.SENT.inc(len(delivered))
+        metrics.SEND_FAILURES.inc(len(failed))
+        if sent:
+            self.log.debug("Sent {} messages in {:.3f} seconds ({:.0f}/s)".format(
+                sent, elapsed, sent / elapsed if elapsed else float("inf")))
+        if failed:
+            self.log.warn("{} of {} geofences were not delivered".format(
+                len(failed), len(delivered) + len(failed)))
+        return SendResult(delivered, failed)
+
+    def _settled(self, pending, delivered):
+        """
+        Moves the groups in 'pending' that the broker has settled over to
+        'delivered', and returns the rest. The sender settles messages in
+        order, so the unsettled ones are the last in 'pending'.
+        """
+        try:
+            unsettled = self.transport.unsettled()
+        except MessagingError:
+            unsettled = len(pending)
+        settled = len(pending) - min(unsettled, len(pending))
+        for group in pending[:settled]:
+            delivered.extend(group)
+        return pending[settled:]
+
+    def start(self):
+        """
+        Starts the background thread that keeps the connection open and
+        sends whatever is submitted to the outbox.
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="interchange")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the background thread and closes the connection"""
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.close()
+
+    def submit(self, datex_obj, context=None, block=False):
+        """
+        Queues the 'datex2' object for the background thread. 'context' is
+        handed back by results() once the object is delivered or dropped.
+        The outbox holds at most 'outbox_size' objects. With 'block', this
+        waits for room while the background thread runs and the broker is
+        reachable. Otherwise the oldest are dropped first.
+        """
+        key = datex_obj.locations[0][1] if datex_obj.locations else id(datex_obj)
+        with self._lock:
+            while (block and self._running and self._reachable and key not in self._outbox and
+                   len(self._outbox) + self._in_flight >= self.outbox_size):
+                # Wait in short steps so KeyboardInterrupt gets through
+                self._lock.wait(1.0)
+            self._outbox.pop(key, None)
+            self._outbox[key] = (datex_obj, context)
+            self._trim()
+            self._lock.notify_all()
+
+    def publish(self, items, timeout=None):
+        """
+        Submits the (datex_obj, context) pairs in 'items' and waits up to
+        'timeout' seconds for the outbox to drain. Returns results().
+        """
+        for datex_obj, context in items:
+            self.submit(datex_obj, context)
+        self.wait(timeout)
+        return self.results()
+
+    def wait(self, timeout=None):
+        """Waits until everything submitted is sent. False on timeout."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._outbox or self._in_flight:
+                remaining = deadline - time.time() if deadline is not None else 1.0
+                if remaining <= 0:
+                    return False
+                # Wait in short steps so KeyboardInterrupt gets through
+                self._lock.wait(min(remaining, 1.0))
+        return True
+
+    def pending(self):
+        """How many submitted objects are not yet delivered"""
+        with self._lock:
+            return len(self._outbox) + self._in_flight
+
+    def results(self):
+        """
+        A SendResult with the contexts of the objects delivered and
+        dropped since the last call.
+        """
+        with self._lock:
+            result = SendResult(self._delivered, self._failed)
+            self._delivered = []
+            self._failed = []
+        return result
+
+    def _trim(self):
+        dropped = 0
+        while len(self._outbox) > self.outbox_size:
+            _, (datex_obj, context) = self._outbox.popitem(last=False)
+            self._failed.append(context)
+            dropped += 1
+        if dropped:
+            # Reported once per cycle by whoever collects results()
+            self.log.debug("Outbox full, dropped {} geofences".format(dropped))
+
+    def _run(self):
+        while self._running:
+            if not self.connected():
+                self.close()
+                try:
+                    self.connect()
+                except Exception as e:
+                    self._backoff("Unable to connect to {}: {}".format(self.url, e))
+                    continue
+                self.log.info("Connected to {}".format(self.url))
+                self._attempt = 0
+                with self._lock:
+                    self._reachable = True
+                    self._lock.notify_all()
+
+            with self._lock:
+                if not self._outbox and self._running:
+                    # Idle until something is submitted, or it is time
+                    # for the next health check
+                    self._lock.wait(self.health_interval)
+                if not self._running:
+                    break
+                items = list(self._outbox.items())
+                self._outbox.clear()
+                self._in_flight = len(items)
+
+            if items:
+                self._send(items)
+
+    def _send(self, items):
+        """Sends the outbox 'items', and puts those that failed back"""
+        datex_objs = [datex_obj for key, (datex_obj, context) in items]
+        try:
+            result = self.send_objs(datex_objs)
+        except Exception:
+            self.log.exception("Unexpected error sending to {}".format(self.url))
+            metrics.SEND_FAILURES.inc(len(datex_objs))
+            result = SendResult([], datex_objs)
+
+        delivered = set(id(datex_obj) for datex_obj in result.delivered)
+        with self._lock:
+            # Failed objects go back in front of the outbox, unless a newer
+            # document for the same geofence was submitted meanwhile
+            retry = OrderedDict()
+            for key, (datex_obj, context) in items:
+                if id(datex_obj) in delivered:
+                    self._delivered.append(context)
+                elif key not in self._outbox:
+                    retry[key] = (datex_obj, context)
+            retry.update(self._outbox)
+            self._outbox = retry
+            self._trim()
+            self._in_flight = 0
+            self._lock.notify_all()
+
+        if result.failed:
+            # Start over with a fresh connection
+            self.close()
+            self._backoff("{} geofences not delivered to {}".format(len(result.failed), self.url))
+        else:
+            self._attempt = 0
+
+    def _backoff(self, reason):
+        delay = random.uniform(0, min(self.max_reconnect_backoff,
+                                      self.reconnect_backoff * 2 ** self._attempt))
+        self._attempt += 1
+        self.log.warn("{}. Reconnecting in {:.1f} seconds".format(reason, delay))
+        with self._lock:
+            self._reachable = False
+            # Wake up submit() calls blocked on a full outbox
+            self._lock.notify_all()
+            if self._running:
+                self._lock.wait(delay)
 
     def close(self):
-        self.connection.close()
+        try:
+            self.transport.close()
+        except MessagingError as e:
+            self.log.debug("Error closing connection: {}".format(e))
 
     def recv(self, timeout=None):
-        msg = self.receiver.fetch(timeout=timeout)
+        msg = self.transport.fetch(timeout=timeout)
         return msg
 
+    def recv_batch(self, max_messages, timeout=None):
+        """
+        Up to 'max_messages' messages from the receiver, waiting at most
+        'timeout' seconds for the first one and not at all for the rest.
+        Call acknowledge() once they are handled.
+        """
+        messages = []
+        try:
+            messages.append(self.transport.fetch(timeout=timeout))
+            while len(messages) < max_messages:
+                messages.append(self.transport.fetch(timeout=0))
+        except Empty:
+            pass
+        return messages
+
+    def acknowledge(self):
+        """Acknowledges every message received so far"""
+        self.transport.acknowledge()
+
+    def send_messages(self, messages):
+        """Sends the transport.Message objects within the window and waits
+        for the broker to settle them. Raises MessagingError on failure.
+        """
+        for m in messages:
+            self.transport.send(m)
+        self.transport.sync(timeout=self.settle_timeout)
+
     def __repr__(self):
-        return "<{} url={}, sender={}, receiver={}, options={}>".format(
+        return "<{} url={}, sender={}, receiver={}, options={}, batch_size={}, window={}, transport={}>".format(
             self.__class__.__name__, self.url,
-            self._queue_sender, self._queue_receiver, self.options)
+            self._queue_sender, self._queue_receiver, self.options, self.batch_size, self.window,
+            self.transport.__class__.__name__)
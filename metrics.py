@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import bisect
+import logging
+import os
+import threading
+import time
+from six.moves import BaseHTTPServer
+
+log = logging.getLogger("geofencebroker")
+
+# Seconds, for calls from a millisecond up to a slow NVDB page
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CYCLE_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs) + "}"
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{} takes the labels {}, not {}".format(self.name, self.labels, sorted(labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labels:
+            values = [((), self._empty())]
+        for key, value in values:
+            lines.extend(self._lines(key, value))
+        return lines
+
+    def _empty(self):
+        return 0.0
+
+    def _lines(self, key, value):
+        return ["{}{} {}".format(self.name, _format_labels(self.labels, key), _format_value(value))]
+
+
+class Counter(_Metric):
+    """A count that only goes up, such as geofences sent"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    """A value that is set, such as the size of the outbox"""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, such as call durations in seconds, in
+    cumulative 'buckets' like a Prometheus histogram.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _empty(self):
+        # (count per bucket and one for +Inf, sum)
+        return [0] * (len(self.buckets) + 1), 0.0
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or self._empty()
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the 'with' block takes"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels)) or self._empty()
+        return sum(counts)
+
+    def _lines(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                self.name, _format_labels(self.labels, key, [("le", _format_value(bound))]), cumulative))
+        labels = _format_labels(self.labels, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    """The metrics to expose, in the order they were registered"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes render() to 'path', replacing it in one step"""
+        tmp = "{}.tmp".format(path)
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.histogram("geofence_fetch_request_seconds", "Duration of NVDB requests")
+FETCH_BYTES = REGISTRY.counter("geofence_fetch_response_bytes_total",
+                               "Bytes of NVDB response bodies, after decompression")
+FETCH_ERRORS = REGISTRY.counter("geofence_fetch_errors_total", "Failed NVDB requests, before retries")
+DIFF_SECONDS = REGISTRY.histogram("geofence_diff_seconds",
+                                  "Duration of comparing a chunk of the NVDB listing with the database")
+FENCES = REGISTRY.counter("geofence_fences_total", "Geofences seen in NVDB, by change", ["change"])
+CONVERT_SECONDS = REGISTRY.histogram("geofence_convert_seconds",
+                                     "Duration of converting a geofence to Datex2")
+SEND_BATCH_SECONDS = REGISTRY.histogram("geofence_send_batch_seconds",
+                                        "Duration of sending a batch of geofences until the broker "
+                                        "settled all of its messages")
+SENT = REGISTRY.counter("geofence_sent_total", "Geofences the broker confirmed")
+SEND_FAILURES = REGISTRY.counter("geofence_send_failures_total", "Geofences the broker did not confirm")
+OUTBOX = REGISTRY.gauge("geofence_outbox", "Geofences waiting to be sent")
+STORE_SECONDS = REGISTRY.histogram("geofence_store_seconds", "Duration of database writes")
+STORED = REGISTRY.counter("geofence_stored_total", "Geofences written to the database, by change", ["change"])
+STAGE_SECONDS = REGISTRY.histogram("geofence_stage_seconds", "Time each pipeline stage worked on a cycle",
+                                   ["stage"], CYCLE_BUCKETS)
+CYCLE_SECONDS = REGISTRY.histogram("geofence_cycle_seconds", "Duration of sync cycles",
+                                   buckets=CYCLE_BUCKETS)
+CYCLES = REGISTRY.counter("geofence_cycles_total", "Sync cycles, by result", ["result"])
+LAST_CYCLE = REGISTRY.gauge("geofence_last_cycle_timestamp_seconds", "When the last sync cycle ended")
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics request from %s: %s", self.client_address[0], format % args)
+
+
+class MetricsServer(object):
+    """
+    Serves 'registry' in the Prometheus text format on
+    http://host:port/metrics from a background thread.
+    """
+
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+        self.registry = registry
+        self._server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+        self._server.registry = registry
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __repr__(self):
+        return "<{} address={}:{}>".format(self.__class__.__name__, *self.address)
+
+
+class MetricsFile(object):
+    """Writes 'registry' to 'path' every 'interval' seconds"""
+
+    def __init__(self, path, interval=60.0, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.registry.write(self.path)
+        except (IOError, OSError) as e:
+            log.warn("Unable to write metrics to {}: {}".format(self.path, e))
+
+    def __repr__(self):
+        return "<{} path={}, interval={}>".format(self.__class__.__name__, self.path, self.interval)
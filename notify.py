@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+import requests
+from six.moves import queue
+from util import slack_notify
+
+
+class SlackNotifier(object):
+    """
+    Posts Slack messages from a background thread, so a slow or failing
+    webhook never holds up the sync loop.
+
+    Events added with event() during a cycle are coalesced by flush()
+    into one summary message. Messages wait in a queue of at most
+    'queue_size', and are dropped when it is full. At most one message is
+    posted every 'min_interval' seconds, over one pooled connection.
+    Without a 'url' nothing is sent.
+    """
+
+    def __init__(self, url, queue_size=100, min_interval=1.0, max_lines=20, timeout=(3.05, 10)):
+        self.url = url
+        self.min_interval = min_interval
+        self.max_lines = max_lines
+        self.timeout = timeout
+        self.sent = 0
+        self.dropped = 0
+        self.log = logging.getLogger("geofencebroker")
+        self._queue = queue.Queue(queue_size)
+        # kind -> list of event messages since the last flush()
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._thread is not None or not self.url:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="slack")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Sends what is queued, within 'timeout' seconds, and stops"""
+        if self._thread is None:
+            return
+        # The worker stops once the queue is empty. The None only wakes it
+        # up sooner, so it does not matter if a full queue has no room.
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        self._session.close()
+
+    def notify(self, msg):
+        """Queues 'msg' to be sent on its own"""
+        if self.url:
+            self._put(msg)
+
+    def event(self, kind, msg):
+        """Adds 'msg' to the next summary, grouped by 'kind' (e.g. "New")"""
+        if not self.url:
+            return
+        with self._lock:
+            self._events.setdefault(kind, []).append(msg)
+
+    def flush(self):
+        """Queues one summary of the events since the last flush()"""
+        with self._lock:
+            events, self._events = self._events, OrderedDict()
+        if events:
+            self.notify(self.summary(events))
+
+    def summary(self, events):
+        """The message for 'events', at most 'max_lines' of them listed"""
+        counts = ", ".join("{} {}".format(len(msgs), kind.lower()) for kind, msgs in events.items())
+        lines = [u"Geofence changes: {}".format(counts)]
+        listed = [msg for msgs in events.values() for msg in msgs]
+        lines.extend(listed[:self.max_lines])
+        if len(listed) > self.max_lines:
+            lines.append(u"... and {} more".format(len(listed) - self.max_lines))
+        return u"\n".join(lines)
+
+    def _put(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+            self.log.warn("Slack queue full, dropped {} messages".format(self.dropped))
+
+    def _run(self):
+        last_post = 0
+        while True:
+            try:
+                msg = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    break
+                continue
+            if msg is None:
+                if self._stopping.is_set() and self._queue.empty():
+                    break
+                continue
+            wait = last_post + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            last_post = time.time()
+            if slack_notify(msg, self.url, self._session, self.timeout) is not None:
+                self.sent += 1
+
+    def __repr__(self):
+        return "<{} enabled={}, min_interval={}, sent={}, dropped={}>".format(
+            self.__class__.__name__, bool(self.url), self.min_interval, self.sent, self.dropped)
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from six.moves import queue
+import datex2
+import diff
+import geofence
+import metrics
+import storage
+from convert import DocumentConverter
+
+log = logging.getLogger("geofencebroker")
+
+# Marks the end of a cycle on a stage queue, and shutdown of the pipeline
+_END = object()
+_STOP = object()
+
+
+class Cycle(object):
+    """
+    One sync cycle on its way through the stages. Each stage only
+    writes the fields it owns; persist reads them once the cycle has
+    passed every other stage.
+    """
+
+    def __init__(self, number, watermark, check_deletes):
+        self.number = number
+        self.started = time.time()
+        self.watermark = watermark
+        self.check_deletes = check_deletes
+        self.known = {}
+        self.changes = diff.ChangeSet([], [], [], [], set(), None)
+        self.listed_ids = None
+        self.submitted = 0
+        self.error = None
+        self.result = None
+        # Seconds each stage spent working on this cycle
+        self.busy = {}
+        # A profiling.CycleProfile if this cycle is profiled
+        self.profile = None
+        self.done = threading.Event()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+
+    def __repr__(self):
+        return "<{} number={}, watermark={}, check_deletes={}>".format(
+            self.__class__.__name__, self.number, self.watermark, self.check_deletes)
+
+
+class Stage(object):
+    """
+    A thread that takes (cycle, payload) items from 'inbox', and puts
+    the items yielded by process(cycle, payload) on 'outbox', as they
+    are produced. At the end of each cycle finish(cycle) is called, and
+    the end is passed on.
+
+    Errors are logged and stored on the cycle, which still runs through
+    the rest of the stages. The last stage marks the cycle done.
+    """
+
+    def __init__(self, name, process, finish=None, inbox=None, outbox=None):
+        self.name = name
+        self.process = process
+        self.finish = finish
+        self.inbox = inbox
+        self.outbox = outbox
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                if self.outbox is not None:
+                    self.outbox.put(_STOP)
+                return
+            cycle, payload = item
+            started = time.time()
+            profiler = cycle.profile.profiler(self.name) if cycle.profile is not None else None
+            if profiler is not None:
+                profiler.enable()
+            try:
+                if payload is _END:
+                    outputs = self.finish(cycle) if self.finish is not None else None
+                elif cycle.error is None:
+                    outputs = self.process(cycle, payload)
+                else:
+                    # Skip the rest of a failed cycle
+                    outputs = None
+                for output in outputs or ():
+                    self.outbox.put((cycle, output))
+            except Exception as e:
+                if not isinstance(e, geofence.FetchError):
+                    log.exception("Error in {} stage of cycle {}".format(self.name, cycle.number))
+                cycle.fail(e)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            cycle.busy[self.name] = cycle.busy.get(self.name, 0.0) + time.time() - started
+            if payload is _END:
+                if self.outbox is not None:
+                    self.outbox.put((cycle, _END))
+                else:
+                    cycle.done.set()
+
+
+class SyncPipeline(object):
+    """
+    Keeps the database and the broker in sync with NVDB, in cycles
+    started every 'interval' seconds, counted from the start of the
+    previous cycle. A cycle that runs longer than 'interval' is followed
+    by the next one right away.
+
+    Each cycle runs through these stages, each in its own thread and
+    connected by queues of at most 'queue_size' items:
+
+      fetch   - lists the geofences from 'nvdb' (a geofence.NvdbClient)
+                and hands them on 'chunk_size' at a time
+      diff    - sorts each chunk into new, modified and touched
+                geofences, and finds the deleted ones at the end
+      convert - builds the Datex2 documents with 'converter'
+      publish - submits them to the outbox of 'ic' (a started
+                NordicWayIC), waiting for room while the broker is
+                reachable
+      persist - waits up to 'send_timeout' seconds for delivery, and
+                stores what the broker confirmed
+
+    So the first geofences are converted and sent while NVDB is still
+    listing the rest. Only one cycle runs at a time, so every cycle is
+    compared against what the previous one stored.
+
+    In incremental mode only geofences changed since the stored
+    'sist_modifisert' high-water mark are listed, and deleted geofences
+    are looked for every 'delete_check_interval' seconds.
+
+    Cycles are profiled when requested from 'profiler' (a
+    profiling.CycleProfiler).
+    """
+
+    def __init__(self, nvdb, ic, notifier, interval=60, incremental=False, delete_check_interval=3600,
+                 cache=None, converter=None, index=None, reducer=None, send_timeout=None,
+                 chunk_size=200, queue_size=8, store=storage, profiler=None):
+        self.nvdb = nvdb
+        self.ic = ic
+        self.notifier = notifier
+        self.interval = interval
+        self.incremental = incremental
+        self.delete_check_interval = delete_check_interval
+        self.cache = cache
+        self.converter = converter or DocumentConverter(workers=1)
+        self.index = index
+        self.reducer = reducer
+        self.send_timeout = send_timeout
+        self.chunk_size = chunk_size
+        self.store = store
+        self.profiler = profiler
+        self.last_delete_check = 0
+        self.cycles = 0
+        self._stop = threading.Event()
+
+        queues = [queue.Queue(queue_size) for _ in range(5)]
+        self.stages = [
+            Stage("fetch", self._fetch, None, queues[0], queues[1]),
+            Stage("diff", self._diff, self._diff_end, queues[1], queues[2]),
+            Stage("convert", self._convert, None, queues[2], queues[3]),
+            Stage("publish", self._publish, None, queues[3], queues[4]),
+            Stage("persist", None, self._persist, queues[4], None)
+        ]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self, timeout=None):
+        """Stops the stages once the cycle in progress is done"""
+        self._stop.set()
+        self.stages[0].inbox.put(_STOP)
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def run(self, cycles=None):
+        """
+        Runs a cycle every 'interval' seconds until stop() is called, or
+        'cycles' cycles have run.
+        """
+        count = 0
+        while not self._stop.is_set() and (cycles is None or count < cycles):
+            cycle = self.run_cycle()
+            count += 1
+            elapsed = time.time() - cycle.started
+            if elapsed > self.interval:
+                log.warn("Cycle {} took {:.1f} seconds, longer than the {} second interval".format(
+                    cycle.number, elapsed, self.interval))
+            if cycles is None or count < cycles:
+                self._stop.wait(max(0, self.interval - elapsed))
+
+    def run_cycle(self):
+        """Runs one cycle through the stages and returns it when done"""
+        watermark = self.store.get_state("sist_modifisert") if self.incremental else None
+        check_deletes = (watermark is None or
+                         time.time() - self.last_delete_check >= self.delete_check_interval)
+        cycle = Cycle(self.cycles, watermark, check_deletes)
+        self.cycles += 1
+        if self.profiler is not None:
+            cycle.profile = self.profiler.begin(cycle)
+        profiler = cycle.profile.profiler("schedule") if cycle.profile is not None else None
+
+        geofence.clear_geometry_cache()
+        # Compare against all stored geofences at once, instead of
+        # looking each geofence up in the database
+        if profiler is not None:
+            profiler.enable()
+        try:
+            cycle.known = self.store.versions()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+        inbox = self.stages[0].inbox
+        inbox.put((cycle, None))
+        inbox.put((cycle, _END))
+        # Wait in short steps so KeyboardInterrupt gets through
+        while not cycle.done.wait(1.0):
+            pass
+        if self.profiler is not None:
+            self.profiler.end(cycle)
+        return cycle
+
+    def _fetch(self, cycle, payload):
+        chunk = []
+        try:
+            for vegobjekt in self.nvdb.objects(changed_since=cycle.watermark):
+                chunk.append(vegobjekt)
+                if len(chunk) >= self.chunk_size:
+                    yield "objects", chunk
+                    chunk = []
+        except geofence.NotModified:
+            log.debug("No geofences changed in NVDB since {}".format(cycle.watermark))
+        if chunk:
+            yield "objects", chunk
+
+        if cycle.check_deletes and cycle.watermark is not None:
+            # A delta listing only holds changed geofences, so we need
+            # the IDs of all of them to find the deleted ones
+            yield "ids", set(self.nvdb.ids())
+
+    def _diff(self, cycle, payload):
+        kind, data = payload
+        if kind == "ids":
+            cycle.listed_ids = data
+            return
+
+        with metrics.DIFF_SECONDS.time():
+            changes = diff.compute(data, cycle.known)
+        for change in ("added", "modified", "touched"):
+            metrics.FENCES.inc(len(getattr(changes, change)), change=change)
+        metrics.FENCES.inc(len(changes.seen), change="seen")
+        total = cycle.changes
+        cycle.changes = total._replace(added=total.added + changes.added,
+                                       modified=total.modified + changes.modified,
+                                       touched=total.touched + changes.touched,
+                                       seen=total.seen | changes.seen,
+                                       newest=max(total.newest, changes.newest))
+        if changes.added:
+            yield "added", changes.added
+        if changes.modified:
+            yield "modified", changes.modified
+
+    def _diff_end(self, cycle):
+        if cycle.error is not None or not cycle.check_deletes:
+            return
+        listed_ids = cycle.changes.seen if cycle.watermark is None else cycle.listed_ids
+        if not listed_ids:
+            if not cycle.known:
+                # Nothing stored and nothing listed, e.g. an area without geofences
+                return
+            # An empty listing is far more likely an NVDB hiccup than
+            # every geofence being removed at once.
+            raise geofence.FetchError("Empty geofence listing from NVDB")
+        cycle.changes = diff.with_deleted(cycle.changes, cycle.known, listed_ids)
+        metrics.FENCES.inc(len(cycle.changes.deleted), change="deleted")
+        if cycle.changes.deleted:
+            yield "deleted", list(self.store.find(cycle.changes.deleted))
+
+    def _convert(self, cycle, payload):
+        kind, fences = payload
+        if kind == "deleted":
+            for v in fences:
+                msg = "Vegobjekt with ID '{}' removed from NVDB: {}".format(v.get("id"), v)
+                log.warn(msg)
+                self.notifier.event("Deleted", msg)
+                datex_obj = datex2.create_delete_doc_from_db(v, self.cache)
+                log.debug(datex_obj)
+                yield datex_obj, ("deleted", v.get("id"))
+            return
+
+        for fence, datex_obj in zip(fences, self.converter.convert(fences, self.cache)):
+            if kind == "added":
+                msg = u"New geofence: id={}, version={}, name={}".format(
+                    fence.get("id"), datex_obj.version, datex_obj.name)
+                log.info(msg)
+                self.notifier.event("New", msg)
+            else:
+                msg = u"Modified geofence: message: id={}, version={}, name={}".format(
+                    fence.get("id"), datex_obj.version, datex_obj.name)
+                log.info(msg)
+                self.notifier.event("Modified", msg)
+            # (key in what to store, what to store once it is delivered)
+            yield datex_obj, (kind, fence)
+
+    def _publish(self, cycle, payload):
+        datex_obj, context = payload
+        # Waits for room in the outbox while the broker takes messages,
+        # rather than dropping what this cycle has converted
+        self.ic.submit(datex_obj, context, block=True)
+        cycle.submitted += 1
+        return ()
+
+    def _persist(self, cycle):
+        """
+        Stores the geofences the broker has confirmed, in this or an
+        earlier cycle, in one transaction. The rest are sent again next
+        cycle if they are still waiting then.
+        """
+        try:
+            if cycle.submitted:
+                self.ic.wait(self.send_timeout)
+            cycle.result = result = self.ic.results()
+
+            changes = cycle.changes
+            log.debug("{} geofences from NVDB: {} new, {} modified, {} unchanged content, {} deleted".format(
+                len(changes.seen), len(changes.added), len(changes.modified),
+                len(changes.touched), len(changes.deleted)))
+
+            # Geofences that were only touched in NVDB are stored without sending
+            sent = {"added": [], "modified": list(changes.touched), "deleted": []}
+            for key, value in result.delivered:
+                sent[key].append(value)
+                if key == "deleted":
+                    log.warn("Delete geofence id: {}".format(value))
+            self.store.write(**sent)
+            if self.index is not None:
+                self.index.apply(**sent)
+
+            if isinstance(cycle.error, geofence.FetchError):
+                # The listing is incomplete, so we can't tell which
+                # geofences were deleted. Try again next cycle.
+                log.error("Unable to fetch all geofences from NVDB: {}".format(cycle.error))
+                return
+            if cycle.error is not None:
+                return
+
+            if cycle.check_deletes:
+                self.last_delete_check = cycle.started
+
+            # Only move the high-water mark once the whole cycle went
+            # through, so undelivered geofences are listed again next cycle
+            pending = self.ic.pending()
+            if result.failed or pending:
+                log.warn("{} geofences dropped from the full outbox, "
+                         "{} waiting in it".format(len(result.failed), pending))
+            elif changes.newest and changes.newest > (cycle.watermark or ""):
+                self.store.set_state("sist_modifisert", changes.newest)
+                log.debug("Geofences synced up to {}".format(changes.newest))
+
+            if self.cache is not None:
+                if changes.added or changes.modified:
+                    self.cache.save()
+                log.debug("Document cache: {}".format(self.cache.stats()))
+            if self.reducer is not None and self.reducer.polygons:
+                log.info("Geometry reduction: {}".format(self.reducer.stats()))
+                self.reducer.reset()
+        finally:
+            self.notifier.flush()
+            elapsed = time.time() - cycle.started
+            log.debug("Cycle {} done in {:.2f} seconds: {}".format(
+                cycle.number, elapsed,
+                ", ".join("{} {:.2f}s".format(stage.name, cycle.busy.get(stage.name, 0.0))
+                          for stage in self.stages[:-1])))
+            for stage in self.stages[:-1]:
+                metrics.STAGE_SECONDS.observe(cycle.busy.get(stage.name, 0.0), stage=stage.name)
+            metrics.CYCLE_SECONDS.observe(elapsed)
+            metrics.CYCLES.inc(result="failed" if cycle.error is not None else "ok")
+            metrics.LAST_CYCLE.set(time.time())
+            metrics.OUTBOX.set(self.ic.pending())
+
+    def __repr__(self):
+        return "<{} interval={}, incremental={}, chunk_size={}, queue_size={}>".format(
+            self.__class__.__name__, self.interval, self.incremental, self.chunk_size,
+            self.stages[0].inbox.maxsize)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+log = logging.getLogger("geofencebroker")
+
+
+class Sampler(object):
+    """
+    Samples the stacks of all other threads every 'interval' seconds
+    and counts them in the collapsed stack format of flame graphs:
+    "thread;file:function;... count".
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.counts = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write("{} {}\n".format(stack, count))
+
+
+class CycleProfile(object):
+    """
+    The profile of one cycle: a cProfile.Profile for each thread that
+    works on it, see profiler(), or a Sampler of all threads.
+    """
+
+    def __init__(self, mode="cprofile", interval=0.005):
+        self.mode = mode
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        if mode == "sample":
+            self._sampler = Sampler(interval)
+            self._sampler.start()
+
+    def profiler(self, name):
+        """
+        The cProfile.Profile for the thread 'name' to enable while it
+        works on the cycle, or None when sampling. cProfile only sees the
+        thread it was enabled in.
+        """
+        if self._sampler is not None:
+            return None
+        with self._lock:
+            if name not in self._profiles:
+                self._profiles[name] = cProfile.Profile()
+            return self._profiles[name]
+
+    def write(self, path):
+        """Writes the profile to 'path' plus .pstats or .collapsed"""
+        if self._sampler is not None:
+            self._sampler.stop()
+            path += ".collapsed"
+            self._sampler.write(path)
+            return path
+        profiles = list(self._profiles.values())
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        path += ".pstats"
+        stats.dump_stats(path)
+        return path
+
+
+class CycleProfiler(object):
+    """
+    Profiles the next cycles of a pipeline.SyncPipeline once request()
+    is called, e.g. from a signal handler. Each profile is written to
+    'directory', named after the cycle and its fence and change counts.
+
+    'mode' is "cprofile" for deterministic profiles of each stage,
+    merged into one pstats file, or "sample" for collapsed stacks of all
+    threads every 'interval' seconds.
+    """
+
+    def __init__(self, directory="profiles", mode="cprofile", interval=0.005):
+        if mode not in ("cprofile", "sample"):
+            raise ValueError("Unknown profile mode: {}".format(mode))
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.written = []
+        self._remaining = 0
+        self._lock = threading.Lock()
+
+    def request(self, cycles=1):
+        """Profiles the next 'cycles' cycles. Safe to call from a signal handler."""
+        self._remaining = max(self._remaining, cycles)
+
+    def begin(self, cycle):
+        """A CycleProfile for 'cycle' if it is to be profiled, else None"""
+        with self._lock:
+            if self._remaining <= 0:
+                return None
+            self._remaining -= 1
+        log.info("Profiling cycle {} ({})".format(cycle.number, self.mode))
+        return CycleProfile(self.mode, self.interval)
+
+    def end(self, cycle):
+        """Writes the profile of 'cycle', once every stage is done with it"""
+        if cycle.profile is None:
+            return None
+        changes = cycle.changes
+        name = "{}-cycle{}-fences{}-added{}-modified{}-deleted{}".format(
+            time.strftime("%Y%m%dT%H%M%S", time.localtime(cycle.started)), cycle.number,
+            len(changes.seen), len(changes.added), len(changes.modified), len(changes.deleted))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = cycle.profile.write(os.path.join(self.directory, name))
+        if path is not None:
+            self.written.append(path)
+            log.info("Wrote profile of cycle {} to {}".format(cycle.number, path))
+        return path
+
+    def __repr__(self):
+        return "<{} directory={}, mode={}, remaining={}>".format(
+            self.__class__.__name__, self.directory, self.mode, self._remaining)
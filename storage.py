@@ -1,42 +1,203 @@
 # -*- coding: utf-8 -*-
 
-import dataset
 import logging
+import time
 from util import parse_timestamp, parse_polygon, get_polygon_centroid, utm_to_gps
+from geometry import parse_wkt
 import geofence
+import metrics
 
-# Initialize and connect to local sqlite database
-db = dataset.connect("sqlite:///database.db")
+log = logging.getLogger("geofencebroker")
+
+DEFAULT_URL = "sqlite:///database.db"
+
+# The database all functions here use, connected by get_db() on first
+# use. dataset pulls in SQLAlchemy and alembic, so it is only imported
+# then too.
+_url = DEFAULT_URL
+_db = None
+_schema_ready = False
+
+
+def configure(url=DEFAULT_URL):
+    """Uses the database at 'url' from now on, connecting on first use"""
+    global _url, _db, _schema_ready
+    _url = url
+    _db = None
+    _schema_ready = False
+
+
+def connect(url=None):
+    """Connects to the database at 'url' (default: the configured one),
+    which all functions here use from now on
+    """
+    global _url, _db, _schema_ready
+    import dataset
+    if url is not None:
+        _url = url
+    # The sync pipeline uses the connection from its stage threads, one
+    # at a time, see pipeline.SyncPipeline
+    db = dataset.connect(_url, engine_kwargs={"connect_args": {"check_same_thread": False}})
+
+    # dataset shares a single SQLite connection, so these apply to all queries.
+    # WAL lets readers run alongside a write and, with synchronous=NORMAL,
+    # only syncs to disk at checkpoints instead of on every commit.
+    db.query("PRAGMA journal_mode=WAL")
+    db.query("PRAGMA synchronous=NORMAL")
+    _db = db
+    _schema_ready = False
+    return db
+
+
+def get_db():
+    """The database connection, see connect()"""
+    if _db is None:
+        connect()
+    return _db
+
+
+# Columns of the 'vegobjekter' table, besides the 'id' primary key, with
+# the name of their SQLAlchemy type
+COLUMNS = [
+    ("name", "UnicodeText"),
+    ("href", "UnicodeText"),
+    ("sist_modifisert", "UnicodeText"),
+    ("version", "Integer"),
+    ("type", "UnicodeText"),
+    ("polygon", "UnicodeText"),
+    ("centroid", "UnicodeText"),
+    ("content_hash", "UnicodeText")
+]
 
 
 def vegobjekter():
-    table_vegobjekter = db.get_table("vegobjekter")
+    table_vegobjekter = get_db().get_table("vegobjekter")
     return table_vegobjekter
 
 
+def ensure_schema():
+    """Creates the 'vegobjekter' table and its columns if missing. Batch
+    writes expect the columns to exist, and replace rows by their 'id'
+    primary key. Only checked once per connection.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    import sqlalchemy
+    table = vegobjekter()
+    columns = table.columns
+    for name, column_type in COLUMNS:
+        if name not in columns:
+            table.create_column(name, getattr(sqlalchemy, column_type))
+    _schema_ready = True
+
+
+def get_state(key, default=None):
+    """Returns a value persisted with set_state(), such as the sync high-water mark"""
+    table = get_db().get_table("sync_state", primary_id="key", primary_type="String")
+    row = table.find_one(key=key)
+    if not row:
+        return default
+    return row["value"]
+
+
+def set_state(key, value):
+    table = get_db().get_table("sync_state", primary_id="key", primary_type="String")
+    table.upsert({"key": key, "value": value}, ["key"])
+
+
 def exists(vegobjekt):
-    table_vegobjekter = db.get_table("vegobjekter")
+    table_vegobjekter = get_db().get_table("vegobjekter")
     if table_vegobjekter.find_one(id=vegobjekt.get("id")):
         return True
     return False
 
 
-def delete(geofence_id):
+def versions():
+    """Returns {id: (sist_modifisert, content_hash)} for every stored
+    geofence, in one query
+    """
+    db = get_db()
+    if "vegobjekter" not in db:
+        return {}
+    ensure_schema()
+    rows = db.query("SELECT id, sist_modifisert, content_hash FROM vegobjekter")
+    return dict((row["id"], (row["sist_modifisert"], row["content_hash"])) for row in rows)
+
+
+def polygons():
+    """Yields (id, polygon WKT) for every stored geofence, see index.GeofenceIndex"""
+    db = get_db()
+    if "vegobjekter" not in db:
+        return
+    for row in db.query("SELECT id, polygon FROM vegobjekter"):
+        yield row["id"], row["polygon"]
+
+
+def find(geofence_ids, chunk_size=500):
+    """Yields the stored geofences with the given IDs"""
     table = vegobjekter()
-    table.delete(id=geofence_id)
+    geofence_ids = list(geofence_ids)
+    # Stay well below SQLite's limit on the number of query parameters
+    for i in range(0, len(geofence_ids), chunk_size):
+        for row in table.find(id=geofence_ids[i:i + chunk_size]):
+            yield row
+
+
+def delete(geofence_id):
+    write(deleted=[geofence_id])
 
 
 def add(vegobjekt):
-    table_vegobjekter = db.get_table("vegobjekter")
-    geofence = convert_to_geofence(vegobjekt)
+    write(added=[vegobjekt])
 
-    nvdb_polygon = geofence.get("polygon")
-    polygon = parse_polygon(nvdb_polygon)
-    centroid = get_polygon_centroid(polygon)
 
-    geofence["centroid"] = ','.join(map(str, [centroid[0], centroid[1]]))
+def write(added=(), modified=(), deleted=()):
+    """Stores the new and modified 'vegobjekt' dicts and removes the
+    geofences with IDs in 'deleted', all in one transaction.
 
-    table_vegobjekter.insert(geofence)
+    Each kind of change is written with a single executemany statement.
+    """
+    from sqlalchemy import text
+    added = [row for row in map(_to_row, added) if row]
+    modified = [row for row in map(_to_row, modified) if row]
+    deleted = [{"id": geofence_id} for geofence_id in deleted]
+    if not any([added, modified, deleted]):
+        return
+
+    ensure_schema()
+    db = get_db()
+    names = [name for name, _ in COLUMNS]
+    insert = text("INSERT OR REPLACE INTO vegobjekter (id, {}) VALUES (:id, {})".format(
+        ", ".join(names), ", ".join(":" + name for name in names)))
+    update = text("UPDATE vegobjekter SET {} WHERE id = :id".format(
+        ", ".join("{0} = :{0}".format(name) for name in names)))
+    delete = text("DELETE FROM vegobjekter WHERE id = :id")
+
+    with metrics.STORE_SECONDS.time():
+        with db:
+            for statement, rows in [(insert, added), (update, modified), (delete, deleted)]:
+                if rows:
+                    db.executable.execute(statement, rows)
+    for change, rows in [("added", added), ("modified", modified), ("deleted", deleted)]:
+        metrics.STORED.inc(len(rows), change=change)
+
+    log.debug("Stored geofences: {} added, {} updated, {} deleted".format(
+        len(added), len(modified), len(deleted)))
+
+
+def _to_row(vegobjekt):
+    """The database row for 'vegobjekt', including its centroid"""
+    row = convert_to_geofence(vegobjekt)
+    if row is None:
+        return None
+
+    polygon = geofence.get_polygon(vegobjekt)
+    centroid = get_polygon_centroid(polygon)
+
+    row["centroid"] = ','.join(map(str, [centroid[0], centroid[1]]))
+    row["content_hash"] = geofence.get_content_hash(vegobjekt)
+    return row
 
 
 def convert_to_geofence(vegobjekt):
@@ -73,7 +234,7 @@ def is_modified(vegobjekt):
     log = logging.getLogger("geofencebroker")
     next_date = parse_timestamp(vegobjekt["metadata"]["sist_modifisert"])
 
-    table_vegobjekter = db.get_table("vegobjekter")
+    table_vegobjekter = get_db().get_table("vegobjekter")
     geofence = table_vegobjekter.find_one(id=vegobjekt.get("id"))
     if not geofence:
         log.warn("vegobjekt not found in database")
@@ -115,14 +276,66 @@ def fix_centroid():
     return True
 
 
+def fix_content_hash():
+    """Stores the content hash of geofences stored before we had one
+    """
+    log = logging.getLogger("geofencebroker")
+    ensure_schema()
+    table_vegobjekter = vegobjekter()
+
+    rows = list(table_vegobjekter.find(content_hash=None))
+    for row in rows:
+        parsed = parse_wkt(row.get("polygon"))
+        update_data = {
+            'id': row.get("id"),
+            'content_hash': geofence.content_hash(row.get("name"), row.get("version"), parsed)
+        }
+        table_vegobjekter.update(update_data, ['id'])
+
+    if rows:
+        log.info("Stored content hash of {} geofences".format(len(rows)))
+    return True
+
+
 def update(vegobjekt):
-    table_vegobjekter = db.get_table("vegobjekter")
-    geofence = convert_to_geofence(vegobjekt)
+    write(modified=[vegobjekt])
 
-    nvdb_polygon = geofence.get("polygon")
-    polygon = parse_polygon(nvdb_polygon)
-    centroid = get_polygon_centroid(polygon)
 
-    geofence["centroid"] = ','.join(map(str, [centroid[0], centroid[1]]))
+def drop_id_index():
+    """Drops the unique index on 'id' that ensure_schema() used to create.
+    The primary key already is one, so it only slowed down writes.
+    """
+    get_db().query("DROP INDEX IF EXISTS ix_vegobjekter_id")
+
+
+# Schema migrations: (version, description, function). migrate() runs
+# each one newer than the stored 'schema_version' once, in order. Only
+# ever append to this list.
+MIGRATIONS = [
+    (1, "create the vegobjekter columns", ensure_schema),
+    (2, "store missing centroids", fix_centroid),
+    (3, "store missing content hashes", fix_content_hash),
+    (4, "drop the redundant index on id", drop_id_index)
+]
+
 
-    table_vegobjekter.update(geofence, ['id'])
+def schema_version():
+    return int(get_state("schema_version") or 0)
+
+
+def migrate():
+    """Runs the MIGRATIONS the database has not had yet, and returns the
+    new schema version. A fresh or current database is never scanned.
+    """
+    version = schema_version()
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        started = time.time()
+        migration()
+        # Stored as text, like the other sync_state values
+        set_state("schema_version", str(number))
+        version = number
+        log.info("Migrated database to schema version {} ({}) in {:.2f} seconds".format(
+            number, description, time.time() - started))
+    return version
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import benchmark
+import diff
+import geofence
+import util
+
+
+class TestBenchmark(TestCase):
+
+    def tearDown(self):
+        # The synthetic geofences reuse IDs and timestamps of other tests
+        geofence.clear_geometry_cache()
+
+    def test_generate(self):
+        fences = benchmark.generate(20, vertices=12, name_length=30)
+
+        self.assertEqual([f["id"] for f in fences], list(range(1, 21)))
+        self.assertEqual(len(util.parse_polygon(fences[0]["egenskaper"][3]["verdi"])), 13)
+        self.assertLessEqual(len(geofence.get_name(fences[0])), 63)
+
+    def test_change(self):
+        fences = benchmark.generate(40)
+        known = dict((f["id"], (f["metadata"]["sist_modifisert"], geofence.get_content_hash(f)))
+                     for f in fences)
+
+        changes = diff.compute(benchmark.change(fences, ratio=0.2), known)
+        changes = diff.with_deleted(changes, known, changes.seen)
+
+        self.assertEqual((len(changes.added), len(changes.modified), len(changes.deleted)), (2, 8, 2))
+
+    def test_compare(self):
+        baseline = {"a": {"per_item_us": 10.0}, "b": {"per_item_us": 10.0}}
+        results = {"a": {"per_item_us": 11.0}, "b": {"per_item_us": 13.0}, "c": {"per_item_us": 1.0}}
+
+        comparison = benchmark.compare(results, baseline, threshold=0.2)
+
+        self.assertEqual(sorted(comparison), ["a", "b"])
+        self.assertFalse(comparison["a"]["regressed"])
+        self.assertTrue(comparison["b"]["regressed"])
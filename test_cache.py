@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from cache import DocumentCache, CachedLocation
+import datex2
+import metrics
+from testutil import fence
+
+
+class TestDocumentCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.row = {
+            "id": 826277828,
+            "name": u"Oslo Demo",
+            "version": 2,
+            "content_hash": "abc",
+            "polygon": "POLYGON ((262906.3971474045 6649248.441221254, "
+                       "263059.8558061711 6649187.586932589, "
+                       "263022.81406153727 6649124.086805921, "
+                       "262906.3971474045 6649248.441221254))"
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _entry(self, name):
+        return CachedLocation(name, [(59.9, 10.7)], (59.9, 10.7), b"<container/>", None)
+
+    def test_lru_eviction(self):
+        cache = DocumentCache(maxsize=2)
+        cache.put(1, 1, self._entry(u"a"))
+        cache.put(2, 1, self._entry(u"b"))
+        cache.get(1, 1)
+        cache.put(3, 1, self._entry(u"c"))
+
+        self.assertIsNotNone(cache.get(1, 1))
+        self.assertIsNone(cache.get(2, 1))
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_doc_from_db_is_cached(self):
+        cache = DocumentCache()
+        first = datex2.create_doc_from_db(self.row, cache=cache)
+        second = datex2.create_doc_from_db(self.row, cache=cache)
+
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(second.containers, first.containers)
+        self.assertEqual(second.centroid, first.centroid)
+
+        delete = datex2.create_delete_doc_from_db(self.row, cache=cache)
+        self.assertEqual(delete.polygon, [])
+        self.assertEqual(cache.stats()["hits"], 2)
+
+    def test_doc_is_not_converted_again(self):
+        cache = DocumentCache()
+        converted = metrics.CONVERT_SECONDS.count()
+        first = datex2.create_doc(fence(1), cache=cache)
+        second = datex2.create_doc(fence(1), cache=cache)
+
+        self.assertEqual(metrics.CONVERT_SECONDS.count(), converted + 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(second.containers, first.containers)
+
+        # Other content under the same version is converted
+        changed = fence(1)
+        changed["egenskaper"][0]["verdi"] = u"Renamed"
+        datex2.create_doc(changed, cache=cache)
+        self.assertEqual(metrics.CONVERT_SECONDS.count(), converted + 2)
+
+    def test_other_content_hash_is_a_miss(self):
+        cache = DocumentCache()
+        datex2.create_doc_from_db(self.row, cache=cache)
+
+        self.assertIsNone(cache.get(self.row["id"], self.row["version"], "def"))
+
+    def test_persistence(self):
+        path = os.path.join(self.tmpdir, "cache.pickle")
+        cache = DocumentCache(path=path)
+        cache.put(1, 1, self._entry(u"Tromsø"))
+        cache.save()
+
+        loaded = DocumentCache(path=path)
+        self.assertEqual(loaded.get(1, 1), self._entry(u"Tromsø"))
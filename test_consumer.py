@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import datetime
+import json
+import time
+import pytz
+from consumer import Consumer, parse_positions
+from index import GeofenceIndex
+from interchange import NordicWayIC
+from transport import LoopbackBroker, LoopbackTransport, Message
+from util import utm_to_gps
+
+
+class FlakyIndex(object):
+    """Fails the first query, then answers like 'index'"""
+
+    def __init__(self, index):
+        self.index = index
+        self.failed = False
+
+    def query(self, lat, lon):
+        if not self.failed:
+            self.failed = True
+            raise KeyError("flaky")
+        return self.index.query(lat, lon)
+
+
+class TestConsumer(TestCase):
+
+    def setUp(self):
+        self.index = GeofenceIndex()
+        self.index.load([(1, "POLYGON ((260000 6649000, 260100 6649000, 260100 6649100, "
+                             "260000 6649100, 260000 6649000))")])
+        self.broker = LoopbackBroker()
+        self.ic = NordicWayIC("amqp://localhost", "hits", "positions", "user", "secret",
+                              transport=LoopbackTransport(self.broker))
+        self.ic.connect()
+
+        self.inside = utm_to_gps((260050, 6649050))
+        self.outside = utm_to_gps((261050, 6649050))
+        self.when = datetime.datetime.now(pytz.timezone("Europe/Oslo")).isoformat()
+
+    def tearDown(self):
+        self.ic.close()
+
+    def _position(self, position):
+        self.broker._enqueue("positions", Message(content=b"", user_id="vehicle", properties={
+            "lat": position[0], "lon": position[1], "when": self.when, "subject": "vehicle-1"}))
+
+    def test_parse_positions(self):
+        messages = [Message(b"", {"lat": "59.9", "lon": 10.7, "when": "2017-01-01T01:00:00+01:00"}, None),
+                    Message(b"", {"lat": None}, None)]
+
+        lat, lon, sent_at = parse_positions(messages)
+
+        self.assertEqual(lat[0], 59.9)
+        self.assertEqual(lon[0], 10.7)
+        self.assertEqual(sent_at[0], 1483228800)
+        self.assertNotEqual(lat[1], lat[1])
+
+    def test_consume(self):
+        for position in [self.inside, self.outside, self.inside]:
+            self._position(position)
+
+        consumer = Consumer(self.ic, self.index, batch_size=2, timeout=0, publish_hits=True)
+        self.assertEqual(consumer.consume(), 2)
+        self.assertEqual(consumer.consume(), 1)
+        self.assertEqual(consumer.consume(), 0)
+
+        stats = consumer.stats()
+        self.assertEqual(stats["received"], 3)
+        self.assertEqual(stats["hits"], 2)
+        self.assertGreaterEqual(stats["lag_max"], 0)
+
+        self.assertEqual(self.broker.depth("hits"), 2)
+        message = self.broker.queues["hits"][0]
+        hit = json.loads(message.content)
+        self.assertEqual(hit["geofences"], [1])
+        # Sent as us, without the properties of the position message
+        self.assertEqual(message.user_id, "user")
+        self.assertEqual(message.properties["what"], "GeofenceHit")
+        self.assertEqual(message.properties["geofences"], "1")
+        self.assertNotIn("subject", message.properties)
+
+    def _run(self, consumer, received):
+        consumer.start()
+        try:
+            deadline = time.time() + 5
+            while consumer.stats()["received"] < received and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            consumer.stop(timeout=5)
+
+    def test_without_hits_queue(self):
+        # Consume only: no sender queue to open
+        ic = NordicWayIC("amqp://localhost", None, "positions", "user", "secret",
+                         transport=LoopbackTransport(self.broker))
+        for position in [self.inside, self.outside]:
+            self._position(position)
+
+        consumer = Consumer(ic, self.index, timeout=0.01, publish_hits=False)
+        self._run(consumer, 2)
+
+        self.assertEqual(consumer.stats()["received"], 2)
+        self.assertEqual(consumer.stats()["hits"], 1)
+
+    def test_unexpected_error_reconnects(self):
+        ic = NordicWayIC("amqp://localhost", None, "positions", "user", "secret",
+                         transport=LoopbackTransport(self.broker))
+        self._position(self.outside)
+        self._position(self.inside)
+
+        # The loopback broker does not deliver the failed batch again
+        consumer = Consumer(ic, FlakyIndex(self.index), batch_size=1, timeout=0.01,
+                            reconnect_backoff=0.01)
+        self._run(consumer, 1)
+
+        self.assertEqual(consumer.stats()["received"], 1)
+        self.assertEqual(consumer.stats()["hits"], 1)
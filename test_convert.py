@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import datex2
+import geofence
+import metrics
+from cache import DocumentCache
+from convert import DocumentConverter, _convert
+from testutil import vegobjekt
+
+
+def _geometry_cache_size(_):
+    return len(geofence._geometries)
+
+
+class TestDocumentConverter(TestCase):
+
+    def setUp(self):
+        self.fences = [vegobjekt(i, "2017-09-01 10:00:00",
+                                 "POLYGON ((262906 6649248, 263059 6649187, {} 6649124, 262906 6649248))".format(
+                                     263000 + i))
+                       for i in range(1, 21)]
+
+    def test_pool_matches_serial(self):
+        serial = [str(d) for d in DocumentConverter(workers=1).convert(self.fences)]
+
+        converter = DocumentConverter(workers=2, chunksize=3, min_parallel=1)
+        cache = DocumentCache()
+        try:
+            docs = list(converter.convert(self.fences, cache))
+        finally:
+            converter.close()
+
+        self.assertEqual([d.nvdb_id for d in docs], list(range(1, 21)))
+        self.assertEqual([s.split(b"</publicationTime>")[1] for s in serial],
+                         [str(d).split(b"</publicationTime>")[1] for d in docs])
+        self.assertEqual(len(cache), 20)
+
+        # Converted before, so none go to the pool again
+        converted = metrics.CONVERT_SECONDS.count()
+        converter = DocumentConverter(workers=2, chunksize=3, min_parallel=1)
+        try:
+            again = list(converter.convert(self.fences, cache))
+        finally:
+            converter.close()
+        self.assertEqual(metrics.CONVERT_SECONDS.count(), converted)
+        self.assertEqual([d.containers for d in again], [d.containers for d in docs])
+
+    def test_worker_forgets_geometries(self):
+        geofence.clear_geometry_cache()
+        _convert(self.fences[0])
+        _convert(self.fences[1])
+        self.assertEqual(len(geofence._geometries), 0)
+
+        converter = DocumentConverter(workers=2, chunksize=3, min_parallel=1)
+        try:
+            list(converter.convert(self.fences))
+            list(converter.convert(self.fences))
+            sizes = converter._pool.map(_geometry_cache_size, range(8), 1)
+        finally:
+            converter.close()
+
+        self.assertEqual(sizes, [0] * 8)
+
+    def test_pool_reduces_geometry(self):
+        reducer = datex2.GeometryReducer(decimals=4)
+        converter = DocumentConverter(workers=2, min_parallel=1, reducer=reducer)
+        try:
+            docs = list(converter.convert(self.fences))
+        finally:
+            converter.close()
+
+        self.assertEqual(reducer.polygons, 20)
+        self.assertEqual(reducer.vertices_before, 80)
+        self.assertEqual(docs[0].polygon[0][0], round(docs[0].polygon[0][0], 4))
@@ -2,8 +2,12 @@
 
 from unittest import TestCase
 from datex2 import Datex2
+from lxml import etree
+import datex2
 import calendar
+import math
 import time
+import util
 
 
 class TestDatex2(TestCase):
@@ -53,3 +57,87 @@ class TestDatex2(TestCase):
         # print(d)
         
         self.assertTrue(d.doc.findall("payloadPublication"))
+
+    def test_serializer_matches_lxml(self):
+        polygon = [(262906.3971474045, 6649248.441221254),
+                   (263059.8558061711, 6649187.586932589),
+                   (263022.81406153727, 6649124.086805921),
+                   (262906.3971474045, 6649248.441221254)]
+        centroid = [263059.8558061711, 6649187.586932589]
+
+        for name, points in [(u"Oslo Demo", polygon),
+                             (u"Tromsø & <Ørland> \"test\"", polygon),
+                             (u"Deleted", [])]:
+            d = Datex2()
+            d.body(name, "826277828", 3, points, centroid)
+
+            self.assertEqual(str(d), etree.tostring(d.doc, pretty_print=True))
+
+    def test_reducer(self):
+        # A 200 m wide circle near Oslo with 1 cm of noise
+        polygon = [(262900.0 + 100 * math.cos(a) + 0.01 * (i % 2),
+                    6649200.0 + 100 * math.sin(a))
+                   for i, a in enumerate(x * 2 * math.pi / 400 for x in range(400))]
+        polygon.append(polygon[0])
+
+        reducer = datex2.GeometryReducer(tolerance=0.5, decimals=6)
+        d = Datex2()
+        d.body(u"Circle", 1, 1, polygon, polygon[0], reducer)
+
+        stats = reducer.stats()
+        self.assertEqual(stats["vertices_before"], 401)
+        self.assertLess(stats["vertices_after"], 50)
+        self.assertLess(stats["bytes_after"], stats["bytes_before"] / 5)
+        # The unreduced size is estimated
+        lat, lon = util.utm_to_gps_array(polygon)
+        unreduced = len(datex2.render_container(u"Circle", 1, 1, list(zip(lat.tolist(), lon.tolist()))))
+        self.assertAlmostEqual(stats["bytes_before"], unreduced, delta=unreduced * 0.02)
+        self.assertEqual(str(d), etree.tostring(d.doc, pretty_print=True))
+        for lat, lon in d.polygon:
+            self.assertEqual(lat, round(lat, 6))
+            self.assertEqual(lon, round(lon, 6))
+
+    def test_reducer_keeps_tiny_ring(self):
+        # A 5 cm triangle is a single point at 4 decimals (about 10 m)
+        polygon = [(262900.0, 6649200.0), (262900.05, 6649200.0),
+                   (262900.0, 6649200.05), (262900.0, 6649200.0)]
+
+        reducer = datex2.GeometryReducer(decimals=4)
+        d = Datex2()
+        d.body(u"Tiny", 1, 1, polygon, polygon[0], reducer)
+
+        self.assertEqual(len(d.polygon), 4)
+        self.assertEqual(d.polygon[0], d.polygon[-1])
+        self.assertEqual(len(set(d.polygon)), 3)
+
+    def _doc(self, nvdb_id, polygon):
+        d = Datex2()
+        d.body(u"Geofence", nvdb_id, 1, polygon, polygon[0])
+        return d
+
+    def test_batches(self):
+        polygon = [(262906.3971474045, 6649248.441221254),
+                   (263059.8558061711, 6649187.586932589),
+                   (263022.81406153727, 6649124.086805921)]
+        docs = [self._doc(i, polygon) for i in range(5)]
+
+        groups = list(datex2.batches(docs, max_locations=2))
+        self.assertEqual([len(g) for g in groups], [2, 2, 1])
+
+        one_doc = len(str(docs[0]))
+        groups = list(datex2.batches(docs, max_locations=10, max_bytes=one_doc))
+        self.assertEqual([len(g) for g in groups], [1, 1, 1, 1, 1])
+
+    def test_merge(self):
+        docs = [self._doc(1, [(262906.3971474045, 6649248.441221254)]),
+                self._doc(2, [(263943.56601331057, 6648669.00256108)])]
+
+        merged = datex2.merge(docs)
+
+        containers = merged.doc.findall("payloadPublication/predefinedLocationContainer")
+        self.assertEqual([c.get("id") for c in containers], ["1", "2"])
+        self.assertEqual(str(merged), etree.tostring(merged.doc, pretty_print=True))
+
+        min_lat, min_lon, max_lat, max_lon = merged.bbox
+        self.assertEqual(merged.position, ((min_lat + max_lat) / 2, (min_lon + max_lon) / 2))
+        self.assertEqual(docs[0].position, docs[0].centroid)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import diff
+import geofence
+from testutil import vegobjekt
+
+
+class TestDiff(TestCase):
+
+    def setUp(self):
+        geofence.clear_geometry_cache()
+        content_hash = geofence.get_content_hash(vegobjekt(2, "2017-09-01 10:00:00"))
+        self.known = {
+            1: ("2017-09-01 10:00:00", None),
+            2: ("2017-09-01 10:00:00", content_hash),
+            3: ("2017-09-01 10:00:00", None)
+        }
+
+    def test_compute(self):
+        fences = [vegobjekt(1, "2017-09-01 10:00:00"),
+                  vegobjekt(2, "2017-09-02 08:30:00", "POLYGON ((0 0, 2 0, 2 2, 0 0))"),
+                  vegobjekt(4, "2017-09-03 12:00:00")]
+
+        changes = diff.compute(iter(fences), self.known)
+
+        self.assertEqual([f["id"] for f in changes.added], [4])
+        self.assertEqual([f["id"] for f in changes.modified], [2])
+        self.assertEqual(changes.touched, [])
+        self.assertEqual(changes.deleted, [])
+        self.assertEqual(changes.seen, set([1, 2, 4]))
+        self.assertEqual(changes.newest, "2017-09-03 12:00:00")
+
+    def test_same_content_is_touched(self):
+        changes = diff.compute([vegobjekt(2, "2017-09-02 08:30:00")], self.known)
+
+        self.assertEqual(changes.modified, [])
+        self.assertEqual([f["id"] for f in changes.touched], [2])
+
+    def test_older_timestamp_is_not_modified(self):
+        changes = diff.compute([vegobjekt(1, "2017-08-01 10:00:00")], self.known)
+
+        self.assertEqual(changes.modified, [])
+
+    def test_with_deleted(self):
+        changes = diff.compute([vegobjekt(1, "2017-09-01 10:00:00")], self.known)
+        changes = diff.with_deleted(changes, self.known, changes.seen)
+
+        self.assertEqual(changes.deleted, [2, 3])
+
+    def test_empty_listing(self):
+        changes = diff.compute([], self.known)
+
+        self.assertEqual(changes.added, [])
+        self.assertEqual(changes.modified, [])
+        self.assertIsNone(changes.newest)
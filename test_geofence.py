@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import json
+from requests.exceptions import ConnectionError, TooManyRedirects
+import geofence
+from geofence import FetchError, NotModified, NvdbClient
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, page=None, headers=None, url="https://nvdb/911", content=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+        self.url = url
+        self.content = content if content is not None else json.dumps(page or {}).encode("utf-8")
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+class FakeSession(object):
+    """Stands in for requests.Session, answering with 'responses' in order"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests.append((url, params, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def page(ids, next_url=None):
+    metadata = {"returnert": len(ids)}
+    if next_url:
+        metadata["neste"] = {"href": next_url}
+    return {"objekter": [{"id": i} for i in ids], "metadata": metadata}
+
+
+class TestPages(TestCase):
+
+    def setUp(self):
+        self.client = NvdbClient(retries=0)
+
+    def test_follows_next(self):
+        self.client.session = FakeSession([FakeResponse(200, page([1, 2], "https://nvdb/911?start=2")),
+                                           FakeResponse(200, page([3], "https://nvdb/911?start=3")),
+                                           FakeResponse(200, page([]))])
+
+        self.assertEqual(list(self.client.ids()), [1, 2, 3])
+        self.assertEqual([r[0] for r in self.client.session.requests],
+                         [self.client.url, "https://nvdb/911?start=2", "https://nvdb/911?start=3"])
+
+    def test_error_in_prefetch(self):
+        self.client.session = FakeSession([FakeResponse(200, page([1, 2], "https://nvdb/911?start=2")),
+                                           TooManyRedirects("loop")])
+
+        pages = self.client.pages()
+        # The second page is already requested while the first is handled
+        self.assertEqual(len(next(pages)["objekter"]), 2)
+        self.assertRaises(FetchError, next, pages)
+
+
+class TestListings(TestCase):
+
+    def setUp(self):
+        self.client = NvdbClient(retries=0)
+
+    def test_changed_since(self):
+        self.client.session = FakeSession([FakeResponse(200, page([1]))])
+
+        self.assertEqual([o["id"] for o in geofence.fetch_objects("2017-09-01 10:00:00", self.client)], [1])
+        params = self.client.session.requests[0][1]
+        # One second of overlap, as NVDB timestamps have second resolution
+        self.assertEqual(params["endret_etter"], "2017-09-01T09:59:59")
+        self.assertEqual(params["inkluder"], "lokasjon,egenskaper,metadata")
+
+    def test_all(self):
+        self.client.session = FakeSession([FakeResponse(200, page([1]))])
+
+        list(geofence.fetch_objects(client=self.client))
+        self.assertNotIn("endret_etter", self.client.session.requests[0][1])
+
+    def test_ids(self):
+        self.client.session = FakeSession([FakeResponse(200, page([1, 2], "https://nvdb/911?start=2")),
+                                           FakeResponse(200, page(["3"]))])
+
+        self.assertEqual(list(geofence.fetch_ids(self.client)), [1, 2, 3])
+        self.assertEqual(self.client.session.requests[0][1], {"inkluder": "minimum"})
+
+
+class TestNvdbClient(TestCase):
+
+    def setUp(self):
+        self.client = NvdbClient(retries=2, backoff=0)
+
+    def _answer(self, *responses):
+        self.client.session = FakeSession(responses)
+        return self.client.session
+
+    def test_retries(self):
+        session = self._answer(FakeResponse(503), ConnectionError("reset"), FakeResponse(200, page([1])))
+
+        self.assertEqual(list(self.client.ids()), [1])
+        self.assertEqual(len(session.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        session = self._answer(FakeResponse(503), FakeResponse(429), FakeResponse(500), FakeResponse(200))
+
+        self.assertRaises(FetchError, list, self.client.ids())
+        self.assertEqual(len(session.requests), 3)
+
+    def test_does_not_retry_client_errors(self):
+        session = self._answer(FakeResponse(404), FakeResponse(200, page([1])))
+
+        self.assertRaises(FetchError, list, self.client.ids())
+        self.assertEqual(len(session.requests), 1)
+
+    def test_invalid_json(self):
+        session = self._answer(FakeResponse(200, content=b"<html>"))
+
+        self.assertRaises(FetchError, list, self.client.ids())
+        self.assertEqual(len(session.requests), 1)
+
+    def test_not_modified(self):
+        self._answer(FakeResponse(304))
+
+        self.assertRaises(NotModified, list, self.client.objects("2017-09-01 10:00:00"))
+
+    def test_validators_after_complete_walk(self):
+        headers = {"ETag": '"v1"', "Last-Modified": "Fri, 01 Sep 2017 10:00:00 GMT"}
+        since = "2017-09-01 10:00:00"
+
+        # A walk that fails on its second page is not remembered
+        session = self._answer(FakeResponse(200, page([1], "https://nvdb/911?start=1"), headers),
+                               FakeResponse(404))
+        self.assertRaises(FetchError, list, self.client.objects(since))
+        session = self._answer(FakeResponse(200, page([1]), headers))
+        self.assertEqual(len(list(self.client.objects(since))), 1)
+        self.assertEqual(session.requests[0][2], {})
+
+        # The next walk asks if the listing changed since
+        session = self._answer(FakeResponse(304))
+        self.assertRaises(NotModified, list, self.client.objects(since))
+        self.assertEqual(session.requests[0][2], {"If-None-Match": '"v1"',
+                                                  "If-Modified-Since": "Fri, 01 Sep 2017 10:00:00 GMT"})
+
+        # A full listing is never conditional
+        session = self._answer(FakeResponse(200, page([1]), headers))
+        self.assertEqual(list(self.client.ids()), [1])
+        self.assertEqual(session.requests[0][2], {})
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import math
+import geometry
+
+
+class TestPolygonStats(TestCase):
+
+    def setUp(self):
+        self.square = [(0.0, 0.0), (2.0, 0.0), (2.0, 2.0), (0.0, 2.0), (0.0, 0.0)]
+        # Polygon, Oslo, Grønland
+        self.polygon = [(262906.3971474045, 6649248.441221254),
+                        (263059.8558061711, 6649187.586932589),
+                        (263022.81406153727, 6649124.086805921),
+                        (263816.5657456318, 6648542.002307889),
+                        (263943.56601331057, 6648669.00256108),
+                        (263803.3365402619, 6650023.6719330065),
+                        (262906.3971474045, 6649248.441221254)]
+
+    def test_square(self):
+        stats = geometry.polygon_stats(self.square)
+
+        self.assertEqual(stats.area, 4.0)
+        self.assertEqual(stats.centroid, (1.0, 1.0))
+        self.assertEqual(stats.bbox, (0.0, 0.0, 2.0, 2.0))
+
+    def test_clockwise_area_is_negative(self):
+        stats = geometry.polygon_stats(self.square[::-1])
+
+        self.assertEqual(stats.area, -4.0)
+        self.assertEqual(stats.centroid, (1.0, 1.0))
+
+    def test_utm_polygon(self):
+        stats = geometry.polygon_stats(self.polygon)
+
+        # Exact (rational arithmetic) centroid: 263549.93804066756, 6649242.346513199
+        self.assertAlmostEqual(stats.centroid[0], 263549.93804066756, places=6)
+        self.assertAlmostEqual(stats.centroid[1], 6649242.346513199, places=6)
+
+    def test_string_coordinates(self):
+        polygon = [[str(x), str(y)] for x, y in self.square]
+
+        self.assertEqual(geometry.polygon_stats(polygon).centroid, (1.0, 1.0))
+
+    def test_degenerate_polygon(self):
+        stats = geometry.polygon_stats([(1.0, 1.0), (3.0, 3.0), (1.0, 1.0)])
+
+        self.assertEqual(stats.area, 0.0)
+        self.assertAlmostEqual(stats.centroid[0], 5.0 / 3)
+        self.assertAlmostEqual(stats.centroid[1], 5.0 / 3)
+
+    def test_empty_polygon(self):
+        stats = geometry.polygon_stats([])
+
+        self.assertEqual(stats.area, 0.0)
+        self.assertTrue(all(math.isnan(c) for c in stats.centroid))
+
+    def test_many(self):
+        area, centroid, bbox = geometry.polygon_stats_many([self.square, [], self.polygon])
+
+        self.assertEqual(area.shape, (3,))
+        self.assertEqual(tuple(centroid[0]), (1.0, 1.0))
+        self.assertTrue(math.isnan(centroid[1][0]))
+        self.assertEqual(tuple(centroid[2]), geometry.polygon_stats(self.polygon).centroid)
+        self.assertEqual(tuple(bbox[0]), (0.0, 0.0, 2.0, 2.0))
+
+
+class TestParseWkt(TestCase):
+
+    def test_polygon(self):
+        parsed = geometry.parse_wkt(
+            "POLYGON ((261406.25545925 6649329.53490491, 261418.543820197 6649292.41831282, "
+            "261400.0 6649300.0, 261406.25545925 6649329.53490491))")
+
+        self.assertEqual(parsed.coords.shape, (4, 2))
+        self.assertEqual(parsed.coords.dtype.name, "float64")
+        self.assertEqual(parsed.coords[1].tolist(), [261418.543820197, 6649292.41831282])
+        self.assertEqual(parsed.rings.tolist(), [0, 4])
+        self.assertEqual(parsed.polygons.tolist(), [0, 1])
+
+    def test_polygon_with_hole(self):
+        parsed = geometry.parse_wkt(
+            "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), (2 2, 2 4, 4 4, 2 2))")
+
+        self.assertEqual(parsed.rings.tolist(), [0, 5, 9])
+        self.assertEqual(parsed.polygons.tolist(), [0, 2])
+        self.assertEqual(geometry.exterior(parsed).shape, (5, 2))
+
+    def test_multipolygon(self):
+        parsed = geometry.parse_wkt(
+            "MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), "
+            "((5 5, 9 5, 9 9, 5 5), (6 6, 7 6, 7 7, 6 6)))")
+
+        self.assertEqual(parsed.rings.tolist(), [0, 4, 8, 12])
+        self.assertEqual(parsed.polygons.tolist(), [0, 1, 3])
+        self.assertEqual(geometry.exterior(parsed, 1)[0].tolist(), [5.0, 5.0])
+
+    def test_polygon_z(self):
+        parsed = geometry.parse_wkt("POLYGON Z ((0 0 1, 1 0 1, 1 1 2, 0 0 1))")
+
+        self.assertEqual(parsed.coords.tolist(), [[0, 0], [1, 0], [1, 1], [0, 0]])
+
+    def test_empty(self):
+        parsed = geometry.parse_wkt("POLYGON EMPTY")
+
+        self.assertEqual(len(geometry.exterior(parsed)), 0)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, geometry.parse_wkt, None)
+        self.assertRaises(ValueError, geometry.parse_wkt, "POINT (1 2)")
+
+
+class TestSimplify(TestCase):
+
+    def test_drops_vertices_within_tolerance(self):
+        # Square with a nearly straight bottom edge
+        ring = [(0.0, 0.0), (1.0, 0.1), (2.0, 0.0), (2.0, 2.0), (0.0, 2.0), (0.0, 0.0)]
+
+        self.assertEqual(geometry.simplify(ring, 0.5).tolist(),
+                         [[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]])
+        self.assertEqual(len(geometry.simplify(ring, 0.05)), 6)
+        self.assertEqual(len(geometry.simplify(ring, 0)), 6)
+
+    def test_returns_ring_unchanged_if_it_would_collapse(self):
+        # Simplified, this thin rectangle would be a line
+        ring = [(0.0, 0.0), (10.0, 0.0), (10.0, 0.1), (0.0, 0.1), (0.0, 0.0)]
+
+        self.assertEqual(len(geometry.simplify(ring, 5.0)), 5)
+
+    def test_is_simple(self):
+        self.assertTrue(geometry.is_simple([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]))
+        self.assertFalse(geometry.is_simple([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)]))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import numpy as np
+from index import GeofenceIndex
+from util import utm_to_gps
+
+
+def square(x, y, size):
+    return "POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))".format(x, y, x + size, y + size)
+
+
+class TestGeofenceIndex(TestCase):
+
+    def setUp(self):
+        # A 10×10 grid of 100 m squares, 200 m apart, near Oslo
+        self.rows = []
+        for i in range(10):
+            for j in range(10):
+                self.rows.append((i * 10 + j + 1, square(260000 + i * 200, 6649000 + j * 200, 100)))
+        self.index = GeofenceIndex(node_size=4)
+        self.index.load(self.rows)
+
+    def test_contains(self):
+        self.assertEqual(self.index.contains(*utm_to_gps((260050, 6649050))), [1])
+        self.assertEqual(self.index.contains(*utm_to_gps((260250, 6649450))), [13])
+        # Between the squares
+        self.assertEqual(self.index.contains(*utm_to_gps((260150, 6649050))), [])
+
+    def test_query_many(self):
+        points = [utm_to_gps((260050 + i * 200, 6649050 + j * 200)) for i in range(10) for j in range(10)]
+        points.append(utm_to_gps((250000, 6640000)))
+        lat, lon = np.array(points).T
+
+        point, ids = self.index.query(lat, lon)
+
+        self.assertEqual(point.tolist(), list(range(100)))
+        self.assertEqual(ids.tolist(), list(range(1, 101)))
+
+    def test_overlapping_and_holes(self):
+        outer = (u"POLYGON ((260000 6649000, 260100 6649000, 260100 6649100, 260000 6649100, 260000 6649000), "
+                 u"(260040 6649040, 260060 6649040, 260060 6649060, 260040 6649060, 260040 6649040))")
+        self.index.add(500, outer)
+
+        self.assertEqual(self.index.contains(*utm_to_gps((260020, 6649020))), [1, 500])
+        self.assertEqual(self.index.contains(*utm_to_gps((260050, 6649050))), [1])
+
+    def test_incremental_updates(self):
+        self.index.delete(1)
+        self.index.add(2, square(260000, 6649000, 100))
+        self.index.add(1000, square(262000, 6651000, 100))
+
+        self.assertEqual(self.index.contains(*utm_to_gps((260050, 6649050))), [2])
+        self.assertEqual(self.index.contains(*utm_to_gps((260050, 6649250))), [])
+        self.assertEqual(self.index.contains(*utm_to_gps((262050, 6651050))), [1000])
+        self.assertEqual(len(self.index), 100)
+
+        # Enough changes to pack the tree again
+        for nvdb_id, polygon in self.rows[10:]:
+            self.index.add(nvdb_id, polygon)
+        self.assertLessEqual(len(self.index._stale), self.index.min_rebuild)
+        self.assertEqual(self.index.contains(*utm_to_gps((260050, 6649050))), [2])
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import sys
+import types
+from datex2 import Datex2
+import metrics
+from interchange import NordicWayIC
+from transport import LoopbackBroker, LoopbackTransport, MessagingError, QpidTransport, Transport
+
+
+class TestNordicWayIC(TestCase):
+
+    def setUp(self):
+        polygon = [(262906.3971474045, 6649248.441221254),
+                   (263059.8558061711, 6649187.586932589),
+                   (263022.81406153727, 6649124.086805921),
+                   (262906.3971474045, 6649248.441221254)]
+        centroid = [263000.0, 6649180.0]
+
+        self.docs = []
+        for nvdb_id in range(1, 11):
+            d = Datex2()
+            d.body("Oslo Demo", nvdb_id, 1, polygon, centroid)
+            self.docs.append(d)
+
+    def _ic(self, broker, **kwargs):
+        kwargs.setdefault("reconnect_backoff", 0.01)
+        kwargs.setdefault("health_interval", 0.05)
+        return NordicWayIC("amqp://localhost", "geofences", "geofences", "user", "secret",
+                           transport=LoopbackTransport(broker), **kwargs)
+
+    def test_send_objs(self):
+        batches = metrics.SEND_BATCH_SECONDS.count()
+        sent = metrics.SENT.value()
+        broker = LoopbackBroker()
+        with self._ic(broker, window=4) as ic:
+            result = ic.send_objs(self.docs)
+            ic.send_obj(self.docs[0])
+
+        # A single geofence is a batch of one, counted in geofences too
+        self.assertEqual(metrics.SEND_BATCH_SECONDS.count(), batches + 2)
+        self.assertEqual(metrics.SENT.value(), sent + 11)
+        self.assertEqual(len(result.delivered), 10)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(broker.depth("geofences"), 11)
+
+    def test_send_objs_batched(self):
+        broker = LoopbackBroker(latency=0.001)
+        with self._ic(broker, window=2, batch_size=4) as ic:
+            result = ic.send_objs(self.docs)
+            message = ic.recv(timeout=0)
+
+        self.assertEqual(len(result.delivered), 10)
+        self.assertEqual(broker.depth("geofences"), 2)
+        self.assertEqual(message.content.count(b"<predefinedLocationContainer"), 4)
+
+    def test_rejected_messages_fail(self):
+        broker = LoopbackBroker(capacity=3)
+        with self._ic(broker, window=10) as ic:
+            result = ic.send_objs(self.docs)
+
+        self.assertEqual(len(result.delivered) + len(result.failed), 10)
+        self.assertTrue(result.failed)
+
+    def test_outbox_reconnects(self):
+        broker = LoopbackBroker()
+        broker.fail()
+        ic = self._ic(broker, window=4)
+        ic.start()
+        try:
+            for d in self.docs:
+                ic.submit(d, d.locations[0][1])
+            self.assertFalse(ic.wait(timeout=0.1))
+            self.assertEqual(ic.pending(), 10)
+
+            broker.restore()
+            self.assertTrue(ic.wait(timeout=5))
+        finally:
+            ic.stop()
+
+        result = ic.results()
+        self.assertEqual(sorted(result.delivered), list(range(1, 11)))
+        self.assertEqual(result.failed, [])
+
+    def test_submit_blocks_while_reachable(self):
+        ic = self._ic(LoopbackBroker(latency=0.001), window=2, outbox_size=3)
+        ic.start()
+        try:
+            for d in self.docs:
+                ic.submit(d, d.locations[0][1], block=True)
+                self.assertLessEqual(ic.pending(), 3)
+            self.assertTrue(ic.wait(timeout=5))
+        finally:
+            ic.stop()
+
+        result = ic.results()
+        self.assertEqual(sorted(result.delivered), list(range(1, 11)))
+        self.assertEqual(result.failed, [])
+
+    def test_submit_drops_while_unreachable(self):
+        broker = LoopbackBroker()
+        broker.fail()
+        ic = self._ic(broker, outbox_size=3, reconnect_backoff=1.0)
+        ic.start()
+        try:
+            ic.wait(timeout=0.1)
+            for d in self.docs:
+                ic.submit(d, d.locations[0][1], block=True)
+        finally:
+            ic.stop()
+
+        self.assertEqual(len(ic.results().failed), 7)
+
+    def test_unexpected_send_error_fails(self):
+        ic = self._ic(LoopbackBroker(), reconnect_backoff=0)
+
+        def broken(datex_objs):
+            raise RuntimeError("broken")
+        ic.send_objs = broken
+        failures = metrics.SEND_FAILURES.value()
+        ic._send([(d.locations[0][1], (d, d.locations[0][1])) for d in self.docs[:3]])
+
+        self.assertEqual(metrics.SEND_FAILURES.value(), failures + 3)
+        self.assertEqual(ic.pending(), 3)
+
+    def test_outbox_replaces_and_drops(self):
+        ic = self._ic(LoopbackBroker(), outbox_size=3)
+        ic.submit(self.docs[0], "old")
+        ic.submit(self.docs[0], "new")
+        self.assertEqual(ic.pending(), 1)
+
+        for d in self.docs[1:4]:
+            ic.submit(d, d.locations[0][1])
+        self.assertEqual(ic.pending(), 3)
+        self.assertEqual(ic.results().failed, ["new"])
+
+
+class TestTransport(TestCase):
+
+    def test_incomplete_transport(self):
+        class SendOnly(Transport):
+            def send(self, message):
+                pass
+
+        self.assertRaises(TypeError, SendOnly)
+
+    def test_qpid_without_sender(self):
+        class Link(object):
+            capacity = 0
+
+        class Session(object):
+            def sender(self, address):
+                # Like qpid, which rejects None as a malformed address
+                if address is None:
+                    raise ValueError("Malformed address")
+                return Link()
+
+            def receiver(self, address):
+                return Link()
+
+        class Connection(object):
+            def __init__(self, url, **options):
+                pass
+
+            def open(self):
+                pass
+
+            def session(self):
+                return Session()
+
+        messaging = types.ModuleType("qpid.messaging")
+        messaging.Connection = Connection
+        for name in ["Empty", "ConnectionError", "Timeout", "MessagingError"]:
+            setattr(messaging, name, type(name, (Exception,), {}))
+        qpid = types.ModuleType("qpid")
+        qpid.messaging = messaging
+        modules = {"qpid": qpid, "qpid.messaging": messaging}
+        saved = dict((name, sys.modules.get(name)) for name in modules)
+        sys.modules.update(modules)
+        try:
+            transport = QpidTransport()
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    del sys.modules[name]
+                else:
+                    sys.modules[name] = module
+
+        transport.open("amqp://localhost", None, "positions", prefetch=10)
+
+        self.assertIsNone(transport.sender)
+        self.assertEqual(transport.receiver.capacity, 10)
+        self.assertEqual(transport.unsettled(), 0)
+        self.assertRaises(MessagingError, transport.send, None)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import requests
+from metrics import Registry, MetricsServer, MetricsFile
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.fences = self.registry.counter("fences_total", "Geofences", ["change"])
+        self.seconds = self.registry.histogram("cycle_seconds", "Cycles", buckets=(1.0, 10.0))
+
+    def test_render(self):
+        self.fences.inc(2, change="added")
+        self.fences.inc(change="added")
+        self.seconds.observe(0.5)
+        self.seconds.observe(5)
+        self.seconds.observe(50)
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn("# TYPE fences_total counter", lines)
+        self.assertIn('fences_total{change="added"} 3.0', lines)
+        self.assertIn("# TYPE cycle_seconds histogram", lines)
+        self.assertIn('cycle_seconds_bucket{le="1.0"} 1', lines)
+        self.assertIn('cycle_seconds_bucket{le="10.0"} 2', lines)
+        self.assertIn('cycle_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("cycle_seconds_sum 55.5", lines)
+        self.assertIn("cycle_seconds_count 3", lines)
+
+    def test_wrong_labels(self):
+        with self.assertRaises(ValueError):
+            self.fences.inc(kind="added")
+
+    def test_server(self):
+        self.fences.inc(change="deleted")
+        server = MetricsServer(0, registry=self.registry)
+        server.start()
+        try:
+            resp = requests.get("http://{}:{}/metrics".format(*server.address), timeout=5)
+        finally:
+            server.stop()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('fences_total{change="deleted"} 1.0', resp.text)
+
+    def test_file(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(workdir, "metrics.prom")
+            exporter = MetricsFile(path, interval=60, registry=self.registry)
+            exporter.start()
+            exporter.stop()
+            with open(path) as f:
+                self.assertIn("cycle_seconds_count 0", f.read())
+        finally:
+            shutil.rmtree(workdir)
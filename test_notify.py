@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import threading
+import time
+from notify import SlackNotifier
+
+
+class RecordingSession(object):
+    """Stands in for requests.Session, keeping what is posted"""
+
+    def __init__(self):
+        self.posted = []
+
+    def post(self, url, json=None, timeout=None):
+        self.posted.append(json)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SlowSession(RecordingSession):
+    """Holds up each post until 'release' is set"""
+
+    def __init__(self):
+        RecordingSession.__init__(self)
+        self.release = threading.Event()
+
+    def post(self, url, json=None, timeout=None):
+        self.release.wait()
+        return RecordingSession.post(self, url, json, timeout)
+
+
+class TestSlackNotifier(TestCase):
+
+    def test_summary(self):
+        notifier = SlackNotifier("http://localhost/hook", max_lines=2)
+        notifier.event("New", u"New geofence: id=1")
+        notifier.event("New", u"New geofence: id=2")
+        notifier.event("Deleted", u"Vegobjekt with ID '3' removed")
+        notifier.flush()
+
+        msg = notifier._queue.get_nowait()
+        self.assertEqual(msg.splitlines(), [
+            u"Geofence changes: 2 new, 1 deleted",
+            u"New geofence: id=1",
+            u"New geofence: id=2",
+            u"... and 1 more"
+        ])
+
+        notifier.flush()
+        self.assertTrue(notifier._queue.empty())
+
+    def test_without_url(self):
+        notifier = SlackNotifier(None)
+        notifier.start()
+        notifier.event("New", u"New geofence: id=1")
+        notifier.flush()
+        notifier.notify(u"Up and running")
+        self.assertTrue(notifier._queue.empty())
+        notifier.stop()
+
+    def test_full_queue_drops(self):
+        notifier = SlackNotifier("http://localhost/hook", queue_size=2)
+        for i in range(5):
+            notifier.notify(u"msg {}".format(i))
+        self.assertEqual(notifier.dropped, 3)
+
+    def test_posts_json(self):
+        notifier = SlackNotifier("http://localhost/hook", min_interval=0)
+        session = notifier._session = RecordingSession()
+        notifier.start()
+        notifier.notify(u'Name with "quotes"')
+        notifier.stop(timeout=5)
+
+        self.assertEqual(notifier.sent, 1)
+        self.assertEqual(session.posted[0]["text"], u'Name with "quotes"')
+        self.assertEqual(session.posted[0]["channel"], "#tran-notifications")
+
+    def test_stop_with_full_queue(self):
+        notifier = SlackNotifier("http://localhost/hook", queue_size=1, min_interval=0)
+        notifier._session = session = SlowSession()
+        notifier.start()
+        notifier.notify(u"First")
+        while not notifier._queue.empty():
+            time.sleep(0.01)
+        # Queued while the first is posted, which leaves no room to stop
+        notifier.notify(u"Second")
+
+        threading.Timer(0.1, session.release.set).start()
+        started = time.time()
+        notifier.stop(timeout=5)
+
+        self.assertLess(time.time() - started, 3)
+        self.assertEqual(len(session.posted), 2)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import geofence
+from interchange import NordicWayIC
+from notify import SlackNotifier
+from pipeline import SyncPipeline
+import storage
+from testutil import FakeNvdb, FakeStore, fence
+from transport import LoopbackBroker, LoopbackTransport
+
+
+class TestSyncPipeline(TestCase):
+
+    def setUp(self):
+        self.broker = LoopbackBroker()
+        self.ic = NordicWayIC("amqp://localhost", "geofences", "positions", "user", "secret",
+                              transport=LoopbackTransport(self.broker))
+        self.ic.start()
+        self.nvdb = FakeNvdb([fence(i) for i in range(1, 11)])
+        self.store = FakeStore()
+        self.pipeline = SyncPipeline(self.nvdb, self.ic, SlackNotifier(None), interval=0,
+                                     incremental=True, delete_check_interval=0, send_timeout=10,
+                                     chunk_size=3, queue_size=2, store=self.store)
+        self.pipeline.start()
+
+    def tearDown(self):
+        self.pipeline.stop(timeout=5)
+        self.ic.stop()
+
+    def test_cycles(self):
+        cycle = self.pipeline.run_cycle()
+
+        self.assertIsNone(cycle.error)
+        self.assertEqual(sorted(self.store.rows), list(range(1, 11)))
+        self.assertEqual(self.store.state["sist_modifisert"], "2017-09-01 10:00:00")
+        self.assertEqual(self.broker.depth("geofences"), 10)
+
+        # One geofence changed and one deleted
+        self.nvdb.fences = [fence(i) for i in range(1, 10)]
+        self.nvdb.fences[0] = fence(1, "2017-09-02 10:00:00")
+        self.nvdb.fences[0]["egenskaper"][0]["verdi"] = u"Renamed"
+        self.pipeline.run(cycles=1)
+
+        self.assertEqual(sorted(self.store.rows), list(range(1, 10)))
+        self.assertEqual(self.store.state["sist_modifisert"], "2017-09-02 10:00:00")
+        self.assertEqual(self.broker.depth("geofences"), 12)
+
+    def test_full_outbox_waits(self):
+        self.ic.stop()
+        self.ic = NordicWayIC("amqp://localhost", "geofences", "positions", "user", "secret",
+                              outbox_size=4, transport=LoopbackTransport(self.broker))
+        self.ic.start()
+        self.pipeline.ic = self.ic
+        self.nvdb.fences = [fence(i) for i in range(1, 31)]
+
+        cycle = self.pipeline.run_cycle()
+
+        self.assertEqual(cycle.result.failed, [])
+        self.assertEqual(sorted(self.store.rows), list(range(1, 31)))
+        self.assertEqual(self.broker.depth("geofences"), 30)
+
+    def test_empty_listing(self):
+        self.nvdb.fences = []
+
+        # Nothing stored yet, so there is nothing to delete either
+        self.assertIsNone(self.pipeline.run_cycle().error)
+
+        self.nvdb.fences = [fence(1)]
+        self.pipeline.run_cycle()
+        self.nvdb.fences = []
+        self.pipeline.last_delete_check = 0
+        # Guards against deleting every stored geofence
+        cycle = self.pipeline.run_cycle()
+        self.assertIsInstance(cycle.error, geofence.FetchError)
+        self.assertEqual(sorted(self.store.rows), [1])
+
+    def test_fetch_error_keeps_watermark(self):
+        self.nvdb.fail = True
+
+        cycle = self.pipeline.run_cycle()
+
+        self.assertIsInstance(cycle.error, geofence.FetchError)
+        self.assertNotIn("sist_modifisert", self.store.state)
+        self.assertEqual(self.pipeline.last_delete_check, 0)
+
+    def test_database_from_stage_threads(self):
+        self.pipeline.store = storage
+        try:
+            storage.connect("sqlite://")
+            self.pipeline.run_cycle()
+            self.nvdb.fences.pop()
+            cycle = self.pipeline.run_cycle()
+            stored = storage.versions()
+        finally:
+            storage.configure()
+
+        self.assertIsNone(cycle.error)
+        self.assertEqual(cycle.changes.deleted, [10])
+        self.assertEqual(sorted(stored), list(range(1, 10)))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from interchange import NordicWayIC
+from notify import SlackNotifier
+from pipeline import SyncPipeline
+from profiling import CycleProfiler
+from testutil import FakeNvdb, FakeStore, fence
+from transport import LoopbackBroker, LoopbackTransport
+
+
+class SlowNvdb(FakeNvdb):
+
+    def objects(self, changed_since=None):
+        time.sleep(0.05)
+        return FakeNvdb.objects(self, changed_since)
+
+
+class TestCycleProfiler(TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.ic = NordicWayIC("amqp://localhost", "geofences", "positions", "user", "secret",
+                              transport=LoopbackTransport(LoopbackBroker()))
+        self.ic.start()
+
+    def tearDown(self):
+        self.ic.stop()
+        shutil.rmtree(self.workdir)
+
+    def _run(self, profiler, cycles):
+        pipeline = SyncPipeline(SlowNvdb([fence(i) for i in range(1, 6)]), self.ic, SlackNotifier(None),
+                                interval=0, send_timeout=10, store=FakeStore(), profiler=profiler)
+        pipeline.start()
+        try:
+            pipeline.run(cycles)
+        finally:
+            pipeline.stop(timeout=5)
+
+    def test_cprofile(self):
+        profiler = CycleProfiler(self.workdir)
+        profiler.request(1)
+
+        self._run(profiler, 2)
+
+        self.assertEqual(len(profiler.written), 1)
+        path = profiler.written[0]
+        self.assertTrue(path.endswith("-cycle0-fences5-added5-modified0-deleted0.pstats"))
+        functions = [f[2] for f in pstats.Stats(path).stats]
+        self.assertIn("compute", functions)
+        self.assertIn("create_doc", functions)
+        self.assertIn("versions", functions)
+
+    def test_sample(self):
+        profiler = CycleProfiler(os.path.join(self.workdir, "profiles"), mode="sample", interval=0.001)
+        profiler.request(1)
+
+        self._run(profiler, 1)
+
+        path = profiler.written[0]
+        self.assertTrue(path.endswith(".collapsed"))
+        with open(path) as f:
+            stacks = f.read()
+        self.assertIn("test_profiling.py:objects", stacks)
+
+    def test_not_requested(self):
+        profiler = CycleProfiler(self.workdir)
+
+        self._run(profiler, 1)
+
+        self.assertEqual(profiler.written, [])
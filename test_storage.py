@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import subprocess
+import sys
+import storage
+from testutil import fence
+
+
+class TestState(TestCase):
+
+    def setUp(self):
+        storage.connect("sqlite://")
+
+    def tearDown(self):
+        storage.configure()
+
+    def test_round_trip(self):
+        self.assertIsNone(storage.get_state("sist_modifisert"))
+        self.assertEqual(storage.get_state("sist_modifisert", "never"), "never")
+
+        storage.set_state("sist_modifisert", "2017-09-01 10:00:00")
+        storage.set_state("sist_modifisert", "2017-09-02 10:00:00")
+        storage.set_state("last_delete_check", "1504260000")
+
+        self.assertEqual(storage.get_state("sist_modifisert"), "2017-09-02 10:00:00")
+        self.assertEqual(storage.get_state("last_delete_check"), "1504260000")
+
+
+class TestWrite(TestCase):
+
+    def setUp(self):
+        storage.connect("sqlite://")
+
+    def tearDown(self):
+        storage.configure()
+
+    def test_write(self):
+        storage.write(added=[fence(1), fence(2), fence(3)])
+        replaced = fence(1, "2017-09-02 10:00:00")
+        renamed = fence(2, "2017-09-02 10:00:00")
+        renamed["egenskaper"][0]["verdi"] = u"Renamed"
+        # Adding a stored geofence again replaces it
+        storage.write(added=[replaced], modified=[renamed], deleted=[3])
+
+        rows = dict((row["id"], row) for row in storage.vegobjekter().all())
+        self.assertEqual(sorted(rows), [1, 2])
+        self.assertEqual(rows[1]["sist_modifisert"], "2017-09-02 10:00:00")
+        self.assertEqual(rows[2]["name"], u"Renamed (Test)")
+        self.assertIsNotNone(rows[2]["centroid"])
+        self.assertIsNotNone(rows[2]["content_hash"])
+
+    def test_nothing_to_write(self):
+        storage.write()
+        self.assertNotIn("vegobjekter", storage.get_db().tables)
+
+
+class TestMigrations(TestCase):
+
+    def setUp(self):
+        storage.connect("sqlite://")
+
+    def tearDown(self):
+        storage.configure()
+
+    def test_migrate_once(self):
+        self.assertEqual(storage.schema_version(), 0)
+
+        self.assertEqual(storage.migrate(), len(storage.MIGRATIONS))
+        self.assertEqual(storage.get_state("schema_version"), str(len(storage.MIGRATIONS)))
+
+        # A current database is not scanned again
+        storage.vegobjekter().insert({"id": 1, "name": u"Geofence", "version": 1, "centroid": None,
+                                      "polygon": "POLYGON ((0 0, 1 0, 1 1, 0 0))"})
+        self.assertEqual(storage.migrate(), len(storage.MIGRATIONS))
+        self.assertIsNone(storage.vegobjekter().find_one(id=1)["centroid"])
+
+    def test_drops_id_index(self):
+        storage.ensure_schema()
+        storage.get_db().query("CREATE UNIQUE INDEX ix_vegobjekter_id ON vegobjekter (id)")
+
+        storage.migrate()
+
+        indexes = [row["name"] for row in storage.get_db().query(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'vegobjekter'")]
+        self.assertNotIn("ix_vegobjekter_id", indexes)
+
+    def test_import_does_not_connect(self):
+        loaded = subprocess.check_output([sys.executable, "-c",
+                                          "import sys, storage, client; print('dataset' in sys.modules)"])
+        self.assertEqual(loaded.strip(), b"False")
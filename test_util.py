@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import numpy as np
+import util
+
+
+class TestUtmToGps(TestCase):
+
+    def setUp(self):
+        # Polygon, Oslo, Grønland
+        self.polygon = [(262906.3971474045, 6649248.441221254),
+                        (263059.8558061711, 6649187.586932589),
+                        (263022.81406153727, 6649124.086805921),
+                        (263816.5657456318, 6648542.002307889),
+                        (263943.56601331057, 6648669.00256108),
+                        (263803.3365402619, 6650023.6719330065),
+                        (262906.3971474045, 6649248.441221254)]
+
+    def test_matches_scalar_conversion(self):
+        lat, lon = util.utm_to_gps_array(self.polygon)
+
+        for i, p in enumerate(self.polygon):
+            expected = util.utm_to_gps(p)
+            self.assertAlmostEqual(lat[i], expected[0], delta=1e-9)
+            self.assertAlmostEqual(lon[i], expected[1], delta=1e-9)
+
+    def test_empty_polygon(self):
+        lat, lon = util.utm_to_gps_array([])
+
+        self.assertEqual(len(lat), 0)
+        self.assertEqual(len(lon), 0)
+
+    def test_polygons_to_gps(self):
+        polygons = [self.polygon, self.polygon[:3]]
+
+        gps = util.polygons_to_gps(polygons)
+
+        self.assertEqual([len(p) for p in gps], [7, 3])
+        lat, lon = util.utm_to_gps_array(self.polygon[:3])
+        np.testing.assert_array_equal(gps[1][:, 0], lat)
+        np.testing.assert_array_equal(gps[1][:, 1], lon)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Fixtures shared by the tests"""
+
+import geofence
+
+
+def vegobjekt(nvdb_id, sist_modifisert, polygon="POLYGON ((0 0, 1 0, 1 1, 0 0))"):
+    return {
+        "id": nvdb_id,
+        "metadata": {"sist_modifisert": sist_modifisert},
+        "egenskaper": [
+            {"id": 11212, "datatype": 1, "verdi": u"Geofence {}".format(nvdb_id)},
+            {"id": 11213, "datatype": 1, "verdi": u"Test"},
+            {"id": 11214, "datatype": 1, "verdi": "1"},
+            {"id": 11215, "datatype": 19, "verdi": polygon}
+        ]
+    }
+
+
+class FakeNvdb(object):
+
+    def __init__(self, fences):
+        self.fences = fences
+        self.fail = False
+
+    def objects(self, changed_since=None):
+        for fence in self.fences:
+            yield fence
+        if self.fail:
+            raise geofence.FetchError("Page 2 timed out")
+
+    def ids(self):
+        return [f["id"] for f in self.fences]
+
+
+class FakeStore(object):
+    """Keeps the geofences in memory, like storage does in the database"""
+
+    def __init__(self):
+        self.rows = {}
+        self.state = {}
+
+    def get_state(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set_state(self, key, value):
+        self.state[key] = value
+
+    def versions(self):
+        return dict((i, (f["metadata"]["sist_modifisert"], geofence.get_content_hash(f)))
+                    for i, f in self.rows.items())
+
+    def find(self, ids):
+        return [{"id": i, "name": "Geofence", "version": 1, "centroid": "0,0",
+                 "polygon": "POLYGON ((262906 6649248, 263059 6649187, 263000 6649124, 262906 6649248))"}
+                for i in ids]
+
+    def write(self, added=(), modified=(), deleted=()):
+        for f in list(added) + list(modified):
+            self.rows[f["id"]] = f
+        for i in deleted:
+            self.rows.pop(i, None)
+
+
+def fence(nvdb_id, sist_modifisert="2017-09-01 10:00:00"):
+    f = vegobjekt(nvdb_id, sist_modifisert,
+                  "POLYGON ((262906 6649248, 263059 6649187, {} 6649124, 262906 6649248))".format(
+                      263000 + nvdb_id))
+    f["href"] = "https://www.vegvesen.no/nvdb/api/v2/vegobjekter/911/{}/1".format(nvdb_id)
+    f["metadata"]["type"] = {"id": 911, "navn": "Geofence"}
+    return f
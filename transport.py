@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
+import abc
+import random
+import threading
+import time
+import six
+
+# An AMQP message as NordicWayIC sends and receives it
+Message = namedtuple("Message", ["content", "properties", "user_id"])
+
+
+# Mirrors the qpid.messaging exceptions NordicWayIC handles
+class MessagingError(Exception):
+    pass
+
+
+class TransportConnectionError(MessagingError):
+    pass
+
+
+class Timeout(MessagingError):
+    pass
+
+
+class Empty(Exception):
+    pass
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Transport(object):
+    """
+    The AMQP link NordicWayIC talks through: one connection with a
+    sender and a receiver. Sends are asynchronous, at most 'capacity'
+    messages are unsettled at a time and send() blocks while they are.
+    The receiver prefetches up to 'prefetch' messages. Either queue may
+    be None for a connection that only receives or only sends. Errors are
+    raised as the exceptions above.
+    """
+
+    @abc.abstractmethod
+    def open(self, url, sender, receiver, username=None, password=None, capacity=1, prefetch=0,
+             **options):
+        pass
+
+    @abc.abstractmethod
+    def opened(self):
+        """True if the connection is open and has not reported an error"""
+
+    @abc.abstractmethod
+    def send(self, message):
+        pass
+
+    @abc.abstractmethod
+    def unsettled(self):
+        """How many sent messages the broker has not settled yet"""
+
+    @abc.abstractmethod
+    def sync(self, timeout=None):
+        """Waits until every sent message is settled, then check_error()"""
+
+    @abc.abstractmethod
+    def check_error(self):
+        """Raises the error the broker has reported for a sent message, if any"""
+
+    @abc.abstractmethod
+    def fetch(self, timeout=None):
+        """The next Message from the receiver. Raises Empty on timeout."""
+
+    @abc.abstractmethod
+    def acknowledge(self):
+        """Acknowledges every message fetched so far"""
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class QpidTransport(Transport):
+    """Transport through qpid.messaging, which is imported on first use"""
+
+    def __init__(self):
+        try:
+            from qpid import messaging
+        except ImportError:
+            raise ImportError("Unable to find 'qpid' module. Do you have it in sys.path / PYTHONPATH?")
+        self._qpid = messaging
+        self.connection = None
+
+    @contextmanager
+    def _errors(self):
+        """Raises qpid errors as the exceptions of this module"""
+        q = self._qpid
+        try:
+            yield
+        except q.Empty as e:
+            raise Empty(str(e))
+        except q.ConnectionError as e:
+            raise TransportConnectionError(str(e))
+        except q.Timeout as e:
+            raise Timeout(str(e))
+        except q.MessagingError as e:
+            raise MessagingError(str(e))
+
+    def open(self, url, sender, receiver, username=None, password=None, capacity=1, prefetch=0,
+             **options):
+        with self._errors():
+            self.connection = self._qpid.Connection(url, username=username, password=password, **options)
+            self.connection.open()
+            self.session = self.connection.session()
+            # qpid rejects None as a malformed address
+            self.sender = None
+            if sender is not None:
+                self.sender = self.session.sender(sender)
+                self.sender.capacity = capacity
+            self.receiver = None
+            if receiver is not None:
+                self.receiver = self.session.receiver(receiver)
+                self.receiver.capacity = prefetch
+
+    def opened(self):
+        if self.connection is None or not self.connection.opened():
+            return False
+        try:
+            with self._errors():
+                self.connection.check_error()
+        except MessagingError:
+            return False
+        return True
+
+    def send(self, message):
+        if self.sender is None:
+            raise MessagingError("No sender queue to send to")
+        m = self._qpid.Message(user_id=message.user_id,
+                               properties=message.properties,
+                               content=message.content)
+        with self._errors():
+            self.sender.send(m, sync=False)
+
+    def unsettled(self):
+        if self.sender is None:
+            return 0
+        with self._errors():
+            return self.sender.unsettled()
+
+    def sync(self, timeout=None):
+        if self.sender is None:
+            return
+        with self._errors():
+            self.sender.sync(timeout=timeout)
+            self.sender.check_error()
+
+    def check_error(self):
+        if self.sender is None:
+            return
+        with self._errors():
+            self.sender.check_error()
+
+    def fetch(self, timeout=None):
+        if self.receiver is None:
+            raise MessagingError("No receiver queue to fetch from")
+        with self._errors():
+            m = self.receiver.fetch(timeout=timeout)
+        return Message(m.content, m.properties, m.user_id)
+
+    def acknowledge(self):
+        with self._errors():
+            self.session.acknowledge()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            with self._errors():
+                self.connection.close()
+        finally:
+            self.connection = None
+
+
+class LoopbackBroker(object):
+    """
+    In-process stand-in for an AMQP broker, holding named queues of
+    messages. Shared by the LoopbackTransports connected to it.
+
+    latency      - seconds until the broker settles a sent message
+    capacity     - how many messages a queue holds, more are rejected
+    failure_rate - share of messages to reject at random
+    """
+
+    def __init__(self, latency=0.0, capacity=None, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.capacity = capacity
+        self.failure_rate = failure_rate
+        self.queues = defaultdict(deque)
+        self.accepted = 0
+        self.rejected = 0
+        self.down = False
+        # Bumped on every outage, so links from before it are broken
+        self.generation = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Condition()
+
+    def fail(self):
+        """Takes the broker down, breaking every open link"""
+        with self._lock:
+            self.down = True
+            self.generation += 1
+            self._lock.notify_all()
+
+    def restore(self):
+        with self._lock:
+            self.down = False
+
+    def depth(self, queue):
+        with self._lock:
+            return len(self.queues[queue])
+
+    def _enqueue(self, queue, message):
+        """True if 'message' is accepted into 'queue'"""
+        with self._lock:
+            if self._random.random() < self.failure_rate or (
+                    self.capacity is not None and len(self.queues[queue]) >= self.capacity):
+                self.rejected += 1
+                return False
+            self.queues[queue].append(message)
+            self.accepted += 1
+            self._lock.notify_all()
+            return True
+
+    def _dequeue(self, queue, timeout, generation):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while True:
+                if self.down or self.generation != generation:
+                    raise TransportConnectionError("Loopback broker is down")
+                if self.queues[queue]:
+                    return self.queues[queue].popleft()
+                remaining = deadline - time.time() if deadline is not None else 1.0
+                if remaining <= 0:
+                    raise Empty("No message in {}".format(queue))
+                self._lock.wait(min(remaining, 1.0))
+
+    def __repr__(self):
+        return "<{} latency={}, capacity={}, failure_rate={}, accepted={}, rejected={}>".format(
+            self.__class__.__name__, self.latency, self.capacity, self.failure_rate,
+            self.accepted, self.rejected)
+
+
+class LoopbackTransport(Transport):
+    """
+    Transport to a LoopbackBroker in the same process, for tests and load
+    testing without a network. A message enters its queue when sent and
+    is settled 'latency' seconds later.
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else LoopbackBroker()
+        self._generation = None
+        # Settle time of each unsettled message, oldest first
+        self._unsettled = deque()
+        self._error = None
+
+    def _check_link(self):
+        if self._generation is None:
+            raise TransportConnectionError("Not connected")
+        if self.broker.down or self.broker.generation != self._generation:
+            self._generation = None
+            raise TransportConnectionError("Loopback broker is down")
+
+    def _settle(self):
+        now = time.time()
+        while self._unsettled and self._unsettled[0] <= now:
+            self._unsettled.popleft()
+
+    def open(self, url, sender, receiver, username=None, password=None, capacity=1, prefetch=0,
+             **options):
+        if self.broker.down:
+            raise TransportConnectionError("Loopback broker is down")
+        self._sender = sender
+        self._receiver = receiver
+        self.capacity = capacity
+        self._unsettled.clear()
+        self._error = None
+        self._generation = self.broker.generation
+
+    def opened(self):
+        try:
+            self._check_link()
+        except TransportConnectionError:
+            return False
+        return True
+
+    def send(self, message):
+        self._check_link()
+        if self._sender is None:
+            raise MessagingError("No sender queue to send to")
+        self._settle()
+        # Block while the window is full, like the qpid sender
+        if len(self._unsettled) >= self.capacity:
+            time.sleep(max(0.0, self._unsettled[0] - time.time()))
+            self._settle()
+            self._check_link()
+        if not self.broker._enqueue(self._sender, message) and self._error is None:
+            self._error = MessagingError("Message rejected by loopback broker")
+        self._unsettled.append(time.time() + self.broker.latency)
+
+    def unsettled(self):
+        self._check_link()
+        self._settle()
+        return len(self._unsettled)
+
+    def sync(self, timeout=None):
+        self._check_link()
+        if self._unsettled:
+            wait = self._unsettled[-1] - time.time()
+            if timeout is not None and wait > timeout:
+                time.sleep(timeout)
+                raise Timeout("Loopback sync timed out")
+            time.sleep(max(0.0, wait))
+            self._check_link()
+        self._settle()
+        self.check_error()
+
+    def check_error(self):
+        self._check_link()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def fetch(self, timeout=None):
+        self._check_link()
+        if self._receiver is None:
+            raise MessagingError("No receiver queue to fetch from")
+        return self.broker._dequeue(self._receiver, timeout, self._generation)
+
+    def acknowledge(self):
+        self._check_link()
+
+    def close(self):
+        self._generation = None
+        self._unsettled.clear()
@@ -2,11 +2,15 @@
 
 import datetime
 import calendar
+import re
+import numpy as np
 import utm
-import six
-import shlex
-import subprocess
+from utm.conversion import (K0, E, E_P2, _E, M1, P2, P3, P4, P5, R,
+                            zone_number_to_central_longitude)
+from utm.error import OutOfRangeError
+import geometry
 import logging
+import requests
 
 
 def datetime_to_unix_epoch(timestamp):
@@ -21,6 +25,28 @@ def parse_timestamp(timestamp):
     return datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
 
 
+_ISO_TIMESTAMP = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?(?:(Z)|([+-])(\d\d):?(\d\d))?$")
+
+
+def parse_iso_epoch(timestamp):
+    """UNIX epoch time of an ISO 8601 timestamp such as
+    '2017-08-29T10:11:12.123456+02:00', or None if it is not one.
+    A timestamp without offset is taken as UTC.
+    """
+    match = _ISO_TIMESTAMP.match(timestamp or "")
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, utc, sign, off_h, off_m = match.groups()
+    epoch = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    if fraction:
+        epoch += float(fraction)
+    if sign:
+        offset = int(off_h) * 3600 + int(off_m) * 60
+        epoch -= offset if sign == "+" else -offset
+    return epoch
+
+
 def utm_to_gps(utm_coordinate, zone=33, zone_letter='N'):
     """
     Converts UTM coordinate to GPS lat, lon.
@@ -30,73 +56,129 @@ def utm_to_gps(utm_coordinate, zone=33, zone_letter='N'):
     return utm.to_latlon(utm_coordinate[0], utm_coordinate[1], zone, zone_letter)
 
 
-def parse_polygon(nvdb_polygon):
-    """Converts NVDB polygon (string) into a 2D python list of float UTM coords:
-    From: POLYGON ((261406.25545925 6649329.53490491, 261418.543820197 6649292.41831282))
-    To: [(261406.25545925, 6649329.53490491), (261418.543820197, 6649292.41831282)]
+def utm_to_gps_array(coordinates, zone=33, zone_letter='N'):
+    """
+    Converts an N×2 array of UTM (easting, northing) coordinates to
+    GPS in one vectorized pass. Returns the (lat, lon) tuple of arrays.
+
+    This is the formula of utm.to_latlon(), so the result matches
+    utm_to_gps() for each coordinate.
     """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    easting = coordinates[:, 0]
+    northing = coordinates[:, 1]
 
-    if not isinstance(nvdb_polygon, six.string_types):
-        raise ValueError("Invalid input argument: expected string, got {}".format(type(nvdb_polygon)))
+    if not np.all((100000 <= easting) & (easting < 1000000)):
+        raise OutOfRangeError('easting out of range (must be between 100.000 m and 999.999 m)')
+    if not np.all((0 <= northing) & (northing <= 10000000)):
+        raise OutOfRangeError('northing out of range (must be between 0 m and 10.000.000 m)')
 
-    tmp = nvdb_polygon.replace("POLYGON ((", "").replace("))", "")
-    polygon = [x.strip().split(" ") for x in tmp.split(",")]
-    return polygon
+    x = easting - 500000
+    y = northing
+    if zone_letter.upper() < 'N':
+        y = y - 10000000
 
+    m = y / K0
+    mu = m / (R * M1)
 
-def get_polygon_centroid(polygon_input):
-    """Calculates centroid from the 2D input list of UTM coordinates.
-    ref https://stackoverflow.com/questions/2792443/finding-the-centroid-of-a-polygon
+    p_rad = (mu +
+             P2 * np.sin(2 * mu) +
+             P3 * np.sin(4 * mu) +
+             P4 * np.sin(6 * mu) +
+             P5 * np.sin(8 * mu))
+
+    p_sin = np.sin(p_rad)
+    p_sin2 = p_sin * p_sin
+    p_cos = np.cos(p_rad)
+
+    p_tan = p_sin / p_cos
+    p_tan2 = p_tan * p_tan
+    p_tan4 = p_tan2 * p_tan2
+
+    ep_sin = 1 - E * p_sin2
+    ep_sin_sqrt = np.sqrt(1 - E * p_sin2)
+
+    n = R / ep_sin_sqrt
+    r = (1 - E) / ep_sin
+
+    c = _E * p_cos ** 2
+    c2 = c * c
+
+    d = x / (n * K0)
+    d2 = d * d
+    d3 = d2 * d
+    d4 = d3 * d
+    d5 = d4 * d
+    d6 = d5 * d
+
+    # Grouped exactly like utm.to_latlon() so the results agree
+    latitude = (p_rad - (p_tan / r) *
+                (d2 / 2 -
+                 d4 / 24 * (5 + 3 * p_tan2 + 10 * c - 4 * c2 - 9 * E_P2)) +
+                d6 / 720 * (61 + 90 * p_tan2 + 298 * c + 45 * p_tan4 - 252 * E_P2 - 3 * c2))
+
+    longitude = (d -
+                 d3 / 6 * (1 + 2 * p_tan2 + c) +
+                 d5 / 120 * (5 - 2 * c + 28 * p_tan2 - 3 * c2 + 8 * E_P2 + 24 * p_tan4)) / p_cos
+
+    return (np.degrees(latitude),
+            np.degrees(longitude) + zone_number_to_central_longitude(zone))
+
+
+def polygons_to_gps(polygons, zone=33, zone_letter='N'):
     """
+    Converts a list of UTM polygons to GPS with a single call to
+    utm_to_gps_array(). Returns a list with an N×2 (lat, lon) array
+    for each polygon.
+    """
+    polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polygons]
+    if not polygons:
+        return []
+
+    lat, lon = utm_to_gps_array(np.concatenate(polygons), zone, zone_letter)
+    gps = np.column_stack((lat, lon))
+    offsets = np.cumsum([len(p) for p in polygons])[:-1]
+    return np.split(gps, offsets)
+
+
+def parse_polygon(nvdb_polygon):
+    """Converts NVDB polygon (string) into an N×2 array of float UTM coords:
+    From: POLYGON ((261406.25545925 6649329.53490491, 261418.543820197 6649292.41831282))
+    To: [(261406.25545925, 6649329.53490491), (261418.543820197, 6649292.41831282)]
 
-    polygon = polygon_input
-    if isinstance(polygon_input[0][0], six.string_types):
-        polygon = [[float(i) for i in p] for p in polygon_input]
+    Only the shell of the (first) polygon is returned, see geometry.parse_wkt()
+    for holes and MULTIPOLYGON.
+    """
+    return geometry.exterior(geometry.parse_wkt(nvdb_polygon))
 
-    centroid = [0.0, 0.0]
-    signed_area = 0.0
-    a = 0.0
-    p_length = len(polygon) - 1
 
-    for i in range(p_length):
-        x0, y0 = polygon[i][0], polygon[i][1]
-        x1, y1 = polygon[i + 1][0], polygon[i + 1][1]
+def get_polygon_centroid(polygon_input):
+    """Calculates centroid from the 2D input list of UTM coordinates.
+    See geometry.polygon_stats()
+    """
+    return geometry.polygon_stats(polygon_input).centroid
 
-        a = x0 * y1 - x1 * y0
-        signed_area += a
-        centroid[0] += (x0 + x1) * a
-        centroid[1] += (y0 + y1) * a
 
-    x0, y0 = polygon[p_length][0], polygon[p_length][1]
-    x1, y1 = polygon[0][0], polygon[0][1]
-    a = x0 * y1 - x1 * y0
-    signed_area += a
-    centroid[0] += (x0 + x1) * a
-    centroid[1] += (y0 + y1) * a
+# Sent with every Slack message, see slack_notify()
+SLACK_PAYLOAD = {
+    "channel": "#tran-notifications",
+    "username": "webhookbot",
+    "icon_emoji": ":ghost:"
+}
 
-    signed_area *= 0.5
 
-    try:
-        centroid[0] /= (6.0 * signed_area)
-        centroid[1] /= (6.0 * signed_area)
-    except ZeroDivisionError:
-        raise
-    else:
-        return tuple(centroid)
-
-
-def slack_notify(msg, url):
-    cmd = """curl -s -S -X POST --data-urlencode \
-        'payload={{"channel": "#tran-notifications", "username": "webhookbot", \
-        "text": "{}", \
-        "icon_emoji": ":ghost:"}}' \
-        {}"""
-    splitted_args = cmd.format(msg, url)
-    args = shlex.split(splitted_args)
+def slack_notify(msg, url, session=None, timeout=(3.05, 10)):
+    """Posts 'msg' to the Slack webhook at 'url', through 'session' if
+    given. Returns the response, or None if it could not be sent.
+    """
     log = logging.getLogger("geofencebroker")
+    if not url:
+        return None
+    payload = dict(SLACK_PAYLOAD, text=msg)
     try:
-        #  subprocess.run(args, check=True)
-        subprocess.check_call(args)
-    except subprocess.CalledProcessError as e:
-        log.error("Unable to send Slack notification!")
-        log.exception(e)
+        resp = (session or requests).post(url, json=payload, timeout=timeout)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        log.error("Unable to send Slack notification: {}".format(e))
+        return None
+    return resp